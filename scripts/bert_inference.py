@@ -0,0 +1,271 @@
+'''
+CPU inference for the BERT category classifier fine-tuned in classification_bert.ipynb.
+
+The simpletransformers checkpoint (model_args.output_dir, 'outputs/') is exported to ONNX and quantized to int8
+with dynamic quantization. Predictions are served by onnxruntime with length-sorted micro-batches: the rows of
+a stream are read in windows, tokenized once, sorted by length and batched so that each batch is padded only to
+its longest sentence and stays below a token budget. torch is only needed for the export and the benchmark.
+
+Usage: $python bert_inference.py export --checkpoint outputs/
+       $python bert_inference.py predict --input ../data/ground_truth_test.csv --output results/bert_predictions.csv
+       $python bert_inference.py benchmark --data ../data/ground_truth_test.csv
+'''
+import argparse
+import os
+import resource
+import time
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+from transformers import AutoTokenizer
+
+from spans import bert_inputs
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+CHECKPOINT_DIR = os.path.join(SCRIPTS_DIR, 'outputs')
+ONNX_PATH = os.path.join(SCRIPTS_DIR, 'models', 'bert_category.onnx')
+QUANTIZED_PATH = os.path.join(SCRIPTS_DIR, 'models', 'bert_category.int8.onnx')
+
+# label_mapping of classification_bert.ipynb, index = class id
+LABELS = ['action', 'intention', 'belief', 'situation']
+
+
+def export_onnx(checkpoint=CHECKPOINT_DIR, onnx_path=ONNX_PATH, quantized_path=QUANTIZED_PATH, opset=17):
+    '''
+    Export the fine-tuned checkpoint to ONNX with dynamic batch and sequence axes and write an int8 copy
+    with dynamic quantization of the weights (activations are quantized at run time)
+    '''
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModelForSequenceClassification
+
+    model = AutoModelForSequenceClassification.from_pretrained(checkpoint).eval()
+    tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+    dummy = tokenizer(['The company reduced its emissions by 40% by 2030.'], return_tensors='pt')
+    os.makedirs(os.path.dirname(onnx_path) or '.', exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(model, (dummy['input_ids'], dummy['attention_mask']), onnx_path,
+                          input_names=['input_ids', 'attention_mask'], output_names=['logits'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                                        'logits': {0: 'batch'}},
+                          opset_version=opset)
+    # the tokenizer is saved next to the model, so the production nodes only need the models folder
+    tokenizer.save_pretrained(os.path.dirname(onnx_path) or '.')
+    quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+    return onnx_path, quantized_path
+
+
+def softmax(logits):
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def pad_batch(token_ids, pad_token_id):
+    '''
+    Input ids and attention mask of a batch, padded to its longest sequence
+    '''
+    length = max(len(ids) for ids in token_ids)
+    input_ids = np.full((len(token_ids), length), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(token_ids), length), dtype=np.int64)
+    for i, ids in enumerate(token_ids):
+        input_ids[i, :len(ids)] = ids
+        attention_mask[i, :len(ids)] = 1
+    return input_ids, attention_mask
+
+
+class OnnxClassifier:
+    '''
+    Class probabilities from an exported (optionally quantized) ONNX model
+    model_path: ONNX file written by export_onnx
+    threads: number of intra-op threads, None for all cores
+    '''
+
+    def __init__(self, model_path=QUANTIZED_PATH, threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def predict_proba(self, input_ids, attention_mask):
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if 'token_type_ids' in self.input_names:
+            inputs['token_type_ids'] = np.zeros_like(input_ids)
+        logits = self.session.run(['logits'], {name: inputs[name] for name in self.input_names})[0]
+        return softmax(logits)
+
+
+class TorchClassifier:
+    '''
+    Class probabilities from the fine-tuned PyTorch checkpoint, the baseline of the benchmark
+    '''
+
+    def __init__(self, checkpoint=CHECKPOINT_DIR, threads=None):
+        import torch
+        from transformers import AutoModelForSequenceClassification
+
+        if threads is not None:
+            torch.set_num_threads(threads)
+        self.torch = torch
+        self.model = AutoModelForSequenceClassification.from_pretrained(checkpoint).eval()
+
+    def predict_proba(self, input_ids, attention_mask):
+        with self.torch.no_grad():
+            logits = self.model(input_ids=self.torch.from_numpy(input_ids),
+                                attention_mask=self.torch.from_numpy(attention_mask)).logits
+        return softmax(logits.numpy())
+
+
+class BatchPredictor:
+    '''
+    Streaming predictions with length-sorted micro-batches
+    classifier: OnnxClassifier or TorchClassifier
+    tokenizer: tokenizer of the fine-tuned checkpoint
+    max_seq_length: truncation length, as in the training arguments
+    max_batch_size: maximum number of rows per batch
+    max_batch_tokens: maximum number of padded tokens (rows x longest sequence) per batch
+    window: number of rows read from the stream and sorted by length at once
+    sort_by_length: batch rows of similar length (False keeps the stream order, as the plain model does)
+    '''
+
+    def __init__(self, classifier, tokenizer, max_seq_length=512, max_batch_size=64, max_batch_tokens=8192,
+                 window=1024, sort_by_length=True):
+        self.classifier = classifier
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.window = window
+        self.sort_by_length = sort_by_length
+        self.padded_tokens = 0
+        self.tokens = 0
+
+    def batches(self, lengths):
+        '''
+        Positions of the rows of each batch, sorted by length
+        '''
+        order = np.argsort(lengths, kind='stable') if self.sort_by_length else np.arange(len(lengths))
+        batch = []
+        for position in order:
+            # rows come in ascending length, the new row sets the padded length of the batch
+            if batch and (len(batch) >= self.max_batch_size or (len(batch) + 1) * lengths[position] > self.max_batch_tokens):
+                yield batch
+                batch = []
+            batch.append(position)
+        if batch:
+            yield batch
+
+    def predict_texts(self, texts):
+        '''
+        Class probabilities of a list of input texts, in the order of the texts
+        '''
+        token_ids = self.tokenizer(list(texts), truncation=True, max_length=self.max_seq_length)['input_ids']
+        lengths = np.array([len(ids) for ids in token_ids])
+        probabilities = np.zeros((len(token_ids), len(LABELS)), dtype=np.float32)
+        for batch in self.batches(lengths):
+            input_ids, attention_mask = pad_batch([token_ids[position] for position in batch], self.tokenizer.pad_token_id)
+            probabilities[batch] = self.classifier.predict_proba(input_ids, attention_mask)
+            self.padded_tokens += input_ids.size
+        self.tokens += int(lengths.sum())
+        return probabilities
+
+    def predict(self, rows):
+        '''
+        Predict the category of each row of a stream, yields one dict per row in the input order
+        rows: iterable of input texts (already marked) or of dicts with the 'text', 'keyword' and 'event_trigger'
+              columns of the ground truth (marked with spans.bert_inputs)
+        '''
+        rows = iter(rows)
+        while True:
+            window = list(islice(rows, self.window))
+            if not window:
+                return
+            if isinstance(window[0], str):
+                texts = window
+            else:
+                texts = bert_inputs(pd.DataFrame(window)).tolist()
+            probabilities = self.predict_texts(texts)
+            best = probabilities.argmax(axis=1)
+            for row_probabilities, label_id in zip(probabilities, best):
+                yield {'label': LABELS[label_id], 'confidence': float(row_probabilities[label_id]),
+                       **{f'probability_{label}': float(probability) for label, probability in zip(LABELS, row_probabilities)}}
+
+
+def load_predictor(model_path=QUANTIZED_PATH, threads=None, **kwargs):
+    '''
+    BatchPredictor of an exported ONNX model, with the tokenizer saved next to it
+    '''
+    tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(model_path) or '.')
+    return BatchPredictor(OnnxClassifier(model_path, threads), tokenizer, **kwargs)
+
+
+def run_benchmark(backend, data_path, checkpoint, threads, max_seq_length, batch_size):
+    '''
+    Throughput, peak memory and accuracy of one backend on the test CSV (run in its own process)
+    backend: 'torch' (plain model, stream order, fixed batches), 'onnx' or 'onnx-int8' (length-sorted micro-batches)
+    '''
+    df = pd.read_csv(data_path)
+    rows = df[['text', 'keyword', 'event_trigger']].to_dict('records')
+    if backend == 'torch':
+        predictor = BatchPredictor(TorchClassifier(checkpoint, threads), AutoTokenizer.from_pretrained(checkpoint),
+                                   max_seq_length=max_seq_length, max_batch_size=batch_size, max_batch_tokens=np.inf,
+                                   sort_by_length=False)
+    else:
+        predictor = load_predictor(ONNX_PATH if backend == 'onnx' else QUANTIZED_PATH, threads, max_seq_length=max_seq_length)
+    start = time.perf_counter()
+    labels = [prediction['label'] for prediction in predictor.predict(rows)]
+    duration = time.perf_counter() - start
+    return {
+        'backend': backend,
+        'rows': len(rows),
+        'sentences_per_sec': len(rows) / duration,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'padded_tokens': predictor.padded_tokens,
+        'tokens': predictor.tokens,
+        'accuracy': float(np.mean(np.array(labels) == df['category'].to_numpy(dtype=object))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the fine-tuned BERT classifier to ONNX and run batched CPU inference.')
+    parser.add_argument('command', choices=['export', 'predict', 'benchmark'])
+    parser.add_argument('--checkpoint', default=CHECKPOINT_DIR, help='folder of the fine-tuned simpletransformers model')
+    parser.add_argument('--model', default=QUANTIZED_PATH, help='ONNX model used by predict')
+    parser.add_argument('--input', help='CSV file with the text, keyword and event_trigger columns (predict)')
+    parser.add_argument('--output', default='results/bert_predictions.csv', help='output CSV file (predict)')
+    parser.add_argument('--data', default='../data/ground_truth_test.csv', help='ground truth CSV file (benchmark)')
+    parser.add_argument('--threads', type=int, default=None, help='number of CPU threads')
+    parser.add_argument('--max-seq-length', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=24, help='batch size of the plain PyTorch model (eval_batch_size of the notebook)')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        onnx_path, quantized_path = export_onnx(args.checkpoint)
+        print(f'Exported {onnx_path} ({os.path.getsize(onnx_path) / 2**20:.0f} MB) '
+              f'and {quantized_path} ({os.path.getsize(quantized_path) / 2**20:.0f} MB)')
+    elif args.command == 'predict':
+        predictor = load_predictor(args.model, args.threads, max_seq_length=args.max_seq_length)
+        df = pd.read_csv(args.input)
+        predictions = pd.DataFrame(list(predictor.predict(df[['text', 'keyword', 'event_trigger']].to_dict('records'))))
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        pd.concat([df, predictions.add_prefix('bert_')], axis=1).to_csv(args.output, index=False)
+        print(f'Saved {len(predictions)} predictions to {args.output}')
+    elif args.command == 'benchmark':
+        from concurrent.futures import ProcessPoolExecutor
+
+        # one process per backend, so that the peak memory is measured separately
+        report = []
+        for backend in ['torch', 'onnx', 'onnx-int8']:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                report.append(executor.submit(run_benchmark, backend, args.data, args.checkpoint, args.threads,
+                                              args.max_seq_length, args.batch_size).result())
+        print(pd.DataFrame(report).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
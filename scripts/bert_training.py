@@ -0,0 +1,298 @@
+'''
+Fine-tuning of the BERT category classifier of classification_bert.ipynb with pre-tokenized inputs.
+
+The texts are tokenized once per tokenizer and stored in a cache keyed on the tokenizer and the input texts
+(untruncated, as flat int32 arrays), so trials with a different max_seq_length, batch size or number of epochs
+reuse them. Batches are drawn from length buckets and padded only to their longest sequence instead of
+padding every sentence to max_seq_length as simpletransformers does.
+
+Usage: $python bert_training.py report --max-seq-length 512 --batch-size 8
+       $python bert_training.py trial --learning-rate 8.5e-05 --epochs 5 --batch-size 8 --padding dynamic
+'''
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from transformers import AutoTokenizer
+
+from bert_inference import LABELS
+from spans import bert_inputs
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(SCRIPTS_DIR, '..', 'data')
+TOKEN_CACHE_DIR = os.path.join(SCRIPTS_DIR, 'cache', 'tokens')
+MODEL_NAME = 'roberta-base'
+
+# Parameters of the final model in classification_bert.ipynb
+PARAMS = {
+    'num_train_epochs': 5,
+    'learning_rate': 8.521786512851659e-05,
+    'train_batch_size': 8,
+    'eval_batch_size': 24,
+    'max_seq_length': 512,
+}
+
+
+def tokenizer_fingerprint(tokenizer):
+    '''
+    Hash of the tokenizer class, vocabulary and special tokens
+    '''
+    digest = hashlib.sha256()
+    digest.update(type(tokenizer).__name__.encode())
+    digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def texts_fingerprint(texts):
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class TokenizedTexts:
+    '''
+    Token ids of a list of texts as one flat array with row offsets
+    ids: int32 array of the token ids of all texts, with the special tokens
+    offsets: int64 array of len(texts) + 1 start positions
+    '''
+
+    def __init__(self, ids, offsets):
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self, max_seq_length=None):
+        lengths = np.diff(self.offsets)
+        return np.minimum(lengths, max_seq_length) if max_seq_length is not None else lengths
+
+    def batch(self, indices, max_seq_length, pad_token_id, pad_to=None):
+        '''
+        Input ids and attention mask of the rows, padded to their longest sequence (or to pad_to).
+        Sequences longer than max_seq_length keep their first tokens and the closing special token.
+        '''
+        lengths = self.lengths(max_seq_length)[indices]
+        width = pad_to if pad_to is not None else int(lengths.max())
+        input_ids = np.full((len(indices), width), pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(indices), width), dtype=np.int64)
+        for i, (index, length) in enumerate(zip(indices, lengths)):
+            start, end = self.offsets[index], self.offsets[index + 1]
+            input_ids[i, :length] = self.ids[start:start + length]
+            input_ids[i, length - 1] = self.ids[end - 1]
+            attention_mask[i, :length] = 1
+        return input_ids, attention_mask
+
+
+class TokenCache:
+    '''
+    Tokenized texts on disk and in memory, keyed on the tokenizer and the texts
+    cache_dir: folder of the .npz files
+    '''
+
+    def __init__(self, cache_dir=TOKEN_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.loaded = {}
+        self.fingerprints = {}
+
+    def encode(self, tokenizer, texts):
+        texts = list(texts)
+        if id(tokenizer) not in self.fingerprints:
+            self.fingerprints[id(tokenizer)] = tokenizer_fingerprint(tokenizer)
+        key = hashlib.sha256((self.fingerprints[id(tokenizer)] + texts_fingerprint(texts)).encode()).hexdigest()[:32]
+        if key in self.loaded:
+            return self.loaded[key]
+
+        path = os.path.join(self.cache_dir, f'{key}.npz')
+        if os.path.exists(path):
+            with np.load(path) as arrays:
+                tokens = TokenizedTexts(arrays['ids'], arrays['offsets'])
+        else:
+            # no truncation, trials truncate to their max_seq_length
+            token_ids = tokenizer(texts, truncation=False, verbose=False)['input_ids']
+            offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+            np.cumsum([len(ids) for ids in token_ids], out=offsets[1:])
+            ids = np.fromiter((token for ids in token_ids for token in ids), dtype=np.int32, count=offsets[-1])
+            tokens = TokenizedTexts(ids, offsets)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(path, ids=ids, offsets=offsets)
+        self.loaded[key] = tokens
+        return tokens
+
+
+def length_bucketed_batches(lengths, batch_size, seed=0, pool_factor=50):
+    '''
+    Batches of row indices with similar lengths: the shuffled rows are split into pools of
+    batch_size * pool_factor rows, each pool is sorted by length and cut into batches, and the
+    order of the batches is shuffled
+    '''
+    rng = np.random.default_rng(seed)
+    indices = rng.permutation(len(lengths))
+    batches = []
+    pool_size = batch_size * pool_factor
+    for pool_start in range(0, len(indices), pool_size):
+        pool = indices[pool_start:pool_start + pool_size]
+        pool = pool[np.argsort(lengths[pool], kind='stable')]
+        batches += [pool[start:start + batch_size] for start in range(0, len(pool), batch_size)]
+    return [batches[i] for i in rng.permutation(len(batches))]
+
+
+def random_batches(n_rows, batch_size, seed=0):
+    indices = np.random.default_rng(seed).permutation(n_rows)
+    return [indices[start:start + batch_size] for start in range(0, n_rows, batch_size)]
+
+
+def padding_report(lengths, batch_size, max_seq_length, seed=0):
+    '''
+    Tokens processed per epoch with padding to max_seq_length (simpletransformers), dynamic padding of random
+    batches and dynamic padding of length-bucketed batches
+    '''
+    lengths = np.minimum(lengths, max_seq_length)
+
+    def padded(batches):
+        return int(sum(len(batch) * lengths[batch].max() for batch in batches))
+
+    report = {
+        'rows': len(lengths),
+        'real_tokens': int(lengths.sum()),
+        'padded_to_max_seq_length': len(lengths) * max_seq_length,
+        'dynamic_padding': padded(random_batches(len(lengths), batch_size, seed)),
+        'bucketed_dynamic_padding': padded(length_bucketed_batches(lengths, batch_size, seed)),
+    }
+    report['reduction'] = 1 - report['bucketed_dynamic_padding'] / report['padded_to_max_seq_length']
+    return report
+
+
+def load_split(split, data_dir=DATA_DIR):
+    '''
+    BERT input texts and label ids of a ground truth split, prepared as in classification_bert.ipynb
+    '''
+    df = pd.read_csv(os.path.join(data_dir, f'ground_truth_{split}.csv'))
+    return bert_inputs(df).tolist(), df['category'].map({label: i for i, label in enumerate(LABELS)}).to_numpy()
+
+
+def predict_proba(model, tokens, max_seq_length, batch_size, pad_token_id, device):
+    import torch
+
+    model.eval()
+    lengths = tokens.lengths(max_seq_length)
+    order = np.argsort(lengths, kind='stable')
+    probabilities = np.zeros((len(tokens), len(LABELS)), dtype=np.float32)
+    with torch.no_grad():
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            input_ids, attention_mask = tokens.batch(indices, max_seq_length, pad_token_id)
+            logits = model(input_ids=torch.from_numpy(input_ids).to(device),
+                           attention_mask=torch.from_numpy(attention_mask).to(device)).logits
+            probabilities[indices] = torch.softmax(logits, dim=1).cpu().numpy()
+    return probabilities
+
+
+def train_and_evaluate(params, train_tokens, y_train, test_tokens, y_test, pad_token_id, model_name=MODEL_NAME,
+                       padding='bucketed', seed=42, report=None):
+    '''
+    Fine-tune the model with the parameters and evaluate it on the test split after every epoch
+    params: dict with the keys of PARAMS
+    padding: 'bucketed' (length buckets, dynamic padding), 'dynamic' (random batches, dynamic padding)
+             or 'max' (random batches padded to max_seq_length like simpletransformers)
+    report: optional callback report(epoch, scores) after every epoch, e.g. to prune an Optuna trial
+    Returns the scores of the last epoch, the training time and the number of tokens processed.
+    '''
+    import torch
+    from sklearn.metrics import accuracy_score, f1_score
+    from transformers import AutoModelForSequenceClassification, get_linear_schedule_with_warmup
+
+    torch.manual_seed(seed)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = AutoModelForSequenceClassification.from_pretrained(model_name, num_labels=len(LABELS)).to(device)
+    max_seq_length, batch_size = params['max_seq_length'], params['train_batch_size']
+    lengths = train_tokens.lengths(max_seq_length)
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=params['learning_rate'])
+    steps = params['num_train_epochs'] * -(-len(lengths) // batch_size)
+    # warmup ratio of the simpletransformers defaults
+    scheduler = get_linear_schedule_with_warmup(optimizer, int(0.06 * steps), steps)
+
+    start = time.perf_counter()
+    tokens_processed = 0
+    scores = {}
+    for epoch in range(params['num_train_epochs']):
+        if padding == 'bucketed':
+            batches = length_bucketed_batches(lengths, batch_size, seed + epoch)
+        else:
+            batches = random_batches(len(lengths), batch_size, seed + epoch)
+        model.train()
+        for indices in batches:
+            input_ids, attention_mask = train_tokens.batch(indices, max_seq_length, pad_token_id,
+                                                           pad_to=max_seq_length if padding == 'max' else None)
+            tokens_processed += input_ids.size
+            loss = model(input_ids=torch.from_numpy(input_ids).to(device),
+                         attention_mask=torch.from_numpy(attention_mask).to(device),
+                         labels=torch.from_numpy(y_train[indices]).to(device)).loss
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad()
+
+        y_pred = predict_proba(model, test_tokens, max_seq_length, params['eval_batch_size'], pad_token_id, device).argmax(axis=1)
+        scores = {
+            'accuracy': accuracy_score(y_test, y_pred),
+            'f1_macro': f1_score(y_test, y_pred, average='macro'),
+            'f1_weighted': f1_score(y_test, y_pred, average='weighted'),
+        }
+        if report is not None:
+            report(epoch, scores)
+
+    return {**scores, 'train_time_s': time.perf_counter() - start, 'tokens_processed': tokens_processed}
+
+
+def load_tokens(model_name=MODEL_NAME, data_dir=DATA_DIR, cache=None):
+    '''
+    Tokenizer and cached tokens and labels of the train and test split
+    '''
+    cache = cache or TokenCache()
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    train_texts, y_train = load_split('train', data_dir)
+    test_texts, y_test = load_split('test', data_dir)
+    return tokenizer, cache.encode(tokenizer, train_texts), y_train, cache.encode(tokenizer, test_texts), y_test
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the padding savings of pre-tokenized, length-bucketed batches or train one trial.')
+    parser.add_argument('command', choices=['report', 'trial'])
+    parser.add_argument('--model-name', default=MODEL_NAME)
+    parser.add_argument('--data', default=DATA_DIR, help='folder with the ground truth CSV files')
+    parser.add_argument('--max-seq-length', type=int, default=PARAMS['max_seq_length'])
+    parser.add_argument('--batch-size', type=int, default=PARAMS['train_batch_size'])
+    parser.add_argument('--eval-batch-size', type=int, default=PARAMS['eval_batch_size'])
+    parser.add_argument('--learning-rate', type=float, default=PARAMS['learning_rate'])
+    parser.add_argument('--epochs', type=int, default=PARAMS['num_train_epochs'])
+    parser.add_argument('--padding', choices=['bucketed', 'dynamic', 'max'], default='bucketed')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    tokenizer, train_tokens, y_train, test_tokens, y_test = load_tokens(args.model_name, args.data)
+    print(f'Tokenized (or loaded from the cache) in {time.perf_counter() - start:.2f} s')
+
+    if args.command == 'report':
+        report = padding_report(train_tokens.lengths(), args.batch_size, args.max_seq_length)
+        print(json.dumps(report, indent=4))
+    elif args.command == 'trial':
+        params = {'num_train_epochs': args.epochs, 'learning_rate': args.learning_rate, 'train_batch_size': args.batch_size,
+                  'eval_batch_size': args.eval_batch_size, 'max_seq_length': args.max_seq_length}
+        result = train_and_evaluate(params, train_tokens, y_train, test_tokens, y_test, tokenizer.pad_token_id,
+                                    args.model_name, args.padding,
+                                    report=lambda epoch, scores: print(f'epoch {epoch + 1}: {scores}'))
+        print(json.dumps({**result, 'tokens_per_epoch': result['tokens_processed'] / args.epochs}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+'''
+CatBoost classifier of the event category from the event features, with the features and the tuned
+parameters of catboost_shap.ipynb, as an importable and persisted predictor.
+
+Usage: $python catboost_predictor.py train
+       $python catboost_predictor.py report --thresholds 0.5 0.6 0.7 0.8 0.9
+       $python catboost_predictor.py score --input features.csv --output predictions.parquet --threads 8
+       $python catboost_predictor.py benchmark --rows 10000000
+'''
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from catboost import CatBoostClassifier, Pool
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(SCRIPTS_DIR, '..', 'data')
+MODEL_PATH = os.path.join(SCRIPTS_DIR, 'models', 'catboost_category.cbm')
+
+FEATURES = ['Measurability', 'Temporal Status', 'Event Factuality', 'Keyword is Nsubj', 'Keyword is Dobj', 'Keyword is Pobj']
+CATEGORICAL_FEATURES = ['Temporal Status', 'Event Factuality', 'Keyword is Nsubj', 'Keyword is Dobj', 'Keyword is Pobj']
+
+# Best hyperparameters of the Optuna search in catboost_shap.ipynb
+PARAMS = {
+    'leaf_estimation_method': 'Gradient',
+    'learning_rate': 0.05599447214373542,
+    'depth': 5,
+    'bootstrap_type': 'Bernoulli',
+    'objective': 'MultiClass',
+    'subsample': 0.14439138713112645,
+    'colsample_bylevel': 0.7334294913535412,
+    'min_data_in_leaf': 93,
+    'random_state': 42,
+    'verbose': 0,
+    "eval_metric" : 'TotalF1',
+    "early_stopping_rounds" : 100
+}
+
+# Columns of the ground truth CSV files holding the features
+GROUND_TRUTH_FEATURES = {
+    'Measurability': 'measurability',
+    'Temporal Status': 'temporal_status',
+    'Event Factuality': 'event_factuality',
+    'Keyword is Nsubj': 'kw_is_nsubj',
+    'Keyword is Dobj': 'kw_is_dobj',
+    'Keyword is Pobj': 'kw_is_pobj',
+}
+
+
+def prepare_features(X):
+    '''
+    Integer measurability and categorical features as Python objects, which CatBoost accepts
+    (pandas string arrays are rejected)
+    '''
+    X = X[FEATURES].copy()
+    X['Measurability'] = X['Measurability'].astype('int')
+    for feature in CATEGORICAL_FEATURES:
+        X[feature] = X[feature].astype(object)
+    return X
+
+
+def load_grouped_features(path):
+    '''
+    Features and category of a grouped features CSV file, prepared as in catboost_shap.ipynb
+    '''
+    df = pd.read_csv(path).dropna()
+    return prepare_features(df), df['category'].to_numpy(dtype=object)
+
+
+def unique_rows(X):
+    '''
+    Position of the first occurrence of each distinct row and the index of the distinct row of every row
+    (rows are compared by their 64-bit hash)
+    '''
+    codes, uniques = pd.factorize(pd.util.hash_pandas_object(X, index=False).to_numpy())
+    first = np.empty(len(uniques), dtype=np.int64)
+    first[codes[::-1]] = np.arange(len(codes) - 1, -1, -1)
+    return first, codes
+
+
+def make_pool(X, y=None, quantize=False):
+    '''
+    CatBoost Pool of the features, built once and reused for every fit or prediction
+    quantize: quantize the features for training (borders of the numerical features, hashes of the categorical
+              ones), so that fits on the pool skip this step. Quantized pools cannot be used for predictions.
+    '''
+    pool = Pool(prepare_features(X), label=y, cat_features=CATEGORICAL_FEATURES)
+    if quantize:
+        pool.quantize()
+    return pool
+
+
+def load_grouped_pools(data_dir=DATA_DIR):
+    '''
+    Quantized training pool, prediction pool and labels of the test split of the grouped features files
+    '''
+    X_train, y_train = load_grouped_features(os.path.join(data_dir, 'ground_truth_features_grouped_train.csv'))
+    X_test, y_test = load_grouped_features(os.path.join(data_dir, 'ground_truth_features_grouped_test.csv'))
+    return make_pool(X_train, y_train, quantize=True), make_pool(X_test), y_test
+
+
+def features_from_ground_truth(df):
+    '''
+    Features of the rows of a ground truth dataframe in the format of the grouped features files:
+    integer measurability and event factuality without its numeric prefix ('3_max' -> 'max').
+    Returns the features and a mask of the rows with all features present.
+    '''
+    X = pd.DataFrame({feature: df[column].values for feature, column in GROUND_TRUTH_FEATURES.items()})
+    complete = X.notna().all(axis=1).values
+    X['Measurability'] = X['Measurability'].fillna(0)
+    X['Event Factuality'] = X['Event Factuality'].astype(str).str.split('_', n=1).str[-1].where(X['Event Factuality'] != '_', '_')
+    return prepare_features(X.fillna('')), complete
+
+
+def train_model(X_train, y_train, params=PARAMS):
+    '''
+    X_train: features, or a (quantized) Pool with the labels, in which case y_train is ignored
+    '''
+    model = CatBoostClassifier(**params, allow_writing_files=False)
+    if isinstance(X_train, Pool):
+        model.fit(X_train)
+    else:
+        model.fit(X_train, y_train, cat_features=CATEGORICAL_FEATURES)
+    return model
+
+
+class CategoryPredictor:
+    '''
+    Predicts the event category and the class probability from the event features
+    model: fitted CatBoostClassifier
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.classes = np.array(model.classes_)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        model = CatBoostClassifier()
+        model.load_model(path)
+        return cls(model)
+
+    @classmethod
+    def load_or_train(cls, path=MODEL_PATH, data_dir=DATA_DIR):
+        '''
+        Load the persisted model, or train it on the grouped features train split and save it first
+        '''
+        if not os.path.exists(path):
+            train_pool, _, _ = load_grouped_pools(data_dir)
+            cls(train_model(train_pool, None)).save(path)
+        return cls.load(path)
+
+    def save(self, path=MODEL_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.model.save_model(path)
+
+    def predict_proba(self, X, thread_count=-1, deduplicate=True):
+        '''
+        X: features or a Pool built with make_pool
+        thread_count: number of CPU threads, -1 for all cores
+        deduplicate: predict each distinct feature combination once. The six low-cardinality features have few
+                     distinct combinations, so large files need only a handful of predictions.
+        '''
+        if isinstance(X, Pool):
+            return self.model.predict_proba(X, thread_count=thread_count)
+        if not deduplicate:
+            return self.model.predict_proba(make_pool(X), thread_count=thread_count)
+        first, codes = unique_rows(X[FEATURES])
+        return self.model.predict_proba(make_pool(X.iloc[first]), thread_count=thread_count)[codes]
+
+    def predict_with_confidence(self, X, thread_count=-1):
+        '''
+        Most probable category of each row and its probability
+        '''
+        probabilities = self.predict_proba(X, thread_count)
+        best = probabilities.argmax(axis=1)
+        return self.classes[best], probabilities[np.arange(len(best)), best]
+
+
+def coverage_report(predictor, X, y, thresholds, complete=None):
+    '''
+    Coverage/accuracy trade-off of answering the rows whose class probability exceeds a threshold locally
+    complete: optional mask of the rows with all features present, other rows are never answered locally
+    Returns a dataframe with one row per threshold: number and share of the rows answered locally, accuracy
+    of the local answers and accuracy the predictor would have had on the rows left to the LLM.
+    '''
+    labels, confidences = predictor.predict_with_confidence(X)
+    if complete is not None:
+        confidences = np.where(complete, confidences, 0.0)
+    correct = labels == np.asarray(y)
+    report = []
+    for threshold in thresholds:
+        local = confidences >= threshold
+        report.append({
+            'threshold': threshold,
+            'rows': len(local),
+            'local_rows': int(local.sum()),
+            'coverage': local.mean(),
+            'accuracy_local': correct[local].mean() if local.any() else np.nan,
+            'accuracy_remaining': correct[~local].mean() if (~local).any() else np.nan,
+        })
+    return pd.DataFrame(report)
+
+
+def score_csv(predictor, input_path, output_path, chunk_size=1000000, thread_count=-1, deduplicate=True):
+    '''
+    Score a large features CSV file (columns as in ground_truth_features_grouped_*.csv) chunk by chunk and write the
+    class probabilities and the predicted category of each row to a CSV or Parquet file
+    Returns the number of rows and the time spent reading, predicting and writing.
+    '''
+    timings = {'rows': 0, 'read_s': 0.0, 'predict_s': 0.0, 'write_s': 0.0}
+    writer = None
+    start = time.perf_counter()
+    for i, chunk in enumerate(pd.read_csv(input_path, usecols=FEATURES, chunksize=chunk_size)):
+        read = time.perf_counter()
+        probabilities = predictor.predict_proba(chunk, thread_count, deduplicate)
+        predicted = time.perf_counter()
+
+        scores = pd.DataFrame(probabilities, columns=[f'probability_{category}' for category in predictor.classes])
+        scores['predicted_category'] = predictor.classes[probabilities.argmax(axis=1)]
+        if output_path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(scores, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table)
+        else:
+            scores.to_csv(output_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+        written = time.perf_counter()
+
+        timings['rows'] += len(chunk)
+        timings['read_s'] += read - start
+        timings['predict_s'] += predicted - read
+        timings['write_s'] += written - predicted
+        start = time.perf_counter()
+    if writer is not None:
+        writer.close()
+    return timings
+
+
+def write_synthetic_features(path, n_rows, data_dir=DATA_DIR, chunk_size=1000000, seed=42):
+    '''
+    Write n_rows feature rows sampled from the grouped features train split to a CSV file
+    '''
+    df = pd.read_csv(os.path.join(data_dir, 'ground_truth_features_grouped_train.csv')).dropna()[FEATURES]
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_rows, chunk_size):
+        sample = df.iloc[rng.integers(0, len(df), min(chunk_size, n_rows - start))]
+        sample.to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the CatBoost category predictor or report its coverage/accuracy trade-off.')
+    parser.add_argument('command', choices=['train', 'report', 'score', 'benchmark'])
+    parser.add_argument('--model', default=MODEL_PATH, help='path of the persisted model')
+    parser.add_argument('--data', default=DATA_DIR, help='folder with the ground truth CSV files')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95])
+    parser.add_argument('--input', help='features CSV file to score')
+    parser.add_argument('--output', default='predictions.parquet', help='CSV or Parquet file of the scores')
+    parser.add_argument('--chunk-size', type=int, default=1000000, help='rows scored at once')
+    parser.add_argument('--threads', type=int, default=-1, help='CPU threads of the predictions, -1 for all cores')
+    parser.add_argument('--rows', type=int, default=10000000, help='number of synthetic rows of the benchmark')
+    parser.add_argument('--no-deduplicate', action='store_true', help='predict every row instead of each distinct feature combination once')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        train_pool, _, _ = load_grouped_pools(args.data)
+        CategoryPredictor(train_model(train_pool, None)).save(args.model)
+        print(f'Saved the model to {args.model}')
+    elif args.command == 'report':
+        predictor = CategoryPredictor.load_or_train(args.model, args.data)
+        # the rows of the test split as they are routed in llm_annotation.py
+        df_test = pd.read_csv(os.path.join(args.data, 'ground_truth_test.csv'))
+        X_test, complete = features_from_ground_truth(df_test)
+        print(coverage_report(predictor, X_test, df_test['category'], args.thresholds, complete).to_string(index=False))
+    elif args.command == 'score':
+        predictor = CategoryPredictor.load_or_train(args.model, args.data)
+        timings = score_csv(predictor, args.input, args.output, args.chunk_size, args.threads, not args.no_deduplicate)
+        print(f"Scored {timings['rows']} rows in {sum(timings[key] for key in ['read_s', 'predict_s', 'write_s']):.1f} s, saved to {args.output}")
+    elif args.command == 'benchmark':
+        import tempfile
+
+        predictor = CategoryPredictor.load_or_train(args.model, args.data)
+        with tempfile.TemporaryDirectory() as folder:
+            input_path = os.path.join(folder, 'features.csv')
+            write_synthetic_features(input_path, args.rows, args.data, args.chunk_size)
+            timings = score_csv(predictor, input_path, os.path.join(folder, 'predictions.parquet'), args.chunk_size, args.threads,
+                                not args.no_deduplicate)
+        total = timings['read_s'] + timings['predict_s'] + timings['write_s']
+        print(f"{timings['rows']} rows, chunks of {args.chunk_size}, thread_count {args.threads}, deduplicate {not args.no_deduplicate}:")
+        for key in ['read_s', 'predict_s', 'write_s']:
+            print(f"  {key[:-2]:8s} {timings[key]:7.1f} s  {timings['rows'] / timings[key]:12,.0f} rows/s")
+        print(f"  total    {total:7.1f} s  {timings['rows'] / total:12,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+'''
+Optuna hyperparameter search of the CatBoost (catboost_shap.ipynb) and BERT (classification_bert.ipynb) category
+classifiers with a persistent, shared study.
+
+The study is stored in a local SQLite database, so several worker processes optimize the same study and an
+interrupted search is resumed by running the command again. Each trial reports the test macro-F1 while it trains
+(every 200 iterations for CatBoost, every epoch for BERT) and the pruner stops trials that fall behind.
+
+Usage: $python hyperparameter_search.py catboost --workers 4 --trials 60 --pruner median
+       $python hyperparameter_search.py catboost --workers 1 --trials 60 --pruner none --study catboost-sequential
+       $python hyperparameter_search.py report --study catboost --baseline catboost-sequential
+'''
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import optuna
+import pandas as pd
+from catboost import CatBoostClassifier
+from sklearn.metrics import f1_score
+
+from catboost_predictor import DATA_DIR, PARAMS, SCRIPTS_DIR, load_grouped_pools
+
+STORAGE_PATH = os.path.join(SCRIPTS_DIR, 'models', 'optuna.sqlite')
+
+# Best macro-F1 of the sequential search in catboost_shap.ipynb, classification_bert.ipynb has no search to compare with
+NOTEBOOK_BEST_F1 = {'catboost': 0.4997031703928256}
+
+PRUNERS = {
+    'median': lambda: optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=1),
+    'halving': lambda: optuna.pruners.SuccessiveHalvingPruner(),
+    'none': lambda: optuna.pruners.NopPruner(),
+}
+
+
+def storage(path=STORAGE_PATH):
+    '''
+    SQLite storage shared by the worker processes, waiting for locks instead of failing
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    return optuna.storages.RDBStorage(f'sqlite:///{path}', engine_kwargs={'connect_args': {'timeout': 60}})
+
+
+def catboost_params(trial):
+    '''
+    Search space of the objective in catboost_shap.ipynb
+    '''
+    return {
+        "learning_rate": trial.suggest_float("learning_rate", 1e-3, 0.1, log=True),
+        "depth": trial.suggest_int("depth", 1, 10),
+        "subsample": trial.suggest_float("subsample", 0.1, 1.0),
+        "colsample_bylevel": trial.suggest_float("colsample_bylevel", 0.05, 1.0),
+        "min_data_in_leaf": trial.suggest_int("min_data_in_leaf", 1, 100),
+        **{key: PARAMS[key] for key in ['leaf_estimation_method', 'bootstrap_type', 'objective', 'random_state', 'verbose',
+                                        'eval_metric', 'early_stopping_rounds']},
+    }
+
+
+class CatBoostObjective:
+    '''
+    Macro-F1 on the grouped features test split. The 1000 iterations of the notebook are trained in steps,
+    continuing from the previous model, and the score of each step is reported to the pruner. The data is
+    quantized once into pools shared by all trials of the worker.
+    '''
+
+    def __init__(self, data_dir=DATA_DIR, iterations=1000, step=200, thread_count=-1):
+        self.train_pool, self.test_pool, self.y_test = load_grouped_pools(data_dir)
+        self.iterations = iterations
+        self.step = step
+        self.thread_count = thread_count
+
+    def __call__(self, trial):
+        params = catboost_params(trial)
+        model = None
+        for trained in range(self.step, self.iterations + self.step, self.step):
+            next_model = CatBoostClassifier(**params, iterations=min(self.step, self.iterations - trained + self.step),
+                                            thread_count=self.thread_count, allow_writing_files=False)
+            next_model.fit(self.train_pool, init_model=model)
+            model = next_model
+            f1 = f1_score(self.y_test, model.predict(self.test_pool).ravel(), average='macro')
+            trial.report(f1, min(trained, self.iterations))
+            if trial.should_prune():
+                raise optuna.TrialPruned()
+        return f1
+
+
+def bert_params(trial):
+    '''
+    Search space of the (commented) objective in classification_bert.ipynb
+    '''
+    return {
+        "num_train_epochs": trial.suggest_int("num_train_epochs", 1, 5),
+        "learning_rate": trial.suggest_float("learning_rate", 1e-6, 1e-4, log=True),
+        "train_batch_size": trial.suggest_int("train_batch_size", 8, 32),
+        "eval_batch_size": trial.suggest_int("eval_batch_size", 8, 32),
+        "max_seq_length": trial.suggest_int("max_seq_length", 128, 512),
+    }
+
+
+class BertObjective:
+    '''
+    Test macro-F1 of a fine-tuned BERT model, reported after every epoch. The texts are tokenized once
+    per worker (and cached on disk for the other workers, see bert_training.py).
+    '''
+
+    def __init__(self, data_dir=DATA_DIR, thread_count=-1):
+        import torch
+        from bert_training import load_tokens
+
+        if thread_count > 0:
+            torch.set_num_threads(thread_count)
+        self.tokenizer, self.train_tokens, self.y_train, self.test_tokens, self.y_test = load_tokens(data_dir=data_dir)
+
+    def __call__(self, trial):
+        from bert_training import train_and_evaluate
+
+        def report(epoch, scores):
+            trial.report(scores['f1_macro'], epoch)
+            if trial.should_prune():
+                raise optuna.TrialPruned()
+
+        result = train_and_evaluate(bert_params(trial), self.train_tokens, self.y_train, self.test_tokens, self.y_test,
+                                    self.tokenizer.pad_token_id, report=report)
+        return result['f1_macro']
+
+
+OBJECTIVES = {'catboost': CatBoostObjective, 'bert': BertObjective}
+
+
+def create_study(study_name, pruner='median', storage_path=STORAGE_PATH, seed=None):
+    return optuna.create_study(study_name=study_name, storage=storage(storage_path), direction='maximize',
+                               load_if_exists=True, pruner=PRUNERS[pruner](),
+                               sampler=optuna.samplers.TPESampler(seed=seed))
+
+
+def run_worker(model_name, study_name, n_trials, pruner, storage_path, worker, thread_count=-1):
+    '''
+    Optimize the shared study until it has n_trials finished (complete or pruned) trials
+    thread_count: CPU threads of the worker, -1 for all cores
+    '''
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    study = create_study(study_name, pruner, storage_path, seed=worker)
+    states = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+    if len(study.get_trials(deepcopy=False, states=states)) >= n_trials:
+        return
+    objective = OBJECTIVES[model_name](thread_count=thread_count)
+    study.optimize(objective, callbacks=[optuna.study.MaxTrialsCallback(n_trials, states=states)])
+
+
+def search(model_name, study_name, n_trials=60, workers=1, pruner='median', storage_path=STORAGE_PATH):
+    # create the study once, so that the workers do not race to create the tables
+    study = create_study(study_name, pruner, storage_path)
+    study.set_user_attr('model', model_name)
+    if workers == 1:
+        run_worker(model_name, study_name, n_trials, pruner, storage_path, 0)
+    else:
+        # share the cores between the workers instead of oversubscribing them
+        thread_count = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_worker, model_name, study_name, n_trials, pruner, storage_path, worker, thread_count)
+                       for worker in range(workers)]
+            for future in futures:
+                future.result()
+    return optuna.load_study(study_name=study_name, storage=storage(storage_path))
+
+
+def time_to_target(study, target):
+    '''
+    Wall-clock time and number of finished trials until the study first reached the target score,
+    None if it did not. The time runs from the start of the first trial.
+    '''
+    trials = [trial for trial in study.trials if trial.datetime_complete is not None]
+    if not trials:
+        return None
+    started = min(trial.datetime_start for trial in trials)
+    for n_finished, trial in enumerate(sorted(trials, key=lambda trial: trial.datetime_complete), start=1):
+        if trial.state == optuna.trial.TrialState.COMPLETE and trial.value >= target:
+            return {'seconds': (trial.datetime_complete - started).total_seconds(), 'trials': n_finished}
+    return None
+
+
+def notebook_target(study):
+    '''
+    Best macro-F1 of the notebook of the study's model, None if the notebook has none
+    '''
+    # studies created before the model was stored are named after it, e.g. 'catboost' or 'catboost-sequential'
+    model_name = study.user_attrs.get('model', study.study_name.split('-')[0])
+    return NOTEBOOK_BEST_F1.get(model_name)
+
+
+def study_report(study, target=None):
+    '''
+    Trials, best score and wall-clock time of a study, and the time and trials to reach the target (if any)
+    '''
+    trials = study.trials
+    finished = [trial for trial in trials if trial.datetime_complete is not None]
+    states = pd.Series([trial.state.name for trial in trials]).value_counts()
+    reached = time_to_target(study, target) if target is not None else None
+    return {
+        'study': study.study_name,
+        'trials': len(finished),
+        'complete': int(states.get('COMPLETE', 0)),
+        'pruned': int(states.get('PRUNED', 0)),
+        'best_f1_macro': study.best_value if states.get('COMPLETE', 0) else np.nan,
+        'wall_clock_s': (max(trial.datetime_complete for trial in finished)
+                         - min(trial.datetime_start for trial in finished)).total_seconds() if finished else np.nan,
+        'seconds_to_target': reached['seconds'] if reached else np.nan,
+        'trials_to_target': reached['trials'] if reached else np.nan,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel, pruned and resumable Optuna search of the CatBoost and BERT classifiers.')
+    parser.add_argument('command', choices=['catboost', 'bert', 'report'])
+    parser.add_argument('--study', default=None, help='study name (default: the model name)')
+    parser.add_argument('--baseline', nargs='*', default=[], help='studies to compare with in the report')
+    parser.add_argument('--trials', type=int, default=60, help='number of finished trials of the study, counted across workers and runs')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--pruner', choices=list(PRUNERS), default='median')
+    parser.add_argument('--storage', default=STORAGE_PATH, help='SQLite file of the studies')
+    parser.add_argument('--target', type=float, default=None,
+                        help="macro-F1 of the time-to-target report (default: best of the model's notebook, if any)")
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        studies = [args.study or 'catboost'] + args.baseline
+        studies = [optuna.load_study(study_name=name, storage=storage(args.storage)) for name in studies]
+        target = args.target if args.target is not None else notebook_target(studies[0])
+        if target is None:
+            print(f'No notebook score for {studies[0].study_name}, pass --target for the time to reach it:')
+        else:
+            print(f'Time to reach macro-F1 {target:.4f}:')
+        print(pd.DataFrame([study_report(study, target) for study in studies]).to_string(index=False))
+        if len(studies) > 1:
+            # the notebook's score may be out of reach for both searches, compare with the best score of the baseline
+            target = studies[1].best_value
+            print(f'Time to reach macro-F1 {target:.4f} (best of {studies[1].study_name}):')
+            print(pd.DataFrame([study_report(study, target) for study in studies]).to_string(index=False))
+        return
+
+    study_name = args.study or args.command
+    start = time.perf_counter()
+    study = search(args.command, study_name, args.trials, args.workers, args.pruner, args.storage)
+    print(f'Search took {time.perf_counter() - start:.1f} s')
+    print('Best hyperparameters:', study.best_params)
+    print('Best macro f1:', study.best_value)
+    target = args.target if args.target is not None else NOTEBOOK_BEST_F1.get(args.command)
+    print(pd.DataFrame([study_report(study, target)]).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import asyncio
+import time
+
+from llm_annotation import (attach_results, build_messages, get_row_ids, group_identical_inputs, initialize_response_columns,
+                            initialize_results, input_column, parse_response, print_dedup_ratio, store_parsed_response,
+                            store_response)
+from request_controller import RequestController
+from response_parser import followup_messages, invalid_keys, is_complete, merge_followup, parse_json
+from telemetry import add_usage, new_request_stats
+
+# Rough number of characters per token for OpenAI tokenizers, used to budget the tokens per minute limit
+CHARS_PER_TOKEN = 4
+
+# Completion tokens reserved per request in the tokens per minute budget
+EXPECTED_COMPLETION_TOKENS = 300
+
+
+def estimate_request_tokens(messages):
+    '''
+    Estimate the number of tokens a request consumes for the tokens per minute limit
+    messages: chat messages of the request
+    '''
+    prompt_chars = sum(len(message["content"]) for message in messages)
+    return prompt_chars // CHARS_PER_TOKEN + EXPECTED_COMPLETION_TOKENS
+
+
+class RateLimiter:
+    '''
+    Token bucket limiter for requests per minute and tokens per minute.
+    Both buckets start full and refill continuously. A limit of None disables the bucket.
+    '''
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.available_requests = rpm
+        self.available_tokens = tpm
+        self.last_refill = time.monotonic()
+        # serialize waiting requests so that they are admitted in arrival order
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.rpm:
+            self.available_requests = min(self.rpm, self.available_requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.available_tokens = min(self.tpm, self.available_tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, tokens):
+        wait = 0.0
+        if self.rpm and self.available_requests < 1:
+            wait = max(wait, (1 - self.available_requests) * 60 / self.rpm)
+        if self.tpm and self.available_tokens < tokens:
+            wait = max(wait, (tokens - self.available_tokens) * 60 / self.tpm)
+        return wait
+
+    async def acquire(self, tokens=0):
+        '''
+        Wait until one request and the given number of tokens fit into the limits
+        tokens: estimated number of tokens of the request
+        '''
+        if self.tpm:
+            # a single request larger than the bucket would wait forever
+            tokens = min(tokens, self.tpm)
+        async with self.lock:
+            self._refill()
+            wait = self._wait_time(tokens)
+            while wait > 0:
+                await asyncio.sleep(wait)
+                self._refill()
+                wait = self._wait_time(tokens)
+            if self.rpm:
+                self.available_requests -= 1
+            if self.tpm:
+                self.available_tokens -= tokens
+
+
+async def request_completion_async(client, model, messages, controller, limiter, stats=None, temperature=None):
+    '''
+    Asynchronous counterpart of request_completion
+    controller: RequestController bounding the number of in-flight requests and retrying transient errors
+    limiter: RateLimiter applied before each request (and each retry) is sent
+    stats: optional request statistics the latency, queue wait, retries and token usage are added to
+    temperature: sampling temperature, None for the default of the API
+    '''
+    stats = stats if stats is not None else new_request_stats()
+    options = {} if temperature is None else {"temperature": temperature}
+
+    async def send_request():
+        start = time.monotonic()
+        response = await client.chat.completions.create(
+            model=model,
+            response_format={ "type": "json_object" },
+            messages=messages,
+            **options,
+        )
+        stats["latency"] += time.monotonic() - start
+        return response
+
+    # the rate limiter waits outside of the timed request, so that the controller adapts to the API latency only
+    tokens = estimate_request_tokens(messages)
+    response = await controller.call(send_request, stats, before_request=lambda: limiter.acquire(tokens))
+    stats["api_requests"] += 1
+    add_usage(stats, response)
+    return response.choices[0].message.content
+
+
+async def classify_event_async(client, model, task_name, text, controller, limiter, cache=None, telemetry=None, stats=None):
+    '''
+    Asynchronous counterpart of classify_event
+    client: AsyncOpenAI client
+    controller: RequestController bounding the number of in-flight requests and retrying transient errors
+    limiter: RateLimiter applied before each request (and each retry) is sent
+    cache: optional ResponseCache, cached responses are returned without calling the API
+    telemetry: optional Telemetry recording latency, queue wait, retries, token usage, parse failures and cache hits
+    stats: optional request statistics to fill in, e.g. to read the token usage of the call
+    '''
+    messages = build_messages(task_name, text)
+    stats = stats if stats is not None else new_request_stats()
+
+    if cache is not None:
+        cache_key = cache.key(model, messages)
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            stats["cache_hit"] = True
+            if telemetry is not None:
+                telemetry.record(task_name, model, stats)
+            return cached_response
+
+    content = await request_completion_async(client, model, messages, controller, limiter, stats)
+
+    # re-ask only the missing or invalid subtasks
+    parsed_content = parse_json(content)
+    keys = invalid_keys(task_name, parsed_content)
+    if keys:
+        print(f"Re-asking {', '.join(keys)} for task '{task_name}'.")
+        followup = await request_completion_async(client, model, followup_messages(task_name, text, keys),
+                                                  controller, limiter, stats)
+        content = merge_followup(content, followup, keys)
+
+    # a response that is still incomplete after the re-ask is not cached, so it is requested again in the next run
+    if cache is not None and is_complete(task_name, content):
+        cache.put(cache_key, model, content)
+
+    if telemetry is not None:
+        stats["parse_failed"] = parsed_content is None
+        stats["reasked_keys"] = len(keys)
+        telemetry.record(task_name, model, stats)
+
+    return (content)
+
+
+async def classify_df_async(task_names, df, client, model, max_concurrency=8, rpm=None, tpm=None, cache=None,
+                            journal=None, controller=None, telemetry=None, router=None):
+    '''
+    Classify the events in the dataframe with concurrent requests.
+    Produces the same columns as classify_df. Responses are written back in task and row order,
+    independent of the order in which they arrive. Rows with identical input texts share one request per task.
+    task_names: list of task names as specified in the tasks dictionary
+    df: dataframe with the input data
+    client: AsyncOpenAI client, preferably with max_retries=0 so that retries are left to the controller
+    max_concurrency: maximum number of in-flight requests
+    rpm: requests per minute limit, None for no limit
+    tpm: tokens per minute limit, None for no limit
+    cache: optional ResponseCache in front of the API
+    journal: optional ResultJournal, each response is appended as soon as it arrives and
+             (row, task) pairs already in the journal are skipped
+    controller: optional RequestController, defaults to one whose in-flight limit adapts between 1 and max_concurrency
+    telemetry: optional Telemetry recording every request
+    router: optional router (FeatureRouter, RuleRouter or CombinedRouter) answering some tasks locally for the
+            rows it is confident about
+    '''
+    task_names = list(task_names)
+
+    # Initialize columns for storing results
+    df = initialize_response_columns(df, task_names, model)
+
+    controller = controller or RequestController(initial_limit=max_concurrency, max_limit=max_concurrency)
+    limiter = RateLimiter(rpm, tpm)
+
+    completed = journal.completed(model) if journal is not None else set()
+    local_responses = router.local_responses(df) if router is not None else None
+
+    async def run_job(task_name, row_ids, input_text):
+        response = await classify_event_async(client, model, task_name, input_text, controller, limiter, cache, telemetry)
+        if journal is not None:
+            for row_id in row_ids:
+                journal.record(row_id, task_name, model, response)
+        return response
+
+    row_ids = get_row_ids(df)
+    documents = df['document'].tolist()
+
+    results = {task_name: initialize_results(task_name, model, len(df)) for task_name in task_names}
+
+    # Create one request per task and distinct input text
+    jobs = []
+    requests = []
+    for task_name in task_names:
+        positions_by_text = group_identical_inputs(df[input_column(task_name)].tolist())
+        print_dedup_ratio(task_name, len(df), len(positions_by_text))
+        for input_text, positions in positions_by_text.items():
+            positions = [position for position in positions if (row_ids[position], task_name) not in completed]
+
+            # Answer the rows the router is confident about without a request
+            if router is not None and task_name in router.tasks:
+                task_responses = local_responses[task_name]
+                for position in positions:
+                    if task_responses[position] is not None:
+                        if journal is not None:
+                            journal.record(row_ids[position], task_name, model, task_responses[position])
+                        store_response(results[task_name], task_responses[position], position, model, task_name)
+                positions = [position for position in positions if task_responses[position] is None]
+
+            if not positions:
+                continue
+            jobs.append((task_name, positions))
+            requests.append(run_job(task_name, [row_ids[position] for position in positions], input_text))
+
+    # gather returns the responses in the order of the requests
+    responses = await asyncio.gather(*requests)
+
+    for (task_name, positions), response in zip(jobs, responses):
+        print(f'{task_name} - {documents[positions[0]]}\n{response}' )
+        parsed_response = parse_response(response, positions[0], task_name)
+        for position in positions:
+            store_parsed_response(results[task_name], parsed_response, position, model, task_name)
+
+    for task_name in task_names:
+        df = attach_results(df, results[task_name])
+    return df
@@ -0,0 +1,220 @@
+'''
+Offline annotation with the OpenAI Batch API.
+export: write every (row, task) request of classify_df to size-capped JSONL shards in the batch input format
+submit: upload the shards and create one batch per shard
+ingest: stream the batch result files into the same output columns as classify_df
+fixture: write local result files with canned responses for the exported requests (end-to-end test without the API)
+
+Usage: $python batch_api.py export --output-dir batch/requests
+       $python batch_api.py fixture --requests batch/requests/*.jsonl --output batch/results/fixture.jsonl
+       $python batch_api.py ingest --results batch/results/*.jsonl --output ground_truth_llm.csv
+'''
+import argparse
+import json
+import os
+
+from llm_annotation import (attach_results, build_messages, get_row_ids, initialize_response_columns, initialize_results,
+                            input_column, load_input_data, store_response)
+from prompts.tasks import tasks
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+
+
+def make_custom_id(model, task_name, row_id):
+    return f'{model}|{task_name}|{row_id}'
+
+
+def parse_custom_id(custom_id):
+    '''
+    Split a custom_id into model, task name and row id
+    '''
+    model, task_name, row_id = custom_id.split('|')
+    return model, task_name, row_id
+
+
+def batch_request(model, task_name, row_id, input_text):
+    '''
+    Request line of the batch input file, with the same body as classify_event
+    '''
+    return {
+        "custom_id": make_custom_id(model, task_name, row_id),
+        "method": "POST",
+        "url": CHAT_COMPLETIONS_URL,
+        "body": {
+            "model": model,
+            "response_format": { "type": "json_object" },
+            "messages": build_messages(task_name, input_text),
+        },
+    }
+
+
+def export_batch_requests(task_names, df, model, output_dir, max_requests_per_shard=50000, max_mb_per_shard=100):
+    '''
+    Write the requests for all rows and tasks to JSONL shards in the batch input format
+    task_names: list of task names as specified in the tasks dictionary
+    df: dataframe with the input data
+    output_dir: directory of the shards
+    max_requests_per_shard: maximum number of requests in one shard
+    max_mb_per_shard: maximum size of one shard in MB
+    Returns the paths of the shards.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    max_bytes = max_mb_per_shard * 1024 * 1024
+    row_ids = get_row_ids(df)
+    paths = []
+    shard = None
+
+    for task_name in task_names:
+        for row_id, input_text in zip(row_ids, df[input_column(task_name)].tolist()):
+            line = (json.dumps(batch_request(model, task_name, row_id, input_text), ensure_ascii=False) + '\n').encode('utf-8')
+            if shard is None or shard_requests >= max_requests_per_shard or shard_bytes + len(line) > max_bytes:
+                if shard is not None:
+                    shard.close()
+                paths.append(f'{output_dir}/batch-{len(paths):04d}.jsonl')
+                shard = open(paths[-1], 'wb')
+                shard_requests, shard_bytes = 0, 0
+            shard.write(line)
+            shard_requests += 1
+            shard_bytes += len(line)
+
+    if shard is not None:
+        shard.close()
+    return paths
+
+
+def submit_batches(client, paths, completion_window="24h"):
+    '''
+    Upload the shards and create one batch per shard, returns the batch ids
+    client: OpenAI client
+    '''
+    batch_ids = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id, endpoint=CHAT_COMPLETIONS_URL,
+                                      completion_window=completion_window)
+        print(f'Submitted {path} as batch {batch.id}')
+        batch_ids.append(batch.id)
+    return batch_ids
+
+
+def download_batch_results(client, batch_ids, output_dir):
+    '''
+    Download the output files of completed batches, returns the paths of the result files
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for batch_id in batch_ids:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            print(f'Batch {batch_id} is {batch.status}, skipping.')
+            continue
+        path = f'{output_dir}/{batch_id}.jsonl'
+        client.files.content(batch.output_file_id).write_to_file(path)
+        paths.append(path)
+    return paths
+
+
+def read_batch_results(paths):
+    '''
+    Iterate over the lines of batch result files one at a time, without loading the files into memory
+    '''
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def ingest_batch_results(paths, df, task_names, model, journal=None):
+    '''
+    Parse batch result files into the same output columns as classify_df
+    paths: batch result files
+    df: dataframe with the input data the requests were exported from
+    task_names: list of task names as specified in the tasks dictionary
+    journal: optional ResultJournal the responses are appended to
+    '''
+    task_names = list(task_names)
+    df = initialize_response_columns(df, task_names, model)
+    row_ids = get_row_ids(df)
+    position_by_row_id = {str(row_id): position for position, row_id in enumerate(row_ids)}
+    results = {task_name: initialize_results(task_name, model, len(df)) for task_name in task_names}
+
+    for result in read_batch_results(paths):
+        result_model, task_name, row_id = parse_custom_id(result["custom_id"])
+        position = position_by_row_id.get(row_id)
+        if result_model != model or task_name not in results or position is None:
+            continue
+
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            print(f"Request {result['custom_id']} failed: {result.get('error') or response.get('body')}")
+            continue
+
+        content = response["body"]["choices"][0]["message"]["content"]
+        if journal is not None:
+            journal.record(row_ids[position], task_name, model, content)
+        store_response(results[task_name], content, position, model, task_name)
+
+    for task_name in task_names:
+        df = attach_results(df, results[task_name])
+    return df
+
+
+def write_fixture_results(request_paths, output_path):
+    '''
+    Write a batch result file with canned responses of the mock server for the given request shards
+    '''
+    from mock_server import canned_response, completion_body, detect_task
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as out:
+        for request in read_batch_results(request_paths):
+            body = request["body"]
+            content = canned_response(detect_task(body["messages"]))
+            result = {
+                "id": f'batch_req_{request["custom_id"]}',
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": "", "body": completion_body(body["model"], content, body["messages"])},
+                "error": None,
+            }
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Annotate the ground truth with the OpenAI Batch API.')
+    parser.add_argument('command', choices=['export', 'submit', 'download', 'ingest', 'fixture'])
+    parser.add_argument('--model', default="gpt-3.5-turbo-0125")
+    parser.add_argument('--tasks', nargs='+', default=list(tasks.keys()), help='tasks to annotate')
+    parser.add_argument('--data', default='../../data', help='folder with the ground truth CSV files')
+    parser.add_argument('--output-dir', default='batch/requests', help='directory of the request shards (export) or result files (download)')
+    parser.add_argument('--max-requests-per-shard', type=int, default=50000)
+    parser.add_argument('--max-mb-per-shard', type=float, default=100)
+    parser.add_argument('--requests', nargs='+', default=[], help='request shards (submit, fixture)')
+    parser.add_argument('--batch-ids', nargs='+', default=[], help='batch ids (download)')
+    parser.add_argument('--results', nargs='+', default=[], help='batch result files (ingest)')
+    parser.add_argument('--output', default='batch/ground_truth_llm.csv', help='output CSV (ingest) or result file (fixture)')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        df = load_input_data(args.data)
+        paths = export_batch_requests(args.tasks, df, args.model, args.output_dir,
+                                      max_requests_per_shard=args.max_requests_per_shard, max_mb_per_shard=args.max_mb_per_shard)
+        print(f'Wrote {len(paths)} shards to {args.output_dir}')
+    elif args.command == 'submit':
+        from openai import OpenAI
+        submit_batches(OpenAI(), args.requests)
+    elif args.command == 'download':
+        from openai import OpenAI
+        download_batch_results(OpenAI(), args.batch_ids, args.output_dir)
+    elif args.command == 'fixture':
+        write_fixture_results(args.requests, args.output)
+    elif args.command == 'ingest':
+        df = load_input_data(args.data)
+        df_gpt = ingest_batch_results(args.results, df, args.tasks, args.model)
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        df_gpt.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+'''
+Microbenchmark of the local overhead of classify_df per row.
+The OpenAI client is replaced by a mock that answers instantly with a canned response, so the measured
+time is spent in prompt building, response parsing and result writing only.
+
+Usage: $python benchmark_local_overhead.py --rows 1000000
+       $python benchmark_local_overhead.py --rows 100000 --telemetry telemetry.jsonl
+'''
+import argparse
+import contextlib
+import json
+import os
+import time
+
+import pandas as pd
+
+from llm_annotation import classify_df, classify_event, initialize_response_columns, select_input_text
+from mock_server import canned_response
+from telemetry import Telemetry
+
+
+class MockCompletions:
+
+    def __init__(self, content):
+        self.content = content
+
+    def create(self, model, messages, **kwargs):
+        message = type('Message', (), {'content': self.content})
+        choice = type('Choice', (), {'message': message})
+        return type('Response', (), {'choices': [choice]})
+
+
+class MockClient:
+    '''
+    Stand-in for the OpenAI client that returns the same response for every request
+    '''
+
+    def __init__(self, content):
+        self.chat = type('Chat', (), {})()
+        self.chat.completions = MockCompletions(content)
+
+
+def synthetic_df(n_rows):
+    '''
+    Dataframe with the input columns of the ground truth and n_rows distinct sentences
+    '''
+    ids = pd.Series(range(n_rows)).astype(str)
+    text = 'In 2020 we reduced our CO2 emissions by 8% at site ' + ids + '.'
+    return pd.DataFrame({
+        'document': ids + '.txt',
+        'text': text,
+        'text_kw': text + ' (keyword: "CO2 emissions")',
+        'text_kw_et': text + ' (keyword: "CO2 emissions", event trigger: "reduced")',
+    })
+
+
+def classify_df_iterrows(task_names, df, client, model):
+    '''
+    Previous implementation of classify_df with iterrows and per-cell df.at writes, as a baseline
+    '''
+    df = initialize_response_columns(df, task_names, model)
+    for task_name in task_names:
+        for index, row in df.iterrows():
+            response = classify_event(client, model, task_name, select_input_text(row, task_name))
+            print(f'{task_name} - {row["document"]}\n{response}' )
+            response = json.loads(response)
+            if task_name in ['chain_of_features', 'event_trigger_chain_of_features']:
+                cof_task_name = 'cof' if task_name == 'chain_of_features' else 'et_cof'
+                for subtask_name, subtask_response in response.items():
+                    df.at[index, f'{model}_{cof_task_name}_{subtask_name}_label'] = subtask_response['label']
+                    df.at[index, f'{model}_{cof_task_name}_{subtask_name}_reasoning'] = subtask_response['reasoning']
+            else:
+                df.at[index, f'{model}_{task_name}_label'] = response['label']
+                df.at[index, f'{model}_{task_name}_reasoning'] = response['reasoning']
+    return df
+
+
+def run(classify, task_name, n_rows, **kwargs):
+    df = synthetic_df(n_rows)
+    client = MockClient(canned_response(task_name))
+    # classify_df prints every response, which is part of the overhead but not of interest on a terminal
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        classify([task_name], df, client, 'mock-model', **kwargs)
+        elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the local overhead of classify_df per row with a mocked client.')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='number of synthetic rows')
+    parser.add_argument('--baseline-rows', type=int, default=20_000, help='number of rows for the iterrows baseline, 0 to skip')
+    parser.add_argument('--tasks', nargs='+', default=['category', 'chain_of_features'], help='tasks to benchmark')
+    parser.add_argument('--telemetry', default=None, help='also measure classify_df with the telemetry records written to this file')
+    args = parser.parse_args()
+
+    for task_name in args.tasks:
+        elapsed = run(classify_df, task_name, args.rows)
+        print(f'{task_name:<35} columnar  {args.rows:>9} rows  {elapsed:8.2f} s  {elapsed / args.rows * 1e6:7.1f} us/row')
+        if args.telemetry:
+            telemetry = Telemetry(args.telemetry)
+            elapsed = run(classify_df, task_name, args.rows, telemetry=telemetry)
+            telemetry.close()
+            print(f'{task_name:<35} telemetry {args.rows:>9} rows  {elapsed:8.2f} s  {elapsed / args.rows * 1e6:7.1f} us/row')
+        if args.baseline_rows:
+            elapsed = run(classify_df_iterrows, task_name, args.baseline_rows)
+            print(f'{task_name:<35} iterrows  {args.baseline_rows:>9} rows  {elapsed:8.2f} s  {elapsed / args.baseline_rows * 1e6:7.1f} us/row')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+'''
+Throughput benchmark of the annotation pipeline against the local mock server (mock_server.py).
+Runs the sequential classify_df and the async engine at several concurrency levels and reports
+rows/sec, p50/p99 request latency and the local CPU time per request.
+The results can be saved as JSON and compared with a previous run to catch performance regressions.
+
+Usage: $python benchmark_suite.py --rows 500 --concurrency 1 8 32 --latency lognormal:0.2,0.5 --output bench.json
+       $python benchmark_suite.py --baseline bench.json
+'''
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from openai import AsyncOpenAI, OpenAI
+
+from async_engine import classify_df_async
+from benchmark_local_overhead import synthetic_df
+from llm_annotation import classify_df
+from request_controller import RequestController
+
+
+class TimedCompletions:
+    '''
+    Wrapper around client.chat.completions that records the latency of every request
+    '''
+
+    def __init__(self, completions):
+        self.completions = completions
+        self.latencies = []
+
+    def create(self, **kwargs):
+        start = time.perf_counter()
+        response = self.completions.create(**kwargs)
+        self.latencies.append(time.perf_counter() - start)
+        return response
+
+
+class AsyncTimedCompletions(TimedCompletions):
+
+    async def create(self, **kwargs):
+        start = time.perf_counter()
+        response = await self.completions.create(**kwargs)
+        self.latencies.append(time.perf_counter() - start)
+        return response
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server_process(latency, rate_429, rate_500):
+    '''
+    Start the mock server in a separate process, so that its CPU time is not counted as pipeline overhead
+    '''
+    port = free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py'),
+                                '--port', str(port), '--latency', latency,
+                                '--rate-429', str(rate_429), '--rate-500', str(rate_500)],
+                               stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return process, f'http://127.0.0.1:{port}/v1'
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('Mock server did not start.')
+
+
+def run_benchmark(df, task_names, base_url, concurrency):
+    '''
+    Annotate the dataframe against the mock server and measure throughput, latency and local CPU time
+    concurrency: number of in-flight requests, 1 runs the sequential classify_df
+    Injected errors are retried by a RequestController with a short backoff.
+    '''
+    controller = RequestController(initial_limit=concurrency, max_limit=concurrency, base_delay=0.05)
+    if concurrency == 1:
+        client = OpenAI(base_url=base_url, api_key='mock', max_retries=0)
+        completions = client.chat.completions = TimedCompletions(client.chat.completions)
+        run = lambda: classify_df(task_names, df.copy(), client, 'mock-model', cache=None, controller=controller)
+    else:
+        client = AsyncOpenAI(base_url=base_url, api_key='mock', max_retries=0)
+        completions = client.chat.completions = AsyncTimedCompletions(client.chat.completions)
+        run = lambda: asyncio.run(classify_df_async(task_names, df.copy(), client, 'mock-model', max_concurrency=concurrency,
+                                                    controller=controller))
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        run()
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+    latencies = np.array(completions.latencies)
+    requests = len(df) * len(task_names)
+    return {
+        "concurrency": concurrency,
+        "rows": len(df),
+        "requests": requests,
+        "rows_per_sec": len(df) / wall,
+        "requests_per_sec": requests / wall,
+        "latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "latency_p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "cpu_ms_per_request": cpu / requests * 1000,
+        "retries": controller.retries,
+        "final_limit": controller.state()["limit"],
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    '''
+    Print the results that are worse than the baseline by more than the tolerance and return their number
+    '''
+    baseline = {entry["concurrency"]: entry for entry in baseline}
+    regressions = 0
+    for entry in results:
+        previous = baseline.get(entry["concurrency"])
+        if previous is None:
+            continue
+        if entry["rows_per_sec"] < previous["rows_per_sec"] * (1 - tolerance):
+            print(f'REGRESSION concurrency {entry["concurrency"]}: rows/sec {previous["rows_per_sec"]:.1f} -> {entry["rows_per_sec"]:.1f}')
+            regressions += 1
+        if entry["cpu_ms_per_request"] > previous["cpu_ms_per_request"] * (1 + tolerance):
+            print(f'REGRESSION concurrency {entry["concurrency"]}: CPU ms/request {previous["cpu_ms_per_request"]:.2f} -> {entry["cpu_ms_per_request"]:.2f}')
+            regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the annotation pipeline against the local mock server.')
+    parser.add_argument('--rows', type=int, default=200, help='number of synthetic rows')
+    parser.add_argument('--tasks', nargs='+', default=['category', 'chain_of_features'], help='tasks to run on every row')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 128], help='concurrency levels, 1 is the sequential classify_df')
+    parser.add_argument('--latency', default='lognormal:0.1,0.5', help='latency distribution of the mock server')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--rate-500', type=float, default=0.0, help='share of requests answered with 500')
+    parser.add_argument('--output', default=None, help='save the results as JSON')
+    parser.add_argument('--baseline', default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative deterioration reported as regression')
+    args = parser.parse_args()
+
+    df = synthetic_df(args.rows)
+    process, base_url = start_server_process(args.latency, args.rate_429, args.rate_500)
+    try:
+        results = [run_benchmark(df, args.tasks, base_url, concurrency) for concurrency in args.concurrency]
+    finally:
+        process.terminate()
+
+    print(pd.DataFrame(results).to_string(index=False, float_format='%.2f'))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
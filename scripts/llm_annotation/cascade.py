@@ -0,0 +1,283 @@
+'''
+Cheap-first model cascade.
+Every request is first sampled several times from the cheap model. Sampling stops as soon as enough samples
+agree on a label; requests whose label agreement stays below the threshold are escalated to the expensive model.
+The tier that answered each row is recorded, and the cost and latency are compared with an all-expensive baseline.
+
+Usage: $python cascade.py --tasks category temporal_status --sample 0 --samples 5 --threshold 0.6
+'''
+import argparse
+import asyncio
+import math
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from openai import AsyncOpenAI
+
+from async_engine import RateLimiter, classify_event_async, request_completion_async
+from dry_run import MODEL_LATENCY, MODEL_PRICES, expected_output_tokens
+from llm_annotation import (attach_results, build_messages, get_row_ids, group_identical_inputs, initialize_response_columns,
+                            initialize_results, input_column, load_input_data, parse_response, print_dedup_ratio,
+                            result_array, store_parsed_response)
+from prompts.tasks import tasks
+from request_controller import RequestController
+from response_parser import is_complete, parse_json
+from telemetry import new_request_stats
+
+# Model name used in the result columns of the cascade, e.g. cascade_category_label and cascade_category_tier
+CASCADE_MODEL = "cascade"
+
+# Ground truth columns of the tasks, used to report the accuracy per tier
+GOLD_COLUMNS = {
+    "category": "category",
+    "temporal_status": "temporal_status",
+    "measurability": "measurability",
+}
+
+
+def normalize_label(label):
+    '''
+    Comparable form of a label: lower case strings, sorted tuples for lists, '3' for 3 and 3.0
+    '''
+    if isinstance(label, list):
+        return tuple(sorted(normalize_label(value) for value in label))
+    if isinstance(label, float) and label.is_integer():
+        label = int(label)
+    return str(label).strip().lower()
+
+
+def vote_label(response):
+    '''
+    Label a parsed response votes for, None if the response has no label
+    '''
+    if not isinstance(response, dict) or response.get("label") is None:
+        return None
+    return normalize_label(response["label"])
+
+
+async def sample_response(client, model, task_name, messages, sample, controller, limiter, temperature, stats, cache=None):
+    '''
+    One sample of the cheap model. Samples are cached under their index, so a rerun replays the same votes.
+    stats: request statistics the latency and token usage are added to
+    '''
+    if cache is not None:
+        cache_key = cache.key(f'{model}#sample{sample}', messages)
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+    content = await request_completion_async(client, model, messages, controller, limiter, stats, temperature)
+    if cache is not None and is_complete(task_name, content):
+        cache.put(cache_key, model, content)
+    return content
+
+
+async def classify_event_cascade(client, task_name, text, cheap_model, expensive_model, controller, limiter,
+                                 n_samples=5, threshold=0.6, temperature=0.7, cache=None, telemetry=None):
+    '''
+    Classify a single input text with the cascade.
+    The cheap model is sampled until ceil(threshold * n_samples) samples agree on a label, or until that
+    agreement can no longer be reached. In the second case the expensive model answers instead.
+    Tasks with subtasks (chain of features) have no single label to vote on and go to the expensive model directly.
+    Returns the response and a dict with the tier, the agreement and the usage of both tiers.
+    '''
+    record = {"tier": "expensive", "agreement": None, "samples": 0}
+    cheap_stats = new_request_stats()
+    expensive_stats = new_request_stats()
+
+    if "subtasks" not in tasks[task_name] and n_samples > 0:
+        messages = build_messages(task_name, text)
+        required_votes = math.ceil(threshold * n_samples)
+        votes = Counter()
+        responses = {}
+        for sample in range(n_samples):
+            content = await sample_response(client, cheap_model, task_name, messages, sample, controller, limiter,
+                                            temperature, cheap_stats, cache)
+            label = vote_label(parse_json(content))
+            votes[label] += 1
+            responses.setdefault(label, content)
+            record["samples"] = sample + 1
+
+            top_label, top_votes = max(((label, count) for label, count in votes.items() if label is not None),
+                                       key=lambda item: item[1], default=(None, 0))
+            # stop as soon as the votes agree, or as soon as they cannot agree any more
+            if top_votes >= required_votes or top_votes + n_samples - sample - 1 < required_votes:
+                break
+
+        record["agreement"] = top_votes / record["samples"]
+        if top_votes >= required_votes:
+            record["tier"] = "cheap"
+            content = responses[top_label]
+
+    if record["tier"] == "expensive":
+        content = await classify_event_async(client, expensive_model, task_name, text, controller, limiter, cache,
+                                             telemetry, expensive_stats)
+
+    if telemetry is not None and record["samples"]:
+        telemetry.record(task_name, cheap_model, cheap_stats)
+    for tier, stats in [("cheap", cheap_stats), ("expensive", expensive_stats)]:
+        record[f'{tier}_prompt_tokens'] = stats["prompt_tokens"]
+        record[f'{tier}_completion_tokens'] = stats["completion_tokens"]
+        record[f'{tier}_latency'] = stats["latency"]
+        record[f'{tier}_requests'] = stats["api_requests"]
+    return content, record
+
+
+async def classify_df_cascade(task_names, df, client, cheap_model="gpt-3.5-turbo-0125", expensive_model="gpt-4-0125-preview",
+                              n_samples=5, threshold=0.6, temperature=0.7, max_concurrency=8, rpm=None, tpm=None,
+                              cache=None, telemetry=None, controller=None):
+    '''
+    Classify the events in the dataframe with the cheap-first cascade.
+    Produces the columns of classify_df for the model name 'cascade', plus per task the tier that answered
+    each row ('cheap' or 'expensive'), the agreement of the cheap samples and their number.
+    Returns the dataframe and a dataframe with one record per request (see classify_event_cascade).
+    n_samples: maximum number of samples of the cheap model
+    threshold: share of n_samples that must agree on a label to accept the cheap answer
+    temperature: sampling temperature of the cheap model
+    '''
+    task_names = list(task_names)
+    df = initialize_response_columns(df, task_names, CASCADE_MODEL)
+    controller = controller or RequestController(initial_limit=max_concurrency, max_limit=max_concurrency)
+    limiter = RateLimiter(rpm, tpm)
+    row_ids = get_row_ids(df)
+
+    jobs = []
+    requests = []
+    for task_name in task_names:
+        positions_by_text = group_identical_inputs(df[input_column(task_name)].tolist())
+        print_dedup_ratio(task_name, len(df), len(positions_by_text))
+        for input_text, positions in positions_by_text.items():
+            jobs.append((task_name, positions))
+            requests.append(classify_event_cascade(client, task_name, input_text, cheap_model, expensive_model, controller,
+                                                   limiter, n_samples, threshold, temperature, cache, telemetry))
+
+    responses = await asyncio.gather(*requests)
+
+    results = {task_name: initialize_results(task_name, CASCADE_MODEL, len(df)) for task_name in task_names}
+    records = []
+    for (task_name, positions), (response, record) in zip(jobs, responses):
+        parsed_response = parse_response(response, positions[0], task_name)
+        for position in positions:
+            store_parsed_response(results[task_name], parsed_response, position, CASCADE_MODEL, task_name)
+            for key in ["tier", "agreement", "samples"]:
+                result_array(results[task_name], f'{CASCADE_MODEL}_{task_name}_{key}')[position] = record[key]
+        records.append({"task": task_name, "row_id": row_ids[positions[0]], "rows": len(positions), **record})
+
+    for task_name in task_names:
+        df = attach_results(df, results[task_name])
+    return df, pd.DataFrame(records)
+
+
+def request_cost(model, prompt_tokens, completion_tokens):
+    '''
+    Cost in USD of the given tokens, NaN for models without a price
+    '''
+    if model not in MODEL_PRICES:
+        return np.nan
+    input_price, output_price = MODEL_PRICES[model]
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+
+
+def savings_report(df, records, cheap_model, expensive_model):
+    '''
+    Compare the cascade with sending every request to the expensive model, per task.
+    The baseline tokens of a request are those of one cheap sample (same prompt, similar answer length), and its
+    latency is the mean latency of the escalated requests, or the typical latency of the expensive model
+    (MODEL_LATENCY in dry_run.py) if nothing was escalated. The accuracy per tier is computed on the rows
+    whose task has a ground truth column.
+    df: dataframe returned by classify_df_cascade
+    records: request records returned by classify_df_cascade
+    '''
+    report = []
+    for task_name, task_records in records.groupby("task", sort=False):
+        sampled = task_records[task_records["cheap_requests"] > 0]
+        escalated = task_records[task_records["tier"] == "expensive"]
+
+        prompt_per_request = (sampled["cheap_prompt_tokens"] / sampled["cheap_requests"]).mean() if len(sampled) else np.nan
+        completion_per_request = (sampled["cheap_completion_tokens"] / sampled["cheap_requests"]).mean() if len(sampled) else np.nan
+        measured = escalated[escalated["expensive_requests"] > 0]
+        if len(measured):
+            expensive_latency = (measured["expensive_latency"] / measured["expensive_requests"]).mean()
+        else:
+            first_token_latency, tokens_per_second = MODEL_LATENCY.get(expensive_model, (np.nan, np.nan))
+            expensive_latency = first_token_latency + expected_output_tokens(task_name, expensive_model) / tokens_per_second
+
+        cascade_cost = (request_cost(cheap_model, task_records["cheap_prompt_tokens"].sum(), task_records["cheap_completion_tokens"].sum())
+                        + request_cost(expensive_model, task_records["expensive_prompt_tokens"].sum(), task_records["expensive_completion_tokens"].sum()))
+        baseline_cost = request_cost(expensive_model, prompt_per_request * len(task_records), completion_per_request * len(task_records))
+        cascade_latency = task_records["cheap_latency"].sum() + task_records["expensive_latency"].sum()
+        baseline_latency = expensive_latency * len(task_records)
+
+        entry = {
+            "task": task_name,
+            "rows": int(task_records["rows"].sum()),
+            "requests": len(task_records),
+            "escalation_rate": len(escalated) / len(task_records),
+            "mean_samples": task_records["samples"].mean(),
+            "cascade_cost_usd": cascade_cost,
+            "baseline_cost_usd": baseline_cost,
+            "cost_savings": 1 - cascade_cost / baseline_cost if baseline_cost else np.nan,
+            "cascade_latency_s": cascade_latency,
+            "baseline_latency_s": baseline_latency,
+            "latency_savings": 1 - cascade_latency / baseline_latency if baseline_latency else np.nan,
+        }
+
+        gold_column = GOLD_COLUMNS.get(task_name)
+        if gold_column in df.columns:
+            labels = df[f'{CASCADE_MODEL}_{task_name}_label'].map(normalize_label)
+            correct = labels == df[gold_column].map(normalize_label)
+            tiers = df[f'{CASCADE_MODEL}_{task_name}_tier']
+            entry["accuracy"] = correct.mean()
+            entry["accuracy_cheap"] = correct[tiers == "cheap"].mean()
+            entry["accuracy_expensive"] = correct[tiers == "expensive"].mean()
+        report.append(entry)
+    return pd.DataFrame(report).set_index("task")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Annotate the ground truth with a cheap-first model cascade.')
+    parser.add_argument('--cheap-model', default="gpt-3.5-turbo-0125")
+    parser.add_argument('--expensive-model', default="gpt-4-0125-preview")
+    parser.add_argument('--tasks', nargs='+', default=['category', 'temporal_status'], help='tasks to annotate')
+    parser.add_argument('--samples', type=int, default=5, help='maximum number of samples of the cheap model per request')
+    parser.add_argument('--threshold', type=float, default=0.6, help='share of the samples that must agree to accept the cheap answer')
+    parser.add_argument('--temperature', type=float, default=0.7, help='sampling temperature of the cheap model')
+    parser.add_argument('--sample', type=int, default=2, help='number of randomly sampled rows to annotate, 0 for all rows')
+    parser.add_argument('--max-concurrency', type=int, default=8)
+    parser.add_argument('--rpm', type=int, default=None)
+    parser.add_argument('--tpm', type=int, default=None)
+    parser.add_argument('--cache', default='cache/responses.sqlite', help='path of the response cache database')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the response cache')
+    parser.add_argument('--data', default='../../data', help='folder with the ground truth CSV files')
+    parser.add_argument('--output-dir', default='output/cascade', help='directory of the annotated CSV and the savings report')
+    args = parser.parse_args()
+
+    df_input = load_input_data(args.data)
+    df_select = df_input.sample(args.sample).copy() if args.sample else df_input.copy()
+
+    cache = None
+    if not args.no_cache:
+        from response_cache import ResponseCache
+        cache = ResponseCache(args.cache)
+
+    try:
+        df_cascade, records = asyncio.run(classify_df_cascade(
+            args.tasks, df_select, AsyncOpenAI(max_retries=0), args.cheap_model, args.expensive_model,
+            n_samples=args.samples, threshold=args.threshold, temperature=args.temperature,
+            max_concurrency=args.max_concurrency, rpm=args.rpm, tpm=args.tpm, cache=cache))
+    finally:
+        if cache is not None:
+            cache.close()
+
+    report = savings_report(df_cascade, records, args.cheap_model, args.expensive_model)
+    print(report.to_string())
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    df_cascade.to_csv(f'{args.output_dir}/ground_truth_llm.csv', index=False)
+    records.to_csv(f'{args.output_dir}/requests.csv', index=False)
+    report.to_csv(f'{args.output_dir}/savings_report.csv')
+
+
+if __name__ == "__main__":
+    main()
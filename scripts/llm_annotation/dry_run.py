@@ -0,0 +1,129 @@
+import re
+
+import pandas as pd
+
+from llm_annotation import input_column
+from prompts.tasks import tasks
+from prompts.template import TOKENS_PER_REPLY, compile_prompt, count_tokens, get_encoding
+
+# Prices in USD per 1M tokens (input, output)
+MODEL_PRICES = {
+    "gpt-3.5-turbo-0125": (0.50, 1.50),
+    "gpt-4-0125-preview": (10.00, 30.00),
+}
+
+# Typical latency of a request: seconds until the first token and generated tokens per second
+MODEL_LATENCY = {
+    "gpt-3.5-turbo-0125": (0.5, 80),
+    "gpt-4-0125-preview": (1.0, 25),
+}
+
+# Tasks answering the subtasks of the chain-of-features tasks
+SUBTASK_TASKS = {
+    "event_trigger": "event_trigger",
+    "temporal_status": "temporal_status",
+    "time_specifications": "relation_temp",
+    "quantified_values": "relation_quant",
+    "measurability": "measurability",
+    "category": "category",
+}
+
+# Tokens for the key and braces of a subtask in a chain-of-features output
+SUBTASK_OVERHEAD_TOKENS = 6
+
+
+def count_tokens_batch(texts, model):
+    '''
+    Count the tokens of many texts at once
+    texts: list of strings
+    '''
+    encoding = get_encoding(model)
+    if encoding is None:
+        return [len(text) // 4 for text in texts]
+    return [len(tokens) for tokens in encoding.encode_batch(texts, disallowed_special=())]
+
+
+def expected_output_tokens(task_name, model):
+    '''
+    Estimate the completion tokens of a task from the outputs in its examples
+    task_name: task name as specified in the tasks dictionary
+    '''
+    task = tasks[task_name]
+    if "subtasks" in task:
+        return sum(expected_output_tokens(SUBTASK_TASKS[subtask], model) + SUBTASK_OVERHEAD_TOKENS
+                   for subtask in task["subtasks"])
+    outputs = re.findall(r'^Output: (.*)$', task["examples"], flags=re.MULTILINE)
+    return round(sum(count_tokens(output, model) for output in outputs) / len(outputs))
+
+
+def plan_task(df, task_name, model):
+    '''
+    Count the prompt tokens of one task over the dataframe without sending any request.
+    Rows with identical input texts share one request, as in classify_df. The static prompt parts
+    are counted once per task.
+    '''
+    compiled = compile_prompt(task_name)
+    texts = df[input_column(task_name)].astype(str)
+    counts = texts.value_counts()
+    input_tokens = pd.Series(count_tokens_batch(counts.index.tolist(), model), index=counts.index)
+
+    requests = len(counts)
+    static_tokens = compiled.prefix_token_count(model) + count_tokens(compiled.suffix, model) + TOKENS_PER_REPLY
+    prompt_tokens = requests * static_tokens + int(input_tokens.sum())
+    output_tokens = requests * expected_output_tokens(task_name, model)
+    return {
+        "task": task_name,
+        "rows": len(texts),
+        "requests": requests,
+        "prefix_tokens": compiled.prefix_token_count(model),
+        "input_tokens": prompt_tokens,
+        "output_tokens": output_tokens,
+    }
+
+
+def estimate_wall_time(requests, tokens, latency, max_concurrency, rpm=None, tpm=None):
+    '''
+    Projected duration in seconds, limited by the concurrency or by the rate limits
+    requests: number of requests
+    tokens: prompt and completion tokens of all requests
+    latency: seconds per request
+    '''
+    durations = [requests * latency / max_concurrency]
+    if rpm:
+        durations.append(requests / rpm * 60)
+    if tpm:
+        durations.append(tokens / tpm * 60)
+    return max(durations)
+
+
+def plan_run(df, task_names, model="gpt-3.5-turbo-0125", max_concurrency=1, rpm=None, tpm=None):
+    '''
+    Estimate tokens, cost and duration of annotating the dataframe, without any network call
+    task_names: list of task names as specified in the tasks dictionary
+    model: model whose tokenizer is used to count the tokens
+    max_concurrency: number of in-flight requests, 1 for the sequential classify_df
+    rpm: requests per minute limit
+    tpm: tokens per minute limit
+    Returns a dataframe with one row per task and a total row.
+    '''
+    plans = []
+    for task_name in task_names:
+        if input_column(task_name) not in df.columns:
+            print(f"Skipping task '{task_name}': input column '{input_column(task_name)}' is missing.")
+            continue
+        plans.append(plan_task(df, task_name, model))
+    plan = pd.DataFrame(plans).set_index("task")
+    plan.loc["total"] = plan.sum()
+    plan.loc["total", "prefix_tokens"] = None
+    plan["dedup_ratio"] = 1 - plan["requests"] / plan["rows"]
+
+    for priced_model, (input_price, output_price) in MODEL_PRICES.items():
+        plan[f'cost_usd_{priced_model}'] = (plan["input_tokens"] * input_price + plan["output_tokens"] * output_price) / 1e6
+
+    for latency_model, (first_token_latency, tokens_per_second) in MODEL_LATENCY.items():
+        latency = first_token_latency + plan["output_tokens"] / plan["requests"] / tokens_per_second
+        plan[f'hours_{latency_model}'] = [
+            estimate_wall_time(requests, tokens, task_latency, max_concurrency, rpm, tpm) / 3600
+            for requests, tokens, task_latency in zip(plan["requests"], plan["input_tokens"] + plan["output_tokens"], latency)
+        ]
+    return plan
@@ -0,0 +1,266 @@
+'''
+Evaluation of the LLM annotations against the ground truth.
+The label columns of all models and tasks in the output files ({model}_{task}_label, including the cof_/et_cof_
+subtask columns) are aligned with their gold columns and scored at once: accuracy, macro-F1 and confusion matrices
+from integer-coded labels, and bootstrap confidence intervals from NumPy index matrices, computed in a process pool.
+
+Usage: $python evaluation.py output/gpt-4o-mini/2024-06-01/ground_truth_llm.csv output/cascade/ground_truth_llm.csv
+'''
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from llm_annotation import response_columns
+from prompts.tasks import tasks
+from spans import parse_spans
+
+# Gold column of each task and cof_/et_cof_ subtask, and how its labels are compared:
+# 'label' (classes, scored with accuracy, macro-F1 and a confusion matrix) or 'span' (annotated span texts,
+# scored with the exact-match accuracy of the normalized texts; several values of an answer are compared as a set)
+GOLD_COLUMNS = {
+    "event_trigger": ("event_trigger", "span"),
+    "category": ("category", "label"),
+    "category_input_man_features": ("category", "label"),
+    "category_input_all_features": ("category", "label"),
+    "temporal_status": ("temporal_status", "label"),
+    "measurability": ("measurability", "label"),
+    "relation_temp": ("relation_time_specification", "span"),
+    "relation_quant": ("relation_unit", "span"),
+    "time_specifications": ("relation_time_specification", "span"),
+    "quantified_values": ("relation_unit", "span"),
+}
+
+
+def evaluated_tasks():
+    '''
+    Task names as they appear in the label columns (subtasks as cof_{subtask} / et_cof_{subtask}) and their gold column
+    '''
+    evaluated = {}
+    for task_name in tasks:
+        for column in response_columns(task_name, ''):
+            if column.endswith('_label'):
+                column_task = column[1:-len('_label')]
+                gold_task = column_task
+                if column_task.startswith('et_cof_'):
+                    gold_task = column_task[len('et_cof_'):]
+                elif column_task.startswith('cof_'):
+                    gold_task = column_task[len('cof_'):]
+                if gold_task in GOLD_COLUMNS:
+                    evaluated[column_task] = GOLD_COLUMNS[gold_task]
+    return evaluated
+
+
+def find_label_columns(df):
+    '''
+    (model, task, label column, gold column, kind) of every label column of the dataframe with a gold column
+    The longest matching task name wins, e.g. gpt-4o_cof_category_label is the cof_category subtask.
+    '''
+    evaluated = evaluated_tasks()
+    by_length = sorted(evaluated, key=len, reverse=True)
+    found = []
+    for column in df.columns:
+        if not column.endswith('_label'):
+            continue
+        for task_name in by_length:
+            suffix = f'_{task_name}_label'
+            if column.endswith(suffix) and len(column) > len(suffix):
+                gold_column, kind = evaluated[task_name]
+                if gold_column in df.columns:
+                    found.append((column[:-len(suffix)], task_name, column, gold_column, kind))
+                break
+    return found
+
+
+def normalize_labels(column):
+    '''
+    Comparable labels: lower case strings without surrounding whitespace, integer numbers without '.0'
+    (measurability 3.0 and '3' are the same label), '' if missing
+    '''
+    labels = column.astype(object).where(column.notna(), '').astype(str).str.strip().str.lower()
+    numbers = pd.to_numeric(labels, errors='coerce')
+    integers = numbers.notna() & (numbers % 1 == 0)
+    labels = labels.astype(object)
+    labels[integers] = numbers[integers].astype('int64').astype(str)
+    return labels
+
+
+def normalize_texts(column, gold=False):
+    '''
+    Comparable span texts: gold spans ('58-70 [fossil fuels]') are reduced to their text, answers with several values
+    separated by ';' are sorted, whitespace (including thin and no-break spaces) is collapsed
+    '''
+    if gold:
+        texts = pd.Series(parse_spans(column)[2].to_numpy(zero_copy_only=False), index=column.index, dtype=object)
+    else:
+        texts = column.astype(object).where(column.notna(), '').astype(str)
+    texts = texts.str.replace(r'\s+', ' ', regex=True).str.strip().str.lower()
+    return texts.str.split(r'\s*;\s*', regex=True).map(lambda values: '; '.join(sorted(value for value in values if value)))
+
+
+def encode(gold, predictions):
+    '''
+    Integer codes of the gold labels and of the predicted labels of every model in one shared class vocabulary
+    (gold classes first), so that the confusion matrices of a task have the same rows and columns for all models
+    predictions: dict model -> predicted labels
+    '''
+    values = [gold.to_numpy(dtype=object)] + [predicted.to_numpy(dtype=object) for predicted in predictions.values()]
+    codes, classes = pd.factorize(np.concatenate(values))
+    codes = codes.reshape(len(values), len(gold))
+    return codes[0], dict(zip(predictions, codes[1:])), list(classes)
+
+
+def confusion_matrix(gold, predicted, n_classes):
+    '''
+    Confusion matrix of the codes, gold classes in the rows
+    '''
+    return np.bincount(gold * n_classes + predicted, minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+
+
+def macro_f1(confusion):
+    '''
+    Macro-F1 of one or a stack of confusion matrices, averaged over the classes that occur in the gold or
+    predicted labels (as sklearn's f1_score with average='macro')
+    '''
+    true_positives = np.diagonal(confusion, axis1=-2, axis2=-1)
+    denominator = confusion.sum(axis=-1) + confusion.sum(axis=-2)
+    present = denominator > 0
+    f1 = np.divide(2 * true_positives, denominator, out=np.zeros(denominator.shape), where=present)
+    return f1.sum(axis=-1) / np.maximum(present.sum(axis=-1), 1)
+
+
+def resample_counts(n_rows, n_resamples, seed, block_size=250):
+    '''
+    Bootstrap resamples in blocks: a (block_size x n_rows) index matrix of rows drawn with replacement, turned into
+    how often each row is drawn in each resample (one bincount for the whole block). Scores of a resample are
+    then weighted sums over the rows, so one matrix product scores all resamples of a block.
+    '''
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_resamples, block_size):
+        block = min(block_size, n_resamples - start)
+        samples = rng.integers(0, n_rows, size=(block, n_rows), dtype=np.int32)
+        offsets = np.arange(block, dtype=np.int64)[:, None] * n_rows
+        yield np.bincount((samples + offsets).ravel(), minlength=block * n_rows).reshape(block, n_rows).astype(np.float32)
+
+
+def evaluate_task(task_name, kind, gold, predictions, classes, n_resamples=2000, seed=42, confidence=0.95):
+    '''
+    Scores of all models of one task from the integer-coded labels (runs in a worker process)
+    The models are scored on the same bootstrap resamples, so their confidence intervals are paired.
+    Returns a list of result dicts and a dict model -> confusion matrix (None for span tasks).
+    '''
+    n_classes = len(classes)
+    missing = classes.index('') if '' in classes else -1
+    results, confusions = {}, {}
+    for model, predicted in predictions.items():
+        results[model] = {'model': model, 'task': task_name, 'rows': len(gold), 'answered': int((predicted != missing).sum()),
+                          'accuracy': float((gold == predicted).mean())}
+        confusions[model] = None
+        if kind == 'label':
+            confusions[model] = confusion_matrix(gold, predicted, n_classes)
+            results[model]['macro_f1'] = float(macro_f1(confusions[model]))
+
+    if n_resamples:
+        # per model a (rows x confusion cells) one-hot matrix of the rows, or the correct rows for span tasks
+        cells = {}
+        for model, predicted in predictions.items():
+            if kind == 'label':
+                cells[model] = np.zeros((len(gold), n_classes * n_classes), dtype=np.float32)
+                cells[model][np.arange(len(gold)), gold * n_classes + predicted] = 1
+            else:
+                cells[model] = (gold == predicted).astype(np.float32)[:, None]
+        accuracies, f1_scores = {model: [] for model in predictions}, {model: [] for model in predictions}
+        for counts in resample_counts(len(gold), n_resamples, seed):
+            for model in predictions:
+                resampled = counts @ cells[model]
+                if kind == 'label':
+                    resampled = resampled.reshape(-1, n_classes, n_classes)
+                    accuracies[model].append(np.trace(resampled, axis1=1, axis2=2) / len(gold))
+                    f1_scores[model].append(macro_f1(resampled))
+                else:
+                    accuracies[model].append(resampled[:, 0] / len(gold))
+        tail = (1 - confidence) / 2 * 100
+        for model, result in results.items():
+            result['accuracy_low'], result['accuracy_high'] = np.percentile(np.concatenate(accuracies[model]), [tail, 100 - tail])
+            if kind == 'label':
+                result['macro_f1_low'], result['macro_f1_high'] = np.percentile(np.concatenate(f1_scores[model]), [tail, 100 - tail])
+    return list(results.values()), confusions
+
+
+def evaluate(df, n_resamples=2000, workers=None, seed=42):
+    '''
+    Scores of all models and tasks of an annotated dataframe, with bootstrap confidence intervals computed
+    in a process pool (one task per job). Rows without a gold label are left out of the label tasks,
+    a missing answer counts as wrong.
+    Returns a dataframe with one row per model and task and a dict (model, task) -> confusion matrix dataframe
+    '''
+    columns = {}
+    for model, task_name, label_column, gold_column, kind in find_label_columns(df):
+        columns.setdefault((task_name, gold_column, kind), {})[model] = label_column
+
+    jobs = []
+    for (task_name, gold_column, kind), label_columns in columns.items():
+        if kind == 'span':
+            gold_labels = normalize_texts(df[gold_column], gold=True)
+            predictions = {model: normalize_texts(df[column]) for model, column in label_columns.items()}
+        else:
+            rows = df[gold_column].notna()
+            gold_labels = normalize_labels(df.loc[rows, gold_column])
+            predictions = {model: normalize_labels(df.loc[rows, column]) for model, column in label_columns.items()}
+        jobs.append((task_name, kind) + encode(gold_labels, predictions))
+
+    if workers == 1 or len(jobs) <= 1:
+        outputs = [evaluate_task(*job, n_resamples, seed) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(evaluate_task, *job, n_resamples, seed) for job in jobs]
+            outputs = [future.result() for future in futures]
+
+    results, confusions = [], {}
+    for (task_name, kind, gold, predictions, classes), (task_results, task_confusions) in zip(jobs, outputs):
+        results.extend(task_results)
+        for model, confusion in task_confusions.items():
+            if confusion is not None:
+                confusions[(model, task_name)] = pd.DataFrame(confusion, index=pd.Index(classes, name='gold'),
+                                                              columns=pd.Index(classes, name='predicted'))
+    report = pd.DataFrame(results)
+    if not report.empty:
+        report = report.sort_values(['task', 'model']).reset_index(drop=True)
+    return report, confusions
+
+
+def load_outputs(paths):
+    '''
+    Output files of several runs merged on row_id: the columns of the first file plus the label columns
+    of the other files that are not in it yet
+    '''
+    df = pd.read_csv(paths[0])
+    for path in paths[1:]:
+        other = pd.read_csv(path)
+        columns = [column for column in other.columns if column.endswith('_label') and column not in df.columns]
+        df = df.merge(other[['row_id'] + columns], on='row_id', how='left')
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate the LLM annotations of all models and tasks against the ground truth.')
+    parser.add_argument('paths', nargs='+', help='ground_truth_llm.csv output files, merged on row_id')
+    parser.add_argument('--bootstrap', type=int, default=2000, help='number of bootstrap resamples, 0 for no confidence intervals')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--output-dir', default='output/evaluation', help='directory of the scores and confusion matrices')
+    args = parser.parse_args()
+
+    report, confusions = evaluate(load_outputs(args.paths), args.bootstrap, args.workers)
+    print(report.to_string(index=False))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report.to_csv(f'{args.output_dir}/scores.csv', index=False)
+    with open(f'{args.output_dir}/confusion_matrices.txt', 'w') as f:
+        for (model, task_name), confusion in confusions.items():
+            f.write(f'{model} - {task_name}\n{confusion.to_string()}\n\n')
+
+
+if __name__ == "__main__":
+    main()
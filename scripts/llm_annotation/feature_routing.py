@@ -0,0 +1,64 @@
+'''
+Routing stage in front of the category tasks of classify_df: rows whose category the CatBoost feature classifier
+(scripts/catboost_predictor.py) predicts with a probability of at least the threshold are answered locally,
+only the uncertain rows are sent to the LLM.
+'''
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from catboost_predictor import MODEL_PATH, CategoryPredictor, features_from_ground_truth
+
+# Tasks predicting the event category
+ROUTED_TASKS = ["category", "category_input_man_features", "category_input_all_features"]
+
+
+class FeatureRouter:
+    '''
+    Answers the category tasks locally for the rows the CatBoost predictor is confident about
+    predictor: CategoryPredictor
+    threshold: minimum class probability for a local answer
+    '''
+
+    def __init__(self, predictor, threshold=0.9, tasks=ROUTED_TASKS):
+        self.predictor = predictor
+        self.threshold = threshold
+        self.tasks = tasks
+
+    @classmethod
+    def load(cls, threshold=0.9, path=MODEL_PATH):
+        return cls(CategoryPredictor.load_or_train(path), threshold)
+
+    def local_responses(self, df):
+        '''
+        Response per task and row in the JSON format of the category tasks, None for the rows left to the LLM
+        df: dataframe with the ground truth feature columns
+        '''
+        X, complete = features_from_ground_truth(df)
+        labels, confidences = self.predictor.predict_with_confidence(X)
+        local = complete & (confidences >= self.threshold)
+        print(f'CatBoost answers {local.sum()} of {len(local)} rows locally (threshold {self.threshold}).')
+        responses = [json.dumps({"label": label, "reasoning": f"Predicted by the CatBoost feature classifier with probability {confidence:.2f}."})
+                     if is_local else None
+                     for label, confidence, is_local in zip(labels, confidences, local)]
+        return {task_name: responses for task_name in self.tasks}
+
+
+class CombinedRouter:
+    '''
+    Several routers in front of classify_df, e.g. the FeatureRouter for the category tasks and the
+    RuleRouter (relation_rules.py) for the relation tasks. A task is handled by the first router listing it.
+    '''
+
+    def __init__(self, routers):
+        self.routers = routers
+        self.tasks = [task_name for router in routers for task_name in router.tasks]
+
+    def local_responses(self, df):
+        responses = {}
+        for router in self.routers:
+            for task_name, task_responses in router.local_responses(df).items():
+                responses.setdefault(task_name, task_responses)
+        return responses
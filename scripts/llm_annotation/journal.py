@@ -0,0 +1,99 @@
+import json
+import os
+from datetime import datetime
+
+
+class ResultJournal:
+    '''
+    Append-only JSONL journal of the raw model responses of a run.
+    Every (row, task) response is written and flushed as soon as it arrives, so that an interrupted
+    run can be resumed without repeating completed requests.
+    path: path of the JSONL journal file
+    fsync: force each record to disk, survives machine crashes at the cost of slower writes
+    '''
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # a resumed run appends after the last complete record, not onto a line cut off by a crash
+        truncate_partial_line(path)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def record(self, row_id, task_name, model, response):
+        '''
+        Append the raw response for a row and task to the journal
+        '''
+        record = {
+            "row_id": row_id,
+            "task": task_name,
+            "model": model,
+            "response": response,
+            "time": datetime.now().isoformat(),
+        }
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def completed(self, model=None):
+        '''
+        Return the set of (row_id, task) pairs that already have a response in the journal
+        model: only consider responses of this model
+        '''
+        return {(record["row_id"], record["task"]) for record in read_journal(self.path)
+                if model is None or record["model"] == model}
+
+    def responses(self, model):
+        '''
+        Return the raw responses of a model in the journal by (row_id, task)
+        '''
+        return {(record["row_id"], record["task"]): record["response"] for record in read_journal(self.path)
+                if record["model"] == model}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def truncate_partial_line(path, block_size=65536):
+    '''
+    Truncate a journal file after its last newline, removing a partial last line (e.g. from a crash during a write)
+    '''
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            print(f"Removing incomplete journal record at the end of '{path}'.")
+            f.truncate(position)
+
+
+def read_journal(path):
+    '''
+    Iterate over the records of a journal file.
+    A truncated last line (e.g. from a crash during a write) is skipped.
+    '''
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping incomplete journal record in '{path}'.")
+
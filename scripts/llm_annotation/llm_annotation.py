@@ -1,42 +1,113 @@
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv, find_dotenv
 import json
 import pandas as pd
+import numpy as np
 import os
+import argparse
+import asyncio
+import sys
+import time
 from datetime import datetime
 
 # Load environment variables from .env file (such as OPENAI_API_KEY)
 _ = load_dotenv(find_dotenv())
 
-from prompts.template import build_system_prompt, build_user_prompt, build_assistant_prompt, build_main_prompt
+from prompts.template import compile_prompt
 from prompts.tasks import tasks
+from response_cache import ResponseCache
+from journal import ResultJournal, read_journal
+from request_controller import RequestController
+from response_parser import followup_messages, invalid_keys, is_complete, merge_followup, parse_json
+from telemetry import Telemetry, add_usage, new_request_stats
 
-def classify_event(client, model, task_name, text):
-
-    system_prompt = build_system_prompt(task_name)
-    user_prompt = build_user_prompt()
-    assistant_prompt = build_assistant_prompt()
-    main_prompt = build_main_prompt(task_name, text)
+# shared modules of the scripts folder (spans.py, catboost_predictor.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from spans import add_input_columns
 
+def build_messages(task_name, text):
+    '''
+    Build the chat messages sent to the model for a single input text.
+    The prompts of each task are compiled once, only the input text differs between rows.
+    task_name: task name as specified in the tasks dictionary
+    text: input text for the task
+    '''
     # print(f'{task_name} - {text}')
-    # print(f'\n{system_prompt}')
-    # print(f'\n{user_prompt}')
-    # print(f'\n{assistant_prompt}')
-    # print(f'\n{main_prompt}')
+    # print(f'\n{compile_prompt(task_name).main_prompt(text)}')
+
+    return compile_prompt(task_name).messages(text)
+
+
+def request_completion(client, model, messages, controller=None, stats=None, temperature=None):
+    '''
+    Send one chat completion request and return the content of the answer
+    controller: optional RequestController retrying transient errors with backoff
+    stats: optional request statistics (see telemetry.py) the latency, retries and token usage are added to
+    temperature: sampling temperature, None for the default of the API
+    '''
+    stats = stats if stats is not None else new_request_stats()
+    options = {} if temperature is None else {"temperature": temperature}
+
+    def send_request():
+        start = time.monotonic()
+        response = client.chat.completions.create(
+            model=model,
+            response_format={ "type": "json_object" },
+            messages=messages,
+            **options,
+        )
+        stats["latency"] += time.monotonic() - start
+        return response
+
+    response = controller.call_sync(send_request, stats) if controller is not None else send_request()
+    stats["api_requests"] += 1
+    add_usage(stats, response)
+    return response.choices[0].message.content
+
+
+def classify_event(client, model, task_name, text, cache=None, controller=None, telemetry=None):
+    '''
+    Classify a single input text with the specified task.
+    Keys of the response that are missing or invalid are asked for once more in a short follow-up request,
+    and the merged response is returned.
+    cache: optional ResponseCache, cached responses are returned without calling the API
+    controller: optional RequestController retrying transient errors with backoff
+    telemetry: optional Telemetry recording latency, retries, token usage, parse failures and cache hits
+    '''
+    messages = build_messages(task_name, text)
+    stats = new_request_stats()
+
+    if cache is not None:
+        cache_key = cache.key(model, messages)
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            if telemetry is not None:
+                stats["cache_hit"] = True
+                telemetry.record(task_name, model, stats)
+            return cached_response
 
     # create a response
-    response = client.chat.completions.create(
-        model=model,
-        response_format={ "type": "json_object" },
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-            {"role": "assistant", "content": assistant_prompt},
-            {"role": "user", "content": main_prompt}
-        ],
-    )
-    return (response.choices[0].message.content)
+    content = request_completion(client, model, messages, controller, stats)
+
+    # re-ask only the missing or invalid subtasks
+    parsed_content = parse_json(content)
+    keys = invalid_keys(task_name, parsed_content)
+    if keys:
+        print(f"Re-asking {', '.join(keys)} for task '{task_name}'.")
+        followup = request_completion(client, model, followup_messages(task_name, text, keys), controller, stats)
+        content = merge_followup(content, followup, keys)
+
+    # a response that is still incomplete after the re-ask is not cached, so it is requested again in the next run
+    if cache is not None and is_complete(task_name, content):
+        cache.put(cache_key, model, content)
+
+    if telemetry is not None:
+        stats["parse_failed"] = parsed_content is None
+        stats["reasked_keys"] = len(keys)
+        telemetry.record(task_name, model, stats)
+
+    return (content)
 
 
 # -------------------------------
@@ -63,52 +134,104 @@ def select_input_text(row, task_name):
     row: dataframe row
     task_name: task name as specified in the tasks dictionary
     '''
+    return row[input_column(task_name)]
+
+
+def input_column(task_name):
+    '''
+    Name of the dataframe column with the input text for the specified task
+    task_name: task name as specified in the tasks dictionary
+    '''
     if task_name == 'event_trigger' or task_name == 'event_trigger_chain_of_features':
-        return row['text_kw']
+        return 'text_kw'
     elif task_name == 'category_input_man_features':
-        return row['text_kw_et_man']
+        return 'text_kw_et_man'
     elif task_name == 'category_input_all_features':
-        return row['text_kw_et_all']
+        return 'text_kw_et_all'
+    else:
+        return 'text_kw_et'
+
+
+def response_columns(task_name, model):
+    '''
+    Names of the label and reasoning columns of a task
+    '''
+    if task_name in ['chain_of_features', 'event_trigger_chain_of_features']:
+
+        cof_task_name = 'cof' if task_name == 'chain_of_features' else 'et_cof'
+
+        # Subtasks are defined in a global `tasks` dictionary
+        subtasks = tasks[task_name]["subtasks"]
+
+        columns = []
+        for subtask_name in subtasks:
+            columns.append(f'{model}_{cof_task_name}_{subtask_name}_label')
+            columns.append(f'{model}_{cof_task_name}_{subtask_name}_reasoning')
+        return columns
     else:
-        return row['text_kw_et']
-    
+        return [f'{model}_{task_name}_label', f'{model}_{task_name}_reasoning']
+
 
 def initialize_response_columns(df, task_names, model):
     """
     Initialize columns for storing classification results.
     """
     for task_name in task_names:
+        for column in response_columns(task_name, model):
+            df[column] = None
 
-        if task_name in ['chain_of_features', 'event_trigger_chain_of_features']:
+    return df
 
-            cof_task_name = 'cof' if task_name == 'chain_of_features' else 'et_cof'
 
-            # Subtasks are defined in a global `tasks` dictionary
-            subtasks = tasks[task_name]["subtasks"]
+def initialize_results(task_name, model, n_rows):
+    '''
+    Initialize one array per result column of a task, indexed by the position of the row in the dataframe.
+    Results are accumulated in these arrays and attached to the dataframe in one bulk operation.
+    n_rows: number of rows in the dataframe
+    '''
+    return {column: np.full(n_rows, None, dtype=object) for column in response_columns(task_name, model)}
 
-            for subtask_name in subtasks:
-                df[f'{model}_{cof_task_name}_{subtask_name}_label'] = None
-                df[f'{model}_{cof_task_name}_{subtask_name}_reasoning'] = None
-        else:
-            df[f'{model}_{task_name}_label'] = None
-            df[f'{model}_{task_name}_reasoning'] = None
 
+def attach_results(df, results):
+    '''
+    Write the accumulated result arrays to the dataframe, one column at a time
+    '''
+    for column, values in results.items():
+        df[column] = pd.Series(values, index=df.index, dtype=object)
     return df
 
 
-def handle_standard_response(df, response, index, model, task_name):
+def result_array(results, column):
+    '''
+    Return the result array of a column, adding it if the model returned an unexpected subtask
+    '''
+    if column not in results:
+        results[column] = np.full(len(next(iter(results.values()))), None, dtype=object)
+    return results[column]
+
+
+def get_row_ids(df):
+    '''
+    Stable identifiers of the rows: the 'row_id' column if present, otherwise the row positions
+    '''
+    if 'row_id' in df.columns:
+        return df['row_id'].tolist()
+    return list(range(len(df)))
+
+
+def handle_standard_response(results, response, position, model, task_name):
     '''
     Handle response for standard tasks without nested dictionaries.
     '''
     # Check if 'label' and 'reasoning' are in the response
     if 'label' in response and 'reasoning' in response:
-        df.at[index, f'{model}_{task_name}_label'] = response['label']
-        df.at[index, f'{model}_{task_name}_reasoning'] = response['reasoning']
+        results[f'{model}_{task_name}_label'][position] = response['label']
+        results[f'{model}_{task_name}_reasoning'][position] = response['reasoning']
     else:
-        print(f"Missing 'label' or 'reasoning' in response for row {index} and task '{task_name}'.")
+        print(f"Missing 'label' or 'reasoning' in response for row {position} and task '{task_name}'.")
 
 
-def handle_chain_of_features_response(df, response, index, model, task_name):
+def handle_chain_of_features_response(results, response, position, model, task_name):
     '''
     Handle response for "chain_of_features" task with nested dictionaries.
     '''
@@ -116,49 +239,152 @@ def handle_chain_of_features_response(df, response, index, model, task_name):
     for subtask_name, subtask_response in response.items():
         # Skip handling if the subtask response is not as expected
         if not isinstance(subtask_response, dict) or 'label' not in subtask_response or 'reasoning' not in subtask_response:
-            print(f"Unexpected format in subtask response for '{subtask_name}' in row {index}.")
+            print(f"Unexpected format in subtask response for '{subtask_name}' in row {position}.")
             continue
         # Save the classification results
-        df.at[index, f'{model}_{cof_task_name}_{subtask_name}_label'] = subtask_response.get('label', None)
-        df.at[index, f'{model}_{cof_task_name}_{subtask_name}_reasoning'] = subtask_response.get('reasoning', None)
+        result_array(results, f'{model}_{cof_task_name}_{subtask_name}_label')[position] = subtask_response.get('label', None)
+        result_array(results, f'{model}_{cof_task_name}_{subtask_name}_reasoning')[position] = subtask_response.get('reasoning', None)
+
+def parse_response(response, position, task_name):
+    '''
+    Safely parse a raw model response, repairing code fences, surrounding prose and truncated objects.
+    None if no JSON object can be recovered.
+    '''
+    parsed_response = parse_json(response)
+    if parsed_response is None:
+        print(f"Error decoding JSON response for row {position} and task '{task_name}'.")
+    return parsed_response
+
+
+def store_response(results, response, position, model, task_name):
+    '''
+    Parse a raw model response and write its labels and reasonings to the result arrays
+    results: result arrays of the task as returned by initialize_results
+    response: raw JSON string returned by the model
+    position: position of the row the response belongs to
+    '''
+    store_parsed_response(results, parse_response(response, position, task_name), position, model, task_name)
+
+
+def store_parsed_response(results, response, position, model, task_name):
+    '''
+    Write the labels and reasonings of a parsed response to the result arrays
+    response: parsed response, None if the response could not be parsed
+    '''
+    if response is None:
+        return
+
+    # Handle response for "chain_of_features" task with nested dictionaries
+    if task_name in ['chain_of_features', 'event_trigger_chain_of_features']:
+        handle_chain_of_features_response(results, response, position, model, task_name)
+    else:
+        # Standard tasks with direct response handling
+        handle_standard_response(results, response, position, model, task_name)
 
-def classify_df(task_names, df, client, model):
+
+def group_identical_inputs(input_texts):
+    '''
+    Group the rows with identical input texts
+    input_texts: input text of each row
+    Returns a dictionary from each distinct input text to the positions of its rows, in order of first occurrence.
     '''
-    Classify the events in the dataframe using the specified tasks
+    positions_by_text = {}
+    for position, input_text in enumerate(input_texts):
+        positions_by_text.setdefault(input_text, []).append(position)
+    return positions_by_text
+
+
+def print_dedup_ratio(task_name, n_rows, n_unique):
+    dedup_ratio = 1 - n_unique / n_rows if n_rows else 0.0
+    print(f"{task_name}: {n_unique} requests for {n_rows} rows, dedup ratio {dedup_ratio:.1%}")
+
+
+def classify_df(task_names, df, client, model, cache=None, journal=None, controller=None, telemetry=None, router=None):
+    '''
+    Classify the events in the dataframe using the specified tasks.
+    Rows with identical input texts share one request per task, the parsed response is written to all of them.
     task_names: list of task names as specified in the tasks dictionary
     df: dataframe with the input data
+    cache: optional ResponseCache in front of the API
+    journal: optional ResultJournal, each response is appended as soon as it arrives and
+             (row, task) pairs already in the journal are skipped
+    controller: optional RequestController retrying transient errors with backoff
+    telemetry: optional Telemetry recording every request
+    router: optional router (FeatureRouter, RuleRouter or CombinedRouter) answering some tasks locally for the
+            rows it is confident about
     '''
     # Initialize columns for storing results
     df = initialize_response_columns(df, task_names, model)
 
+    completed = journal.completed(model) if journal is not None else set()
+    local_responses = router.local_responses(df) if router is not None else None
+    row_ids = get_row_ids(df)
+    documents = df['document'].tolist()
+
     # Classify the events in the dataframe
     for task_name in task_names:
 
-        # Iterate over the rows in the dataframe
-        for index, row in df.iterrows():
+        results = initialize_results(task_name, model, len(df))
+        positions_by_text = group_identical_inputs(df[input_column(task_name)].tolist())
+        print_dedup_ratio(task_name, len(df), len(positions_by_text))
 
-            # Select the input text for the task
-            input_text = select_input_text(row, task_name)
+        # Iterate over the distinct input texts
+        for input_text, positions in positions_by_text.items():
 
-            # Get the model response
-            response = classify_event(client, model, task_name, input_text)
+            positions = [position for position in positions if (row_ids[position], task_name) not in completed]
 
-            print(f'{task_name} - {row["document"]}\n{response}' )
+            # Answer the rows the router is confident about without a request
+            if router is not None and task_name in router.tasks:
+                task_responses = local_responses[task_name]
+                for position in positions:
+                    if task_responses[position] is not None:
+                        if journal is not None:
+                            journal.record(row_ids[position], task_name, model, task_responses[position])
+                        store_response(results, task_responses[position], position, model, task_name)
+                positions = [position for position in positions if task_responses[position] is None]
 
-            # Safely parse the response
-            try:
-                response = json.loads(response)
-            except json.JSONDecodeError:
-                print(f"Error decoding JSON response for row {index} and task '{task_name}'.")
+            if not positions:
                 continue
 
-            # Handle response for "chain_of_features" task with nested dictionaries
-            if task_name in ['chain_of_features', 'event_trigger_chain_of_features']:
-                handle_chain_of_features_response(df, response, index, model, task_name)
-            else:
-                # Standard tasks with direct response handling
-                handle_standard_response(df, response, index, model, task_name)
+            # Get the model response
+            response = classify_event(client, model, task_name, input_text, cache, controller, telemetry)
+
+            print(f'{task_name} - {documents[positions[0]]}\n{response}' )
+
+            parsed_response = parse_response(response, positions[0], task_name)
+            for position in positions:
+                if journal is not None:
+                    journal.record(row_ids[position], task_name, model, response)
+                store_parsed_response(results, parsed_response, position, model, task_name)
+
+        df = attach_results(df, results)
+
+    return df
+
+
+def rebuild_from_journal(df, path, task_names, model):
+    '''
+    Rebuild the wide result dataframe from the responses in a journal
+    df: dataframe with the input data, identified by its 'row_id' column
+    path: path of the JSONL journal file
+    task_names: list of task names as specified in the tasks dictionary
+    '''
+    task_names = list(task_names)
+    df = initialize_response_columns(df, task_names, model)
+    position_by_row_id = {row_id: position for position, row_id in enumerate(get_row_ids(df))}
+    results = {task_name: initialize_results(task_name, model, len(df)) for task_name in task_names}
+
+    for record in read_journal(path):
+        if record["model"] != model or record["task"] not in task_names:
+            continue
+        position = position_by_row_id.get(record["row_id"])
+        if position is None:
+            continue
+        # later records of the same (row, task) overwrite earlier ones
+        store_response(results[record["task"]], record["response"], position, model, record["task"])
 
+    for task_name in task_names:
+        df = attach_results(df, results[task_name])
     return df
 
 
@@ -170,35 +396,223 @@ def load_input_data(data_folder_path):
     df_train = pd.read_csv(f'{data_folder_path}/ground_truth_train.csv')
     df_test = pd.read_csv(f'{data_folder_path}/ground_truth_test.csv')
     # combine the train and test data
-    df = pd.concat([df_train, df_test])
-    return df
+    df = pd.concat([df_train, df_test], ignore_index=True)
+    # stable identifier of each row, used to resume runs from the journal
+    df['row_id'] = df.index
+    # input columns missing in the files (e.g. text_kw_et_man) are built from the span offsets
+    return add_input_columns(df)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Annotate SDG-related events with OpenAI chat models.')
+    parser.add_argument('--model', default="gpt-3.5-turbo-0125", help='model name, e.g. "gpt-4-0125-preview"')
+    parser.add_argument('--sample', type=int, default=2, help='number of randomly sampled rows to annotate, 0 for all rows')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='send requests concurrently with AsyncOpenAI')
+    parser.add_argument('--max-concurrency', type=int, default=8, help='maximum number of in-flight requests in async mode')
+    parser.add_argument('--pipeline', action='store_true', help='annotate row by row in async mode, feeding predicted event triggers and features into dependent tasks')
+    parser.add_argument('--rpm', type=int, default=None, help='requests per minute limit in async mode')
+    parser.add_argument('--tpm', type=int, default=None, help='tokens per minute limit in async mode')
+    parser.add_argument('--max-retries', type=int, default=6, help='retries of a request on rate limits, timeouts and server errors')
+    parser.add_argument('--latency-target', type=float, default=None, help='request latency in seconds above which the number of in-flight requests is reduced')
+    parser.add_argument('--route-threshold', type=float, default=None, help='answer the category tasks with the CatBoost feature classifier for rows predicted with at least this probability')
+    parser.add_argument('--rules', action='store_true', help='answer relation_temp and relation_quant with the regex rules for rows with exactly one expression next to the event, the LLM for the other rows')
+    parser.add_argument('--rules-min-precision', type=float, default=0.8, help='only use the rules of a relation task if they reach this precision on the ground truth')
+    parser.add_argument('--cache', default='cache/responses.sqlite', help='path of the response cache database')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the response cache')
+    parser.add_argument('--cache-read-only', action='store_true', help='only replay cached responses, fail on cache misses')
+    parser.add_argument('--cache-max-size-mb', type=float, default=None, help='evict least recently used responses beyond this size')
+    parser.add_argument('--cache-max-age-days', type=float, default=None, help='evict responses older than this number of days')
+    parser.add_argument('--output-dir', default=None, help='directory of the run, defaults to output/{model}/{date}')
+    parser.add_argument('--resume', action='store_true', help='resume the run in --output-dir, skipping responses already in its journal')
+    parser.add_argument('--dry-run', action='store_true', help='only estimate tokens, cost and duration of the run, without calling the API')
+    parser.add_argument('--stream-input', nargs='+', default=None, help='annotate these CSV or Parquet files chunk by chunk instead of the ground truth')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='number of rows read at once in streaming mode')
+    parser.add_argument('--max-memory-mb', type=float, default=None, help='memory ceiling of an annotated chunk in streaming mode, lowers the rows read at once')
+    parser.add_argument('--output-format', choices=['csv', 'parquet'], default='csv', help='format of the output chunks in streaming mode')
+    parser.add_argument('--result-store', default=None, help='also append the results in long format to this Parquet result store directory')
+    return parser.parse_args()
+
+
+def open_cache(args):
+    if args.no_cache:
+        return None
+    return ResponseCache(args.cache, max_size_mb=args.cache_max_size_mb,
+                         max_age_days=args.cache_max_age_days, read_only=args.cache_read_only)
+
+
+def open_result_store(args):
+    '''
+    Result store of --result-store and the name of the run, shared by all appends of the run
+    '''
+    if not args.result_store:
+        return None, None
+    from result_store import ResultStore, new_run_name
+    return ResultStore(args.result_store), new_run_name()
+
+
+def make_controller(args):
+    '''
+    Request controller of the run, the OpenAI clients are created with max_retries=0 to leave the retries to it
+    '''
+    max_concurrency = args.max_concurrency if args.use_async or args.pipeline else 1
+    return RequestController(initial_limit=max_concurrency, max_limit=max_concurrency, max_retries=args.max_retries,
+                             latency_target=args.latency_target, report_interval=60)
+
+
+def classify_stream_input(args, task_names, model, output_dir):
+    '''
+    Annotate the --stream-input files chunk by chunk and write one output part file per chunk.
+    With --resume, chunks whose part file exists are skipped (use the same --chunk-size and --max-memory-mb).
+    '''
+    from streaming import classify_stream
+
+    cache = open_cache(args)
+    controller = make_controller(args)
+    os.makedirs(output_dir, exist_ok=True)
+    telemetry = Telemetry(f'{output_dir}/telemetry.jsonl')
+
+    def classify_chunk(chunk):
+        chunk = add_input_columns(chunk)
+        if args.use_async:
+            from async_engine import classify_df_async
+            chunk = asyncio.run(classify_df_async(task_names, chunk, AsyncOpenAI(max_retries=0), model, max_concurrency=args.max_concurrency,
+                                                  rpm=args.rpm, tpm=args.tpm, cache=cache, controller=controller, telemetry=telemetry))
+        else:
+            chunk = classify_df(task_names, chunk, client, model, cache, controller=controller, telemetry=telemetry)
+        if store is not None:
+            store.append(chunk, task_names, model, run)
+        return chunk
+
+    client = OpenAI(max_retries=0)
+    store, run = open_result_store(args)
+    n_result_columns = sum(len(response_columns(task_name, model)) for task_name in task_names)
+    try:
+        classify_stream(args.stream_input, f'{output_dir}/parts', classify_chunk, n_result_columns,
+                        chunk_size=args.chunk_size, max_memory_mb=args.max_memory_mb,
+                        output_format=args.output_format, resume=args.resume)
+    finally:
+        print(f'Request controller: {controller.state()}')
+        telemetry.close()
+        telemetry.write_summary(f'{output_dir}/run_summary.json', f'{output_dir}/metrics.prom')
+        if cache is not None:
+            print(f'Response cache: {cache.stats()}')
+            cache.close()
 
 
 def main():
 
-    # Load the input data
-    df_input = load_input_data('../../data')
+    args = parse_args()
 
-    # df_select = df_input.copy()
-    df_select = df_input.sample(2).copy() # for testing
+    model = args.model
+
+    current_date = datetime.now().strftime("%y%m%d")
+    output_dir = args.output_dir or f'output/{model}/{current_date}'
+    selection_path = f'{output_dir}/selected_rows.json'
 
     # Select the annotation tasks
     selected_tasks = tasks.keys()
 
-    # initialize the openai client
-    client = OpenAI()
+    if args.stream_input:
+        classify_stream_input(args, selected_tasks, model, output_dir)
+        return
 
-    model = "gpt-3.5-turbo-0125"
-    # model = "gpt-4-0125-preview"
+    # Load the input data
+    df_input = load_input_data('../../data')
+
+    if args.dry_run:
+        from dry_run import plan_run
+        df_plan = df_input.sample(args.sample) if args.sample else df_input
+        max_concurrency = args.max_concurrency if args.use_async else 1
+        plan = plan_run(df_plan, selected_tasks, model, max_concurrency=max_concurrency, rpm=args.rpm, tpm=args.tpm)
+        print(plan.to_string())
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    if args.resume:
+        # annotate the same rows as the interrupted run
+        with open(selection_path) as f:
+            df_select = df_input[df_input['row_id'].isin(json.load(f))].copy()
+    elif args.sample:
+        df_select = df_input.sample(args.sample).copy() # for testing
+    else:
+        df_select = df_input.copy()
+
+    if not args.resume:
+        with open(selection_path, 'w') as f:
+            json.dump(df_select['row_id'].tolist(), f)
+
+    # append every response to the journal of the run
+    journal_path = f'{output_dir}/journal.jsonl'
+    if not args.resume and os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal = ResultJournal(journal_path)
+
+    # open the response cache
+    cache = open_cache(args)
+    controller = make_controller(args)
+
+    # answer the confidently predicted category rows with the CatBoost feature classifier and
+    # the time specifications and quantified values tied to the event with the rules, for the relation tasks
+    # whose rules are precise enough on the ground truth
+    routers = []
+    if args.route_threshold is not None:
+        from feature_routing import FeatureRouter
+        routers.append(FeatureRouter.load(args.route_threshold))
+    if args.rules:
+        from relation_rules import RuleRouter, precise_tasks
+        rule_tasks = precise_tasks(df_input, min_precision=args.rules_min_precision)
+        if rule_tasks:
+            routers.append(RuleRouter(rule_tasks))
+    router = None
+    if len(routers) == 1:
+        router = routers[0]
+    elif routers:
+        from feature_routing import CombinedRouter
+        router = CombinedRouter(routers)
+
+    # record every request, the summary of the run is written at the end
+    telemetry = Telemetry(f'{output_dir}/telemetry.jsonl')
 
     # classify the events
-    df_gpt = classify_df(selected_tasks, df_select, client, model)
+    try:
+        if args.pipeline:
+            from task_graph import classify_df_pipelined
+            if router is not None:
+                print('The CatBoost and rule routing is not applied in pipeline mode.')
+            asyncio.run(classify_df_pipelined(selected_tasks, df_select.copy(), AsyncOpenAI(max_retries=0), model,
+                                              max_concurrency=args.max_concurrency, rpm=args.rpm, tpm=args.tpm,
+                                              cache=cache, journal=journal, controller=controller, telemetry=telemetry))
+        elif args.use_async:
+            from async_engine import classify_df_async
+            asyncio.run(classify_df_async(selected_tasks, df_select.copy(), AsyncOpenAI(max_retries=0), model,
+                                          max_concurrency=args.max_concurrency, rpm=args.rpm, tpm=args.tpm,
+                                          cache=cache, journal=journal, controller=controller, telemetry=telemetry,
+                                          router=router))
+        else:
+            # initialize the openai client
+            client = OpenAI(max_retries=0)
+            classify_df(selected_tasks, df_select.copy(), client, model, cache, journal, controller, telemetry, router)
+    finally:
+        print(f'Request controller: {controller.state()}')
+        telemetry.close()
+        telemetry.write_summary(f'{output_dir}/run_summary.json', f'{output_dir}/metrics.prom')
+        journal.close()
+        if cache is not None:
+            print(f'Response cache: {cache.stats()}')
+            cache.close()
+
+    # build the output from all responses of the run, including those of interrupted attempts
+    df_gpt = rebuild_from_journal(df_select, journal_path, selected_tasks, model)
 
     # save the output
-    current_date = datetime.now().strftime("%y%m%d")
-    output_path = f'output/{model}/{current_date}/ground_truth_llm.csv'
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    output_path = f'{output_dir}/ground_truth_llm.csv'
     df_gpt.to_csv(output_path, index=False)
 
+    store, run = open_result_store(args)
+    if store is not None:
+        n_results = store.append(df_gpt, selected_tasks, model, run)
+        print(f'Appended {n_results} results to the result store {args.result_store}')
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
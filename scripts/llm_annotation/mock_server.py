@@ -0,0 +1,170 @@
+'''
+Local stand-in for the OpenAI chat completions API, for benchmarks and regression tests without a live API.
+Responds to POST /v1/chat/completions with canned JSON in the output format of the task that is detected
+from the prompt, after a configurable latency, and injects 429 and 500 errors at configurable rates.
+
+Usage: $python mock_server.py --port 8000 --latency lognormal:0.8,0.5 --rate-429 0.02 --rate-500 0.01
+Client: OpenAI(base_url='http://127.0.0.1:8000/v1', api_key='mock')
+'''
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prompts.tasks import tasks
+from prompts.template import compile_prompt
+
+# Labels of the canned responses, valid values for each task and chain-of-features subtask
+CANNED_LABELS = {
+    "event_trigger": ["reduced"],
+    "category": "action",
+    "temporal_status": "past",
+    "measurability": "3",
+    "relation_temp": "In 2020",
+    "relation_quant": "8%",
+    "time_specifications": "In 2020",
+    "quantified_values": "8%",
+    "category_input_man_features": "action",
+    "category_input_all_features": "action",
+}
+
+
+def canned_response(task_name):
+    '''
+    Valid JSON response in the output format of the task, nested by subtask for the chain-of-features tasks
+    '''
+    if "subtasks" in tasks[task_name]:
+        return json.dumps({subtask: {"label": CANNED_LABELS[subtask], "reasoning": f"Canned reasoning for {subtask}."}
+                           for subtask in tasks[task_name]["subtasks"]})
+    return json.dumps({"label": CANNED_LABELS[task_name], "reasoning": f"Canned reasoning for {task_name}."})
+
+
+def detect_task(messages):
+    '''
+    Return the task whose compiled main prompt prefix the last message starts with, None if no task matches
+    '''
+    main_prompt = messages[-1]["content"]
+    matches = [task_name for task_name in tasks if main_prompt.startswith(compile_prompt(task_name).prefix)]
+    # the longest prefix is the most specific match
+    return max(matches, key=lambda task_name: len(compile_prompt(task_name).prefix), default=None)
+
+
+def make_latency_sampler(spec):
+    '''
+    Parse a latency distribution in seconds:
+    'constant:0.5', 'uniform:0.2,1.0' or 'lognormal:median,sigma', e.g. 'lognormal:0.8,0.5'
+    '''
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',')] if params else []
+    if kind == 'constant':
+        return lambda: values[0]
+    elif kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    elif kind == 'lognormal':
+        median, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median
+    raise ValueError(f"Unknown latency distribution '{spec}'.")
+
+
+def completion_body(model, content, messages):
+    prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-mock-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "logprobs": None,
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def make_handler(latency_sampler, rate_429, rate_500, retry_after):
+
+    class MockHandler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+        # the headers and the body are separate writes, with Nagle's algorithm the body waits for the delayed ACK
+        # of the headers (about 40 ms per request on a keep-alive connection)
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if self.path.rstrip('/') not in ('/v1/chat/completions', '/chat/completions'):
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                return
+
+            time.sleep(latency_sampler())
+
+            draw = random.random()
+            if draw < rate_429:
+                self.send_json(429, {"error": {"message": "Rate limit reached (mock).", "type": "rate_limit_error"}},
+                               headers={'Retry-After': str(retry_after)})
+                return
+            if draw < rate_429 + rate_500:
+                self.send_json(500, {"error": {"message": "Internal server error (mock).", "type": "server_error"}})
+                return
+
+            task_name = detect_task(request["messages"])
+            content = canned_response(task_name) if task_name else json.dumps({"label": "", "reasoning": "Unknown task."})
+            self.send_json(200, completion_body(request.get("model", "mock"), content, request["messages"]))
+
+    return MockHandler
+
+
+def start_mock_server(host='127.0.0.1', port=0, latency='constant:0', rate_429=0.0, rate_500=0.0, retry_after=1):
+    '''
+    Start the mock server in a background thread and return it; server.server_address holds the bound port
+    port: 0 to bind to a free port
+    '''
+    handler = make_handler(make_latency_sampler(latency), rate_429, rate_500, retry_after)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local OpenAI-compatible chat completions server with canned responses.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', default='lognormal:0.8,0.5', help="'constant:s', 'uniform:min,max' or 'lognormal:median,sigma'")
+    parser.add_argument('--rate-429', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--rate-500', type=float, default=0.0, help='share of requests answered with 500')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After header of 429 responses in seconds')
+    args = parser.parse_args()
+
+    handler = make_handler(make_latency_sampler(args.latency), args.rate_429, args.rate_500, args.retry_after)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    print(f'Mock server listening on http://{args.host}:{server.server_address[1]}/v1', flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
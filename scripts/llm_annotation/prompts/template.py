@@ -1,3 +1,6 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
 from prompts.tasks import tasks
 
 SYSTEM_PROMPT_FEATURES = "You are an intelligent text classification expert system. Your task is to classify features of events in texts. I will provide you with the definition of the classification task, the definitions of the different classes, the input text for which you need to classify the event, along with a keyword and event trigger representing the event, and the output format. I will also provide you with examples, including the reasoning behind choosing a certain class. Please return the output strictly in JSON format, not prose."
@@ -95,16 +98,116 @@ def build_instructions(task_name):
         return instructions_features
 
 def build_main_prompt(task_name, text):
+    return compile_prompt(task_name).main_prompt(text)
+
+
+# Tokens added by the chat format per message and for priming the reply (OpenAI chat models)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+def count_tokens(text, model="gpt-3.5-turbo-0125"):
+    '''
+    Count the tokens of a text with the tokenizer of the model.
+    Falls back to an estimate of 4 characters per token if the tokenizer is not available.
+    '''
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # the encoding files are downloaded on first use and may not be available offline
+        print(f"Could not load the tokenizer for '{model}', estimating tokens from characters: {e}")
+        return None
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    '''
+    Prompts of a task, rendered once. Everything except the input text is part of the static prefix,
+    so the messages of all rows of a task start with the same bytes and provider-side prompt caching can hit.
+    prefix: main prompt up to the input text
+    suffix: main prompt after the input text
+    '''
+    task_name: str
+    system_prompt: str
+    user_prompt: str
+    assistant_prompt: str
+    instructions: str
+    prefix: str
+    suffix: str
+
+    def main_prompt(self, text):
+        return f'{self.prefix}{text}{self.suffix}'
+
+    def messages(self, text):
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": self.user_prompt},
+            {"role": "assistant", "content": self.assistant_prompt},
+            {"role": "user", "content": self.main_prompt(text)}
+        ]
+
+    def prefix_token_count(self, model="gpt-3.5-turbo-0125"):
+        '''
+        Number of prompt tokens before the input text, i.e. the cacheable part of each request
+        '''
+        return self._prefix_token_count(model)
+
+    @lru_cache(maxsize=None)
+    def _prefix_token_count(self, model):
+        static_messages = [self.system_prompt, self.user_prompt, self.assistant_prompt]
+        return (sum(count_tokens(content, model) for content in static_messages)
+                + 4 * TOKENS_PER_MESSAGE
+                + count_tokens(self.prefix, model))
+
+
+@lru_cache(maxsize=None)
+def compile_prompt(task_name):
+    '''
+    Render the static parts of a task's prompts once
+    task_name: task name as specified in the tasks dictionary
+    '''
     task = tasks[task_name]
 
+    prefix_template, suffix = MAIN_PROMPT_TEMPLATE.split("{input}")
     instructions = build_instructions(task_name)
 
-    main_prompt = MAIN_PROMPT_TEMPLATE.format(
+    prefix = prefix_template.format(
         task_description=task["task_description"],
         label_definition=task["label_definition"],
-        output_format=task["output_format"], 
-        examples=task["examples"], 
+        output_format=task["output_format"],
+        examples=task["examples"],
+        instructions=instructions,
+    )
+    return CompiledPrompt(
+        task_name=task_name,
+        system_prompt=build_system_prompt(task_name),
+        user_prompt=build_user_prompt(),
+        assistant_prompt=build_assistant_prompt(),
         instructions=instructions,
-        input=text
+        prefix=prefix,
+        suffix=suffix,
     )
-    return main_prompt
\ No newline at end of file
+
+
+def prefix_token_counts(task_names=None, model="gpt-3.5-turbo-0125"):
+    '''
+    Return the number of cacheable prefix tokens for each task
+    task_names: list of task names, defaults to all tasks
+    '''
+    task_names = tasks.keys() if task_names is None else task_names
+    return {task_name: compile_prompt(task_name).prefix_token_count(model) for task_name in task_names}
@@ -0,0 +1,415 @@
+'''
+Rule-based extraction of time specifications (relation_temp) and quantified values (relation_quant).
+The patterns are compiled once and applied to a whole text column at once with pandas' vectorized string
+methods. Each expression is also normalized: years, months and durations of time specifications
+('by the end of 2021' -> 'by:2021-12'), numbers and units of quantified values ('$500 million' -> '500000000 USD').
+
+The relations belong to one event, so in the hybrid mode (RuleRouter) the rules only answer rows with exactly one
+expression tied to the event: in the same clause as the event trigger or keyword and at most a few tokens away
+from it. Rows without such an expression or with several go to the LLM.
+
+Usage: $python relation_rules.py
+'''
+import argparse
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+from llm_annotation import load_input_data, response_columns
+from spans import parse_spans, span_text
+
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+          'november', 'december']
+MONTH_PATTERN = '|'.join(month.capitalize() for month in MONTHS)
+YEAR_PATTERN = r'(?:19|20)\d{2}'
+NUMBER_WORDS = {'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9,
+                'ten': 10, 'twelve': 12, 'fifteen': 15, 'twenty': 20, 'thirty': 30, 'several': None, 'few': None}
+
+# Time specifications: dates with an optional relation ('since', 'by the end of', ...), durations and temporal adverbs
+TIME_PATTERN = re.compile(
+    r'(?:\b(?:[Ss]ince|[Bb]y|[Uu]ntil|[Tt]ill|[Ii]n|[Aa]t|[Ff]rom|[Bb]efore|[Aa]fter|[Tt]hrough|[Dd]uring|[Aa]s of|[Ss]tarting)\s+)?'
+    r'(?:(?:the\s+)?(?:end|beginning|start|middle) of\s+|(?:early|mid|late)[\s-]+)?'
+    rf'(?:\b(?:(?:{MONTH_PATTERN})\s+)?{YEAR_PATTERN}(?:\s*[-–/]\s*(?:{YEAR_PATTERN}|\d{{2}})\b)?\b'
+    rf'|\b(?:{MONTH_PATTERN})\b(?!\s+{YEAR_PATTERN})'
+    r'|\b(?:the\s+)?(?:end|beginning|start) of (?:the|this|next|last) (?:year|decade|month|quarter)\b'
+    rf'|\b(?:FY|[Ff]iscal [Yy]ear)\s?(?:{YEAR_PATTERN}|\d{{2}})\b)'
+    rf'|\b(?:[Oo]ver|[Ww]ithin|[Ff]or|[Ii]n)\s+(?:the\s+)?(?:(?:next|past|last|coming)\s+)?(?:\d+|{"|".join(NUMBER_WORDS)})\s+(?:years?|months?|decades?|weeks?)\b'
+    r'|\b(?:[Ii]n|[Oo]ver) the (?:coming|next|past|last) (?:years|months|decades|weeks)\b'
+    r'|\b(?:[Rr]ecently|[Cc]urrently|[Tt]oday|[Aa]nnually|[Tt]his year|[Ll]ast year|[Nn]ext year)\b'
+)
+
+# Units of quantified values and their normalized names
+UNITS = {
+    '%': '%', 'percent': '%', 'per cent': '%', 'percentage points': 'pp',
+    'kilotons': 'kt', 'kilotonnes': 'kt', 'kt': 'kt', 'megatons': 'Mt', 'megatonnes': 'Mt', 'mt': 'Mt',
+    'tons': 't', 'tonnes': 't', 'tonnes of co2e': 't CO2e', 't co2e': 't CO2e', 'tco2e': 't CO2e', 't': 't', 'kg': 'kg',
+    'gwh': 'GWh', 'mwh': 'MWh', 'kwh': 'kWh', 'twh': 'TWh', 'gj': 'GJ', 'tj': 'TJ', 'mw': 'MW', 'gw': 'GW',
+    'm3': 'm3', 'm³': 'm3', 'cubic meters': 'm3', 'litres': 'l', 'liters': 'l', 'km': 'km', 'hectares': 'ha', 'ha': 'ha',
+    '°c': '°C', 'degrees': '°C',
+    'employees': 'employees', 'people': 'people', 'countries': 'countries', 'hours': 'h', 'suppliers': 'suppliers',
+}
+SCALES = {'thousand': 1e3, 'million': 1e6, 'mn': 1e6, 'billion': 1e9, 'bn': 1e9, 'trillion': 1e12}
+CURRENCIES = {'$': 'USD', 'us$': 'USD', 'usd': 'USD', '€': 'EUR', 'eur': 'EUR', '£': 'GBP', 'gbp': 'GBP', 'chf': 'CHF'}
+
+NUMBER = r'\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?'
+UNIT_PATTERN = '|'.join(re.escape(unit) for unit in sorted(UNITS, key=len, reverse=True))
+SCALE_PATTERN = '|'.join(SCALES)
+CURRENCY_PATTERN = r'US\$|\$|€|£|USD|EUR|GBP|CHF'
+
+# Quantified values: numbers or ranges with a currency, a scale or a unit (bare numbers like years or page numbers are skipped)
+QUANT_PATTERN = re.compile(
+    r'(?:\b(?:more than|less than|over|up to|around|approximately|about|nearly|almost|at least)\s+)?'
+    rf'(?:(?:{CURRENCY_PATTERN})\s?)?'
+    rf'(?<![\w.])(?:{NUMBER})(?:\s?[-–]\s?(?:{NUMBER}))?'
+    rf'(?:\s?(?:{SCALE_PATTERN})\b)?'
+    rf'(?:\s?(?:{UNIT_PATTERN})(?:/(?:year|yr|a|day|month))?(?![\w])|\s(?:{CURRENCY_PATTERN})\b)?',
+    flags=re.IGNORECASE,
+)
+
+# Currency, number or range and scale at the start of a quantified value, the rest is the unit
+VALUE_PATTERN = re.compile(
+    rf'(?:(?P<currency>{CURRENCY_PATTERN})\s?)?(?<![A-Za-z])(?P<first>{NUMBER})(?:\s?[-–]\s?(?P<second>{NUMBER}))?'
+    rf'(?:\s?(?P<scale>{SCALE_PATTERN})\b)?',
+    flags=re.IGNORECASE,
+)
+
+# Currency, scale, unit or comparison word that makes a number a quantified value
+QUANTITY_MARKER = re.compile(
+    rf'%|{CURRENCY_PATTERN}|\b(?:{SCALE_PATTERN}|{UNIT_PATTERN})\b|°|\b(?:more|less|over|up|around|approximately|about|nearly|almost|at least)\b',
+    flags=re.IGNORECASE,
+)
+
+# Words between an expression and the event trigger or keyword that end the clause of the event
+CLAUSE_BOUNDARY = re.compile(r'[.;:!?()]|\b(?:while|whereas|but|which|although)\b', flags=re.IGNORECASE)
+
+# Maximum number of tokens between an expression and the event trigger or keyword for the hybrid mode
+MAX_EVENT_DISTANCE = 3
+
+# Minimum precision on the ground truth of the rows a task's rules would answer for the hybrid mode to use them
+MIN_PRECISION = 0.8
+
+# Tasks answered by the rules, with their extraction and normalization functions
+RELATION_TASKS = {
+    "relation_temp": "time",
+    "relation_quant": "quant",
+}
+
+# Ground truth columns of the relation tasks
+GOLD_COLUMNS = {"relation_temp": "relation_time_specification", "relation_quant": "relation_unit"}
+
+
+def clean_text(texts):
+    '''
+    Replace the thin and non-breaking spaces of the reports with regular spaces
+    texts: Series of strings
+    '''
+    return texts.fillna('').astype(str).str.replace('[\u2009\u202f\u00a0]', ' ', regex=True)
+
+
+def find_expressions(texts, task_name):
+    '''
+    Expressions of a relation task in every text, found in one regex pass per text
+    texts: Series of strings
+    Returns a dataframe with one row per expression: the position of its text, the stripped expression
+    and its start and end offsets
+    '''
+    pattern = TIME_PATTERN if RELATION_TASKS[task_name] == 'time' else QUANT_PATTERN
+    found = [(position, match.group(0), match.start()) for position, text in enumerate(clean_text(texts))
+             for match in pattern.finditer(text)]
+    expressions = pd.DataFrame(found, columns=['position', 'expression', 'start']).astype({'position': 'int64', 'start': 'int64', 'expression': object})
+    stripped = expressions['expression'].str.lstrip()
+    expressions['start'] += expressions['expression'].str.len() - stripped.str.len()
+    expressions['expression'] = stripped.str.rstrip()
+    expressions['end'] = expressions['start'] + expressions['expression'].str.len()
+    keep = expressions['expression'] != ''
+    if RELATION_TASKS[task_name] == 'quant':
+        keep &= expressions['expression'].str.contains(QUANTITY_MARKER)
+    return expressions[keep].reset_index(drop=True)
+
+
+def per_row(expressions, column, n_rows):
+    '''
+    Values of a column of the expressions as one list per text, [] for texts without an expression
+    '''
+    lists = expressions.groupby('position')[column].agg(list)
+    return [lists.get(position, []) for position in range(n_rows)]
+
+
+def extract_time_specifications(texts):
+    '''
+    Time specifications of every text, as lists of matched strings
+    texts: Series of strings
+    '''
+    return pd.Series(per_row(find_expressions(texts, 'relation_temp'), 'expression', len(texts)), index=texts.index)
+
+
+def extract_quantified_values(texts):
+    '''
+    Quantified values of every text, as lists of matched strings
+    texts: Series of strings
+    '''
+    return pd.Series(per_row(find_expressions(texts, 'relation_quant'), 'expression', len(texts)), index=texts.index)
+
+
+def parse_number(number):
+    number = number.replace(',', '')
+    value = float(number)
+    return int(value) if value.is_integer() else value
+
+
+def normalize_time_specification(expression):
+    '''
+    Normalized form of a time specification: relation and ISO-like date or duration, e.g.
+    'In 2019' -> 'in:2019', 'by the end of 2021' -> 'by:2021-12', 'early 2021' -> '2021-H1',
+    'In September' -> 'in:--09', 'over five years' -> 'over:P5Y', 'in the coming months' -> 'in:next:PnM',
+    'recently' -> 'recently'
+    '''
+    text = expression.lower()
+    relation = re.match(r'(since|by|until|till|in|at|from|before|after|through|during|as of|starting|over|within|for)\b', text)
+    prefix = f'{relation.group(1)}:' if relation else ''
+
+    duration = re.search(rf'(\d+|{"|".join(NUMBER_WORDS)})\s+(year|month|decade|week)', text)
+    if duration:
+        count = NUMBER_WORDS.get(duration.group(1), duration.group(1))
+        unit = {'year': 'Y', 'month': 'M', 'decade': '10Y', 'week': 'W'}[duration.group(2)]
+        if unit == '10Y' and count is not None:
+            count, unit = int(count) * 10, 'Y'
+        return f'{prefix}P{count if count is not None else "n"}{unit}'
+
+    relative = re.search(r'\b(coming|next|past|last) (year|month|decade|week)s\b', text)
+    if relative:
+        direction = 'next' if relative.group(1) in ['coming', 'next'] else 'past'
+        return f'{prefix}{direction}:Pn{relative.group(2)[0].upper()}'
+
+    years = re.findall(r'(?<!\d)((?:19|20)\d{2})(?!\d)', text)
+    if not years:
+        month = re.search(rf'\b({"|".join(MONTHS)})\b', text)
+        if month:
+            return f'{prefix}--{MONTHS.index(month.group(1)) + 1:02d}'
+        return prefix + (text[relation.end():].strip() if relation else text)
+
+    range_end = re.search(r'[-–/]\s*(\d{2})$', text)
+    if len(years) > 1 or range_end:
+        end = years[1] if len(years) > 1 else years[0][:2] + range_end.group(1)
+        return f'{prefix}{years[0]}/{end}'
+
+    year = years[0]
+    month = re.search(rf'\b({"|".join(MONTHS)})\b', text)
+    if month:
+        return f'{prefix}{year}-{MONTHS.index(month.group(1)) + 1:02d}'
+    if re.search(r'\bend of\b|\blate\b', text):
+        return f'{prefix}{year}-12' if 'end of' in text else f'{prefix}{year}-H2'
+    if re.search(r'\b(?:beginning|start) of\b', text):
+        return f'{prefix}{year}-01'
+    if re.search(r'\bearly\b', text):
+        return f'{prefix}{year}-H1'
+    if re.search(r'\b(?:middle of|mid)\b', text):
+        return f'{prefix}{year}-06'
+    if text.startswith(('fy', 'fiscal')):
+        return f'{prefix}FY{year}'
+    return f'{prefix}{year}'
+
+
+def normalize_quantified_value(expression):
+    '''
+    Normalized form of a quantified value: comparison, number(s) with the scale applied and unit, e.g.
+    '70,128 m3/year' -> '70128 m3/year', '$500 million' -> '500000000 USD', '12–19 kilotons' -> '12-19 kt',
+    '12 tCO2e' -> '12 t CO2e', 'more than 38,000' -> '>38000'
+    '''
+    text = expression.strip()
+    comparison = ''
+    match = re.match(r'(more than|over|at least|less than|up to|around|approximately|about|nearly|almost)\s+', text, flags=re.IGNORECASE)
+    if match:
+        comparison = {'more than': '>', 'over': '>', 'at least': '>=', 'less than': '<', 'up to': '<=',
+                      'nearly': '<', 'almost': '<'}.get(match.group(1).lower(), '~')
+        text = text[match.end():]
+
+    # the numbers are only read from the number span at the start, digits of the unit (m3, tCO2e) belong to the unit
+    match = VALUE_PATTERN.match(text)
+    if not match:
+        return f'{comparison}{text}'
+    factor = SCALES[match.group('scale').lower()] if match.group('scale') else 1
+    numbers = [parse_number(number) * factor for number in match.group('first', 'second') if number is not None]
+    numbers = [int(number) if float(number).is_integer() else round(number, 6) for number in numbers]
+
+    currency = match.group('currency')
+    rest = text[match.end():].strip()
+    if not currency and re.fullmatch(CURRENCY_PATTERN, rest, flags=re.IGNORECASE):
+        currency, rest = rest, ''
+    per = re.search(r'/(\w+)$', rest)
+    if per:
+        rest = rest[:per.start()].strip()
+    unit = UNITS.get(rest.lower(), rest) if rest else ''
+    if currency:
+        unit = CURRENCIES[currency.lower()] + (f' {unit}' if unit else '')
+    if per:
+        unit += f'/{per.group(1)}'
+
+    value = '-'.join(str(number) for number in numbers)
+    return f'{comparison}{value} {unit}'.strip()
+
+
+def tied_to_event(df, expressions, text_column='text', max_distance=MAX_EVENT_DISTANCE,
+                  anchor_columns=('event_trigger', 'keyword')):
+    '''
+    Whether each extracted expression is tied to the event of its row: in the same clause as the event trigger or
+    the keyword (no CLAUSE_BOUNDARY between them) and at most max_distance tokens away from one of them.
+    Overlapping an anchor counts as distance 0, rows without the anchor are not tied to it.
+    expressions: expressions with their positions and offsets, see find_expressions
+    Returns a boolean array with one value per expression
+    '''
+    positions = expressions['position'].to_numpy()
+    starts = expressions['start'].to_numpy()
+    ends = expressions['end'].to_numpy()
+    texts = clean_text(df[text_column]).to_numpy(dtype=object)[positions]
+    tied = np.zeros(len(expressions), dtype=bool)
+    for column in anchor_columns:
+        if column not in df.columns:
+            continue
+        anchor_starts, anchor_ends = (offsets[positions] for offsets in parse_spans(df[column])[:2])
+        present = anchor_starts >= 0
+        overlaps = present & (starts < anchor_ends) & (anchor_starts < ends)
+        # the text between the expression and the anchor, before or after it
+        gap_starts = np.where(ends <= anchor_starts, ends, anchor_ends)
+        gap_ends = np.where(ends <= anchor_starts, anchor_starts, starts)
+        gaps = pd.Series([text[start:end] for text, start, end in zip(texts, gap_starts, gap_ends)], dtype=object)
+        same_clause = ~gaps.str.contains(CLAUSE_BOUNDARY).to_numpy(dtype=bool)
+        close = gaps.str.count(r'\S+').to_numpy() <= max_distance
+        tied |= overlaps | (present & same_clause & close)
+    return tied
+
+
+def extract_relations(df, task_name, text_column='text', max_distance=MAX_EVENT_DISTANCE):
+    '''
+    Extract the expressions of a relation task from a whole text column
+    Returns a dataframe with the list of matched expressions, their normalized forms and whether they are tied
+    to the event of the row (see tied_to_event) per row.
+    '''
+    expressions = find_expressions(df[text_column], task_name)
+    normalize = normalize_time_specification if RELATION_TASKS[task_name] == 'time' else normalize_quantified_value
+    # each distinct expression is normalized once
+    distinct = expressions['expression'].unique()
+    expressions['normalized'] = expressions['expression'].map(dict(zip(distinct, map(normalize, distinct))))
+    expressions['tied'] = tied_to_event(df, expressions, text_column, max_distance)
+    return pd.DataFrame({
+        'matches': per_row(expressions, 'expression', len(df)),
+        'normalized': per_row(expressions, 'normalized', len(df)),
+        'tied': per_row(expressions, 'tied', len(df)),
+    }, index=df.index)
+
+
+def classify_df_rules(task_names, df, model='rules', text_column='text'):
+    '''
+    Annotate relation_temp and relation_quant with the rules, in the label and reasoning columns of classify_df
+    plus a column with the normalized expressions. Rows without a match get an empty label.
+    '''
+    for task_name in task_names:
+        relations = extract_relations(df, task_name, text_column)
+        label_column, reasoning_column = response_columns(task_name, model)
+        df[label_column] = relations['matches'].map('; '.join).astype(object)
+        df[reasoning_column] = relations['matches'].map(lambda matches: f'Extracted by rules: {len(matches)} match(es).').astype(object)
+        df[f'{model}_{task_name}_normalized'] = relations['normalized'].map('; '.join).astype(object)
+    return df
+
+
+class RuleRouter:
+    '''
+    Hybrid mode for classify_df: answers relation_temp and relation_quant with the rules for the rows with exactly
+    one expression tied to the event (see tied_to_event), the LLM handles the other rows.
+    Same interface as FeatureRouter.
+    max_distance: maximum number of tokens between the expression and the event trigger or keyword
+    '''
+
+    def __init__(self, tasks=tuple(RELATION_TASKS), text_column='text', max_distance=MAX_EVENT_DISTANCE):
+        self.tasks = list(tasks)
+        self.text_column = text_column
+        self.max_distance = max_distance
+
+    def local_responses(self, df):
+        '''
+        Response per task and row in the JSON format of the relation tasks, None for the rows left to the LLM
+        '''
+        responses = {}
+        for task_name in self.tasks:
+            relations = extract_relations(df, task_name, self.text_column, self.max_distance)
+            responses[task_name] = []
+            for matches, normalized, tied in zip(relations['matches'], relations['normalized'], relations['tied']):
+                tied_matches = [(match, value) for match, value, is_tied in zip(matches, normalized, tied) if is_tied]
+                if len(tied_matches) == 1:
+                    match, value = tied_matches[0]
+                    responses[task_name].append(json.dumps({"label": match, "reasoning": f"Extracted by rules (normalized: {value})."}))
+                else:
+                    responses[task_name].append(None)
+            answered = sum(response is not None for response in responses[task_name])
+            print(f'Rules answer {answered} of {len(df)} rows of {task_name}.')
+        return responses
+
+
+def evaluate_rules(df, task_name, gold_column, text_column='text', max_distance=MAX_EVENT_DISTANCE):
+    '''
+    Precision and recall of the rule extractions against the annotated spans of the ground truth
+    An extraction is correct if it overlaps the gold span text. Precision is reported for all extractions
+    and for the rows the hybrid mode answers with the rules (exactly one expression tied to the event).
+    '''
+    relations = extract_relations(df, task_name, text_column, max_distance)
+    gold = df[gold_column].map(lambda span: span_text(span) if pd.notna(span) else '').str.lower()
+
+    def correct(match, gold_text):
+        match = match.lower()
+        return bool(gold_text) and (match in gold_text or gold_text in match)
+
+    extracted = [(match, gold_text) for matches, gold_text in zip(relations['matches'], gold) for match in matches]
+    tied_matches = [[match for match, is_tied in zip(matches, tied) if is_tied] for matches, tied in zip(relations['matches'], relations['tied'])]
+    single = [(matches[0], gold_text) for matches, gold_text in zip(tied_matches, gold) if len(matches) == 1]
+    found = [any(correct(match, gold_text) for match in matches) for matches, gold_text in zip(relations['matches'], gold) if gold_text]
+    return {
+        'task': task_name,
+        'rows': len(df),
+        'gold_rows': int((gold != '').sum()),
+        'rows_with_matches': int((relations['matches'].map(len) > 0).sum()),
+        'extractions': len(extracted),
+        'precision': sum(correct(*pair) for pair in extracted) / len(extracted) if extracted else float('nan'),
+        'rule_answered_rows': len(single),
+        'precision_rule_answered': sum(correct(*pair) for pair in single) / len(single) if single else float('nan'),
+        'recall': sum(found) / len(found) if found else float('nan'),
+    }
+
+
+def precise_tasks(df, task_names=tuple(RELATION_TASKS), min_precision=MIN_PRECISION, max_distance=MAX_EVENT_DISTANCE,
+                  text_column='text'):
+    '''
+    Relation tasks whose rules reach min_precision on the rows the hybrid mode would answer with them
+    df: dataframe with the ground truth relation columns
+    '''
+    selected = []
+    for task_name in task_names:
+        scores = evaluate_rules(df, task_name, GOLD_COLUMNS[task_name], text_column, max_distance)
+        passed = scores['precision_rule_answered'] >= min_precision
+        print(f"Rules of {task_name}: precision {scores['precision_rule_answered']:.2f} on {scores['rule_answered_rows']} rows, "
+              f"{'used' if passed else 'left to the LLM'} (minimum {min_precision:.2f}).")
+        if passed:
+            selected.append(task_name)
+    return selected
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the rule-based relation extraction against the ground truth.')
+    parser.add_argument('--data', default='../../data', help='folder with the ground truth CSV files')
+    parser.add_argument('--examples', type=int, default=0, help='print this many extractions per task')
+    parser.add_argument('--max-distance', type=int, default=MAX_EVENT_DISTANCE, help='maximum number of tokens between an expression and the event trigger or keyword')
+    args = parser.parse_args()
+
+    df = load_input_data(args.data)
+    print(pd.DataFrame([evaluate_rules(df, task_name, gold_column, max_distance=args.max_distance)
+                        for task_name, gold_column in GOLD_COLUMNS.items()]).set_index('task').to_string())
+
+    for task_name in GOLD_COLUMNS:
+        relations = extract_relations(df.drop_duplicates('text'), task_name, max_distance=args.max_distance)
+        for matches, normalized in relations.loc[relations['matches'].map(len) > 0, ['matches', 'normalized']].head(args.examples).values:
+            print(f'{task_name}: {matches} -> {normalized}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import asyncio
+import random
+import time
+
+import openai
+
+# HTTP status codes worth retrying
+TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(RuntimeError):
+    '''
+    Raised when requests are refused because the circuit breaker opened max_trips times in a row.
+    '''
+
+
+def is_transient(error):
+    '''
+    Whether a request error is worth retrying: timeouts, connection errors, rate limits and server errors
+    '''
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in TRANSIENT_STATUS_CODES
+
+
+def is_rate_limit(error):
+    return isinstance(error, openai.APIStatusError) and error.status_code == 429
+
+
+def retry_after(error):
+    '''
+    Delay in seconds requested by the server through the Retry-After headers, None if there is none
+    '''
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after') is not None:
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+class RequestController:
+    '''
+    Controls the requests to the API: retries transient errors with jittered exponential backoff,
+    adapts the number of in-flight requests with additive increase/multiplicative decrease (AIMD) and
+    trips a circuit breaker on sustained failure: requests wait until the circuit closes again, and the run is
+    stopped if it opens again max_trips times without a successful request in between.
+    The in-flight limit grows by one per limit successful requests and is multiplied by decrease_factor
+    on a 429 or when the latency exceeds latency_target, at most once per decrease_interval seconds.
+    initial_limit: in-flight requests at the start
+    min_limit, max_limit: bounds of the in-flight limit
+    max_retries: retries per request before the error is raised
+    base_delay, max_delay: bounds of the exponential backoff in seconds
+    latency_target: latency in seconds above which the limit is decreased, None to only react to 429s
+    failure_threshold: consecutive failed attempts that open the circuit
+    cooldown: seconds the circuit stays open before requests are let through again
+    max_trips: consecutive openings of the circuit after which the requests raise CircuitOpenError
+    report_interval: print the state every report_interval seconds, None to stay quiet
+    '''
+
+    def __init__(self, initial_limit=8, min_limit=1, max_limit=64, max_retries=6, base_delay=1.0, max_delay=60.0,
+                 latency_target=None, decrease_factor=0.5, decrease_interval=5.0, failure_threshold=20, cooldown=60.0,
+                 max_trips=3, report_interval=None):
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_trips = max_trips
+        self.report_interval = report_interval
+
+        self.in_flight = 0
+        self.requests = 0
+        self.successes = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.circuit_trips = 0
+        self.consecutive_trips = 0
+        self.last_decrease = 0.0
+        self.last_report = time.monotonic()
+        self.condition = None
+        self.loop = None
+
+    def state(self):
+        '''
+        Live state of the controller
+        '''
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "successes": self.successes,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "failures": self.failures,
+            "circuit_open": self.circuit_is_open(),
+            "circuit_trips": self.circuit_trips,
+        }
+
+    def circuit_is_open(self):
+        return time.monotonic() < self.circuit_open_until
+
+    def backoff(self, attempt):
+        '''
+        Full-jitter exponential backoff delay for the given retry attempt
+        '''
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease >= self.decrease_interval:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self.last_decrease = now
+
+    def _on_success(self, latency):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.consecutive_trips = 0
+        if self.latency_target is not None and latency > self.latency_target:
+            self._decrease()
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._report()
+
+    def _on_error(self, error):
+        self.consecutive_failures += 1
+        if is_rate_limit(error):
+            self.rate_limited += 1
+            self._decrease()
+        if self.consecutive_failures >= self.failure_threshold and not self.circuit_is_open():
+            self.circuit_open_until = time.monotonic() + self.cooldown
+            self.circuit_trips += 1
+            self.consecutive_trips += 1
+            print(f'Circuit breaker opened for {self.cooldown:.0f} s after {self.consecutive_failures} consecutive failures: {error}')
+
+    def _retry_delay(self, error, attempt):
+        '''
+        Delay before the next attempt, None if the error must be raised
+        '''
+        if not is_transient(error) or attempt >= self.max_retries:
+            self.failures += 1
+            return None
+        self.retries += 1
+        delay = retry_after(error)
+        return min(self.max_delay, delay) if delay is not None else self.backoff(attempt)
+
+    def _circuit_wait(self):
+        '''
+        Seconds until the circuit closes, 0 if it is closed.
+        Raises CircuitOpenError if the circuit opened max_trips times in a row.
+        '''
+        remaining = self.circuit_open_until - time.monotonic()
+        if remaining <= 0:
+            return 0
+        if self.consecutive_trips >= self.max_trips:
+            raise CircuitOpenError(f'Circuit breaker opened {self.consecutive_trips} times in a row.')
+        return remaining
+
+    def _report(self):
+        if self.report_interval is not None and time.monotonic() - self.last_report >= self.report_interval:
+            self.last_report = time.monotonic()
+            print(f'Request controller: {self.state()}')
+
+    async def _acquire(self):
+        # the condition belongs to the event loop it was created in; a controller shared across asyncio.run
+        # calls (e.g. one per streamed chunk) gets a new one in each loop
+        loop = asyncio.get_running_loop()
+        if self.condition is None or self.loop is not loop:
+            self.condition = asyncio.Condition()
+            self.loop = loop
+            self.in_flight = 0
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def _release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def call(self, make_request, stats=None, before_request=None):
+        '''
+        Send a request within the in-flight limit and retry it on transient errors
+        make_request: function without arguments that returns the awaitable request
+        stats: optional request statistics (see telemetry.py), the waits for the open circuit, the in-flight limit
+               and before_request are added to 'queue_wait' and the retries to 'retries'
+        before_request: optional function without arguments returning an awaitable that is awaited before each
+                        attempt, e.g. the rate limiter. Its wait is not part of the latency the limit adapts to.
+        '''
+        attempt = 0
+        while True:
+            wait_start = time.monotonic()
+            delay = self._circuit_wait()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self._circuit_wait()
+            await self._acquire()
+            if before_request is not None:
+                try:
+                    await before_request()
+                except BaseException:
+                    await self._release()
+                    raise
+            if stats is not None:
+                stats["queue_wait"] += time.monotonic() - wait_start
+                stats["retries"] += attempt > 0
+            self.requests += 1
+            start = time.monotonic()
+            try:
+                result = await make_request()
+            except Exception as error:
+                await self._release()
+                self._on_error(error)
+                delay = self._retry_delay(error, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            await self._release()
+            self._on_success(time.monotonic() - start)
+            return result
+
+    def call_sync(self, make_request, stats=None):
+        '''
+        Synchronous counterpart of call, for the sequential classify_df (no in-flight limit)
+        make_request: function without arguments that sends the request and returns the response
+        stats: optional request statistics, the retries are added to 'retries'
+        '''
+        attempt = 0
+        while True:
+            delay = self._circuit_wait()
+            while delay > 0:
+                time.sleep(delay)
+                delay = self._circuit_wait()
+            if stats is not None:
+                stats["retries"] += attempt > 0
+            self.requests += 1
+            start = time.monotonic()
+            try:
+                result = make_request()
+            except Exception as error:
+                self._on_error(error)
+                delay = self._retry_delay(error, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(time.monotonic() - start)
+            return result
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class CacheMissError(KeyError):
+    '''
+    Raised when a read-only cache does not contain a requested response.
+    '''
+
+
+class ResponseCache:
+    '''
+    Persistent, content-addressed cache for model responses stored in a SQLite database.
+    Responses are keyed on a hash of the model name and the fully rendered messages, so that a change
+    in a task's prompt only invalidates the responses of this task.
+    path: path of the SQLite database file
+    max_size_mb: evict the least recently used responses when the cache grows beyond this size, None for no limit
+    max_age_days: evict responses older than this number of days, None for no limit
+    read_only: never write to the cache, a lookup that misses raises CacheMissError (reproducible replays)
+    '''
+
+    def __init__(self, path, max_size_mb=None, max_age_days=None, read_only=False):
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.max_age_seconds = max_age_days * 24 * 3600 if max_age_days else None
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+
+        if read_only:
+            self.connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.connection = sqlite3.connect(path)
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT,
+                    size INTEGER,
+                    created_at REAL,
+                    accessed_at REAL
+                )''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS idx_accessed_at ON responses (accessed_at)')
+            self.connection.commit()
+            self.evict()
+
+        self.size_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def key(model, messages):
+        '''
+        Hash of the model name and the rendered messages of a request
+        messages: chat messages (system, user, assistant and main prompt)
+        '''
+        payload = json.dumps({"model": model, "messages": messages}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''
+        Return the cached response for the key, or None if it is not cached
+        '''
+        row = self.connection.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            if self.read_only:
+                raise CacheMissError(f'Response {key} is not in the read-only cache {self.path}.')
+            return None
+        self.hits += 1
+        if not self.read_only:
+            self.connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+        return row[0]
+
+    def put(self, key, model, response):
+        '''
+        Store a response in the cache
+        '''
+        if self.read_only:
+            return
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        previous = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses (key, model, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (key, model, response, size, now, now))
+        self.connection.commit()
+        self.size_bytes += size - (previous[0] if previous else 0)
+        if self.max_size_bytes and self.size_bytes > self.max_size_bytes:
+            self.evict()
+
+    def evict(self):
+        '''
+        Remove responses that are older than max_age_days and, if the cache is larger than max_size_mb,
+        the least recently used responses until the cache is at 90% of the size limit
+        '''
+        if self.read_only:
+            return
+        if self.max_age_seconds:
+            self.connection.execute('DELETE FROM responses WHERE created_at < ?', (time.time() - self.max_age_seconds,))
+        if self.max_size_bytes:
+            target = int(self.max_size_bytes * 0.9)
+            total = 0
+            keep_after = None
+            # walk from the most recently used response and drop everything beyond the target size
+            for accessed_at, size in self.connection.execute('SELECT accessed_at, size FROM responses ORDER BY accessed_at DESC'):
+                total += size
+                if total > target:
+                    keep_after = accessed_at
+                    break
+            if keep_after is not None:
+                self.connection.execute('DELETE FROM responses WHERE accessed_at <= ?', (keep_after,))
+        self.connection.commit()
+        self.size_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def stats(self):
+        '''
+        Return hit/miss counters and the size of the cache
+        '''
+        entries = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_mb": self.size_bytes / (1024 * 1024),
+        }
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,182 @@
+import json
+import re
+from functools import lru_cache
+
+from prompts.tasks import tasks
+from prompts.template import compile_prompt
+
+FOLLOWUP_PROMPT = """
+Return only the following keys for the above input: {keys}.
+Respond as JSON in this format, no prose:
+{output_format}"""
+
+CODE_FENCE = re.compile(r'```(?:json)?\s*(.*?)(?:```|$)', flags=re.DOTALL)
+
+CLOSERS = {'{': '}', '[': ']'}
+
+# Label definitions of tasks with a fixed set of labels, e.g. 'action: Mention of an action, ...'
+LABEL_DEFINITION = re.compile(r'^([\w-]+): ', flags=re.MULTILINE)
+
+
+def close_truncated(text):
+    '''
+    Complete a JSON object that was cut off, e.g. by the token limit.
+    Scans the text once, keeping track of strings and open brackets, and tries to close the text at its end
+    and then at the last commas, dropping an incomplete trailing key or value.
+    Returns the parsed object, None if the text cannot be completed.
+    '''
+    stack = []
+    cut_points = []
+    in_string = False
+    escape = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in CLOSERS:
+            stack.append(CLOSERS[char])
+        elif char in '}]':
+            if not stack:
+                break
+            stack.pop()
+        elif char == ',':
+            cut_points.append((i, ''.join(reversed(stack))))
+
+    candidates = [text + ('"' if in_string else '') + ''.join(reversed(stack))]
+    candidates += [text[:i] + closers for i, closers in reversed(cut_points)]
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def parse_json(response):
+    '''
+    Parse a model response that should be a JSON object, tolerating code fences, prose before or after
+    the object and truncated objects. Valid JSON takes the fast path through json.loads.
+    Returns the parsed object, None if no object can be recovered.
+    '''
+    if response is None:
+        return None
+    try:
+        return json.loads(response)
+    except json.JSONDecodeError:
+        pass
+
+    fenced = CODE_FENCE.search(response)
+    text = fenced.group(1) if fenced else response
+    start = text.find('{')
+    if start == -1:
+        return None
+    text = text[start:]
+    try:
+        # ignores trailing prose after the object
+        return json.JSONDecoder().raw_decode(text)[0]
+    except json.JSONDecodeError:
+        return close_truncated(text)
+
+
+@lru_cache(maxsize=None)
+def task_schema(task_name):
+    '''
+    Expected keys of a task's response, from the output_format in prompts/tasks.py:
+    {key: description} for standard tasks, {subtask: {key: description}} for chain-of-features tasks
+    '''
+    return json.loads(tasks[task_name]["output_format"])
+
+
+@lru_cache(maxsize=None)
+def allowed_labels(task_name):
+    '''
+    Labels defined in the label_definition of a task in prompts/tasks.py, None for tasks whose labels are
+    extracted from the text (event triggers, time specifications, quantified values)
+    task_name: task name, or the subtask name of a chain-of-features task
+    '''
+    if task_name not in tasks:
+        return None
+    labels = LABEL_DEFINITION.findall(tasks[task_name]["label_definition"])
+    return frozenset(labels) if labels else None
+
+
+def is_allowed_label(task_name, label):
+    '''
+    Whether a label is one of the labels of the task, compared case-insensitively (measurability 3 and '3' are the same)
+    '''
+    labels = allowed_labels(task_name)
+    if labels is None:
+        return True
+    if isinstance(label, float) and label.is_integer():
+        label = int(label)
+    return isinstance(label, (str, int)) and not isinstance(label, bool) and str(label).strip().lower() in labels
+
+
+def invalid_keys(task_name, response):
+    '''
+    Top-level keys of the task schema that are missing or invalid in a parsed response:
+    'label' and 'reasoning' for standard tasks, the subtask names for chain-of-features tasks.
+    A label outside the labels of the task (see allowed_labels) is invalid.
+    response: parsed response, None if it could not be parsed
+    '''
+    schema = task_schema(task_name)
+    if not isinstance(response, dict):
+        return list(schema)
+    invalid = []
+    for key, expected in schema.items():
+        value = response.get(key)
+        if isinstance(expected, dict):
+            if (not isinstance(value, dict) or any(value.get(subkey) is None for subkey in expected)
+                    or not is_allowed_label(key, value.get('label'))):
+                invalid.append(key)
+        elif value is None or (key == 'label' and not is_allowed_label(task_name, value)):
+            invalid.append(key)
+    return invalid
+
+
+def is_complete(task_name, content):
+    '''
+    Whether a raw response parses and has valid values for all keys of the task schema.
+    Only complete responses are cached, incomplete ones are requested again in the next run.
+    '''
+    return not invalid_keys(task_name, parse_json(content))
+
+
+def followup_messages(task_name, text, keys):
+    '''
+    Messages asking the model again for the given keys only: the compiled prompt prefix and the input text,
+    followed by the missing keys instead of the full instructions. Neither the first answer nor the rest
+    of the first prompt is sent again, and the prefix is shared with the first request for prompt caching.
+    text: input text of the first request
+    keys: missing or invalid keys as returned by invalid_keys
+    '''
+    schema = task_schema(task_name)
+    output_format = json.dumps({key: schema[key] for key in keys}, ensure_ascii=False)
+    prompt = compile_prompt(task_name)
+    return prompt.messages(text)[:-1] + [
+        {"role": "user", "content": prompt.prefix + text + FOLLOWUP_PROMPT.format(keys=', '.join(keys), output_format=output_format)},
+    ]
+
+
+def merge_followup(response, followup, keys):
+    '''
+    Merge the answer to a follow-up request into the first response, returns the merged raw JSON response.
+    If the follow-up answer has none of the keys, the first response is returned as it is, so that the raw
+    model output stays visible in the output and the journal.
+    response: raw response to the first request
+    followup: raw response to the follow-up request
+    keys: keys that were asked for again
+    '''
+    parsed_followup = parse_json(followup)
+    if not isinstance(parsed_followup, dict) or not any(key in parsed_followup for key in keys):
+        return response
+    parsed = parse_json(response)
+    parsed = parsed if isinstance(parsed, dict) else {}
+    parsed.update({key: parsed_followup[key] for key in keys if key in parsed_followup})
+    return json.dumps(parsed, ensure_ascii=False)
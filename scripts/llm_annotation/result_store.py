@@ -0,0 +1,216 @@
+'''
+Long-format Parquet store of the annotation results.
+Instead of two object columns per model, task and subtask (initialize_response_columns), every run appends one
+Parquet file with one row per (row_id, model, task, subtask) to the store directory. The model, task, subtask and
+label columns are dictionary-encoded; the reasoning column is compressed on its own (zstd) and is not read unless
+requested. to_wide() pivots the results back to the {model}_{task}_label / _reasoning layout of ground_truth_llm.csv.
+
+Usage: $python result_store.py output/results --models gpt-4o --tasks category chain_of_features --output wide.csv
+       $python result_store.py output/results --convert output/gpt-4o/240601/ground_truth_llm.csv --model gpt-4o
+'''
+import argparse
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from llm_annotation import response_columns
+from prompts.tasks import tasks
+
+SCHEMA = pa.schema([
+    ('row_id', pa.int64()),
+    ('model', pa.dictionary(pa.int32(), pa.string())),
+    ('task', pa.dictionary(pa.int32(), pa.string())),
+    ('subtask', pa.dictionary(pa.int32(), pa.string())),
+    ('label', pa.dictionary(pa.int32(), pa.string())),
+    ('run', pa.dictionary(pa.int32(), pa.string())),
+    ('written_at', pa.timestamp('ns')),
+    ('reasoning', pa.string()),
+])
+
+# Columns read by default, the reasoning is only read when asked for
+LABEL_COLUMNS = ['row_id', 'model', 'task', 'subtask', 'label', 'run', 'written_at']
+
+# Prefix of the subtask columns of the chain-of-features tasks
+SUBTASK_PREFIXES = {'chain_of_features': 'cof', 'event_trigger_chain_of_features': 'et_cof'}
+
+
+def new_run_name():
+    '''
+    Name of a run: the time it started
+    '''
+    return datetime.now().strftime('%y%m%d-%H%M%S')
+
+
+def result_column(model, task_name, subtask, kind):
+    '''
+    Name of the wide result column of a (model, task, subtask), kind 'label' or 'reasoning'
+    '''
+    if subtask:
+        return f'{model}_{SUBTASK_PREFIXES[task_name]}_{subtask}_{kind}'
+    return f'{model}_{task_name}_{kind}'
+
+
+def encode_label(label):
+    '''
+    Labels are stored as strings, other labels (numbers, lists) as JSON
+    '''
+    if label is None or isinstance(label, str):
+        return label
+    if isinstance(label, float) and label != label:
+        return None
+    return json.dumps(label, ensure_ascii=False)
+
+
+def to_long(df, task_names, model, run, written_at):
+    '''
+    Long table of the result columns of a model in a wide dataframe (as written by classify_df),
+    one row per (row_id, task, subtask) with a label or reasoning
+    written_at: time of the append in nanoseconds since the epoch
+    '''
+    row_ids = df['row_id'].to_numpy()
+    frames = []
+    for task_name in task_names:
+        subtasks = tasks[task_name]['subtasks'] if task_name in SUBTASK_PREFIXES else ['']
+        for subtask in subtasks:
+            label_column = result_column(model, task_name, subtask, 'label')
+            reasoning_column = result_column(model, task_name, subtask, 'reasoning')
+            if label_column not in df.columns:
+                continue
+            labels = df[label_column]
+            reasonings = df[reasoning_column] if reasoning_column in df.columns else pd.Series(None, index=df.index, dtype=object)
+            answered = (labels.notna() | reasonings.notna()).to_numpy()
+            frames.append(pd.DataFrame({
+                'row_id': row_ids[answered],
+                'task': task_name,
+                'subtask': subtask,
+                'label': [encode_label(label) for label in labels.to_numpy(dtype=object)[answered]],
+                'reasoning': reasonings.astype(object).where(reasonings.notna(), None).to_numpy(dtype=object)[answered],
+            }))
+    long = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['row_id', 'task', 'subtask', 'label', 'reasoning'])
+    long.insert(1, 'model', model)
+    long['run'] = run
+    long['written_at'] = pd.Timestamp(written_at, unit='ns')
+    return long
+
+
+class ResultStore:
+    '''
+    Directory of Parquet files with the results of all runs in long format
+    path: store directory
+    '''
+
+    def __init__(self, path='output/results'):
+        self.path = path
+        self.last_written_at = 0
+
+    def append(self, df, task_names, model, run=None):
+        '''
+        Append the result columns of a model in a wide dataframe as a new Parquet file of the store.
+        The file is written under a temporary name and renamed when complete. Every result is stamped with the
+        time of the append (written_at), which decides which result of a cell is the latest.
+        run: name of the run, defaults to the current time. Pass the same name for all appends of one run
+             (e.g. the chunks of a streamed run) to select them together.
+        Returns the number of stored results
+        '''
+        run = run or new_run_name()
+        # strictly increasing within the process, so that two appends never tie
+        self.last_written_at = max(time.time_ns(), self.last_written_at + 1)
+        long = to_long(df, list(task_names), model, run, self.last_written_at)
+        table = pa.Table.from_pandas(long[SCHEMA.names], schema=SCHEMA, preserve_index=False)
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, f'{run}-{uuid.uuid4().hex[:8]}.parquet')
+        pq.write_table(table, f'{path}.tmp',
+                       use_dictionary=['model', 'task', 'subtask', 'label', 'run'],
+                       compression={name: 'snappy' for name in LABEL_COLUMNS} | {'reasoning': 'zstd'},
+                       compression_level={'reasoning': 9})
+        os.replace(f'{path}.tmp', path)
+        return len(long)
+
+    def read(self, models=None, task_names=None, runs=None, reasoning=False):
+        '''
+        Results of the store as a long dataframe, optionally only of some models, tasks and runs
+        reasoning: also read the reasoning column
+        '''
+        if not os.path.isdir(self.path) or not any(name.endswith('.parquet') for name in os.listdir(self.path)):
+            return pd.DataFrame(columns=LABEL_COLUMNS + (['reasoning'] if reasoning else []))
+        dataset = ds.dataset(self.path, format='parquet', schema=SCHEMA, exclude_invalid_files=True)
+        condition = None
+        for column, values in [('model', models), ('task', task_names), ('run', runs)]:
+            if values is not None:
+                selected = ds.field(column).isin(list(values))
+                condition = selected if condition is None else condition & selected
+        columns = LABEL_COLUMNS + (['reasoning'] if reasoning else [])
+        return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+    def to_wide(self, df=None, models=None, task_names=None, runs=None, reasoning=True):
+        '''
+        Pivot the results back to one label and one reasoning column per model, task and subtask.
+        If a (row, model, task, subtask) was stored several times, the result written last wins.
+        df: optional input dataframe with a 'row_id' column, the result columns are joined to it
+        '''
+        long = self.read(models, task_names, runs, reasoning)
+        keys = ['model', 'task', 'subtask']
+        for column in keys:
+            long[column] = long[column].astype(str)
+        # column name prefix of each (model, task, subtask), built once per combination instead of once per row
+        names = long[keys].drop_duplicates()
+        names['column'] = [result_column(*key, '') for key in names.itertuples(index=False)]
+        long = long.merge(names, on=keys, how='left')
+        # keep the last written result of each cell
+        long = long.sort_values('written_at', kind='stable').drop_duplicates(['row_id', 'column'], keep='last')
+
+        values = {'label': long['label'].astype(object)}
+        if reasoning:
+            values['reasoning'] = long['reasoning'].astype(object)
+        wide = pd.concat([pd.DataFrame({'row_id': long['row_id'], 'column': long['column'] + kind, 'value': value})
+                          for kind, value in values.items()], ignore_index=True)
+        wide = wide.pivot(index='row_id', columns='column', values='value')
+
+        # columns in the order of initialize_response_columns
+        ordered = []
+        for model in sorted(long['model'].unique()):
+            for task_name in tasks:
+                ordered += [column for column in response_columns(task_name, model) if column in wide.columns]
+        wide = wide[ordered].astype(object)
+        wide = wide.where(wide.notna(), None).reset_index()
+        wide.columns.name = None
+        if df is None:
+            return wide
+        return df.merge(wide, on='row_id', how='left')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read the long-format result store, or add a wide output file to it.')
+    parser.add_argument('store', help='result store directory')
+    parser.add_argument('--convert', default=None, help='ground_truth_llm.csv file to append to the store')
+    parser.add_argument('--model', default=None, help='model of the --convert file')
+    parser.add_argument('--models', nargs='*', default=None, help='models to read')
+    parser.add_argument('--tasks', nargs='*', default=None, help='tasks to read')
+    parser.add_argument('--no-reasoning', action='store_true', help='only read the labels')
+    parser.add_argument('--output', default=None, help='write the wide results to this CSV file')
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    if args.convert:
+        # labels are read as written, e.g. measurability '3' instead of the float 3.0
+        df = pd.read_csv(args.convert, dtype=str)
+        df['row_id'] = df['row_id'].astype('int64')
+        n_results = store.append(df, tasks.keys(), args.model)
+        print(f'Appended {n_results} results of {args.model} to {args.store}')
+        return
+
+    wide = store.to_wide(models=args.models, task_names=args.tasks, reasoning=not args.no_reasoning)
+    print(f'{len(wide)} rows, {len(wide.columns) - 1} result columns')
+    if args.output:
+        wide.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import gc
+import os
+
+import pandas as pd
+
+# Estimated memory of one result cell (label or reasoning string) added to each row by the annotation
+RESULT_BYTES_PER_CELL = 400
+
+# Rows of the first batch of an input file, used to estimate the memory per row
+PROBE_ROWS = 1000
+
+
+def rows_per_chunk(probe, n_result_columns, chunk_size, max_memory_mb):
+    '''
+    Number of rows read at once: chunk_size, lowered so that an annotated chunk stays below the memory ceiling
+    as estimated from the bytes per row of a first small batch
+    probe: first batch of the input file
+    '''
+    if not max_memory_mb or probe.empty:
+        return chunk_size
+    bytes_per_row = estimate_chunk_memory(probe, n_result_columns) / len(probe)
+    return max(1, min(chunk_size, int(max_memory_mb * 1024 * 1024 // bytes_per_row)))
+
+
+def read_file_chunks(path, chunk_size, n_result_columns=0, max_memory_mb=None):
+    '''
+    Read a CSV or Parquet file in chunks. A first batch of at most PROBE_ROWS rows is read to derive the
+    number of rows per chunk from the memory ceiling (rows_per_chunk), so no chunk larger than the ceiling is read.
+    '''
+    probe_size = min(chunk_size, PROBE_ROWS)
+    if path.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        rows = None
+        pending = []
+        n_pending = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=probe_size):
+            if rows is None:
+                rows = rows_per_chunk(batch.to_pandas(), n_result_columns, chunk_size, max_memory_mb)
+            pending.append(batch)
+            n_pending += batch.num_rows
+            while n_pending >= rows:
+                table = pa.Table.from_batches(pending)
+                yield table.slice(0, rows).to_pandas()
+                rest = table.slice(rows)
+                pending = rest.to_batches()
+                n_pending = rest.num_rows
+        if n_pending:
+            yield pa.Table.from_batches(pending).to_pandas()
+        return
+
+    with pd.read_csv(path, chunksize=probe_size) as reader:
+        try:
+            probe = reader.get_chunk()
+        except StopIteration:
+            return
+        rows = rows_per_chunk(probe, n_result_columns, chunk_size, max_memory_mb)
+        # the probe is the start of the first chunk, or is cut into chunks if the ceiling allows fewer rows
+        while len(probe) > rows:
+            yield probe.iloc[:rows]
+            probe = probe.iloc[rows:]
+        chunk = probe
+        while True:
+            if len(chunk) < rows:
+                try:
+                    rest = reader.get_chunk(rows - len(chunk))
+                except StopIteration:
+                    if len(chunk):
+                        yield chunk
+                    return
+                chunk = pd.concat([chunk, rest], ignore_index=True) if len(chunk) else rest
+            yield chunk
+            chunk = probe.iloc[:0]
+
+
+def read_input_chunks(paths, chunk_size, n_result_columns=0, max_memory_mb=None):
+    '''
+    Read CSV or Parquet input files in chunks of at most chunk_size rows, and with a memory ceiling,
+    of at most the rows whose annotated size fits below it.
+    Rows without a 'row_id' column are numbered consecutively across all chunks and files.
+    paths: list of input file paths
+    n_result_columns: number of result columns added by the annotation, used to estimate the memory of a chunk
+    max_memory_mb: memory ceiling of an annotated chunk, None for no ceiling
+    '''
+    next_row_id = 0
+    for path in paths:
+        for chunk in read_file_chunks(path, chunk_size, n_result_columns, max_memory_mb):
+            chunk = chunk.reset_index(drop=True)
+            if 'row_id' not in chunk.columns:
+                chunk['row_id'] = range(next_row_id, next_row_id + len(chunk))
+            next_row_id += len(chunk)
+            yield chunk
+
+
+def estimate_chunk_memory(chunk, n_result_columns):
+    '''
+    Estimate the memory in bytes of an annotated chunk: the input data plus the result columns
+    '''
+    return chunk.memory_usage(deep=True).sum() + len(chunk) * n_result_columns * RESULT_BYTES_PER_CELL
+
+
+def split_chunk(chunk, n_result_columns, max_memory_mb):
+    '''
+    Split a chunk into parts whose annotated size stays below the memory ceiling, for chunks whose rows
+    are larger than those of the first batch the chunk size was derived from
+    max_memory_mb: memory ceiling per chunk, None for no ceiling
+    '''
+    if not max_memory_mb or len(chunk) <= 1:
+        return [chunk]
+    n_parts = int(estimate_chunk_memory(chunk, n_result_columns) // (max_memory_mb * 1024 * 1024)) + 1
+    part_size = -(-len(chunk) // n_parts)
+    return [chunk.iloc[start:start + part_size] for start in range(0, len(chunk), part_size)]
+
+
+def write_output_chunk(df, output_dir, part, output_format):
+    '''
+    Write an annotated chunk as a numbered part file. The file is written under a temporary name
+    and renamed when complete, so an existing part file is always a finished chunk.
+    '''
+    path = f'{output_dir}/part-{part:05d}.{output_format}'
+    tmp_path = f'{path}.tmp'
+    if output_format == 'parquet':
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def classify_stream(input_paths, output_dir, classify_chunk, n_result_columns, chunk_size=10000, max_memory_mb=None,
+                    output_format='csv', resume=False):
+    '''
+    Annotate large inputs chunk by chunk with bounded memory.
+    Each chunk is read, annotated and written to its own part file before the next chunk is read.
+    With a memory ceiling, the number of rows read at once is derived from the size of the first rows of each file.
+    input_paths: list of CSV or Parquet input files
+    output_dir: directory of the output part files
+    classify_chunk: function that annotates a dataframe and returns it, e.g. a partial of classify_df
+    n_result_columns: number of result columns added by classify_chunk, used to estimate the memory of a chunk
+    chunk_size: maximum number of rows read at once
+    max_memory_mb: memory ceiling of an annotated chunk, limits the rows read at once, larger chunks are split
+    output_format: 'csv' or 'parquet'
+    resume: skip chunks whose part file already exists
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    part = 0
+    for chunk in read_input_chunks(input_paths, chunk_size, n_result_columns, max_memory_mb):
+        for sub_chunk in split_chunk(chunk, n_result_columns, max_memory_mb):
+            path = f'{output_dir}/part-{part:05d}.{output_format}'
+            if resume and os.path.exists(path):
+                print(f'Skipping completed part {path}')
+            else:
+                df_annotated = classify_chunk(sub_chunk.copy())
+                write_output_chunk(df_annotated, output_dir, part, output_format)
+                print(f'Wrote {len(df_annotated)} rows to {path}')
+                del df_annotated
+            part += 1
+        del chunk
+        gc.collect()
+    return part
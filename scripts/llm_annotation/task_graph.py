@@ -0,0 +1,187 @@
+import asyncio
+
+from async_engine import RateLimiter, classify_event_async
+from llm_annotation import (attach_results, get_row_ids, initialize_response_columns, initialize_results, input_column,
+                            result_array, store_response)
+from request_controller import RequestController
+from spans import span_text
+
+# Tasks whose outputs can be used to build the input of another task
+TASK_DEPENDENCIES = {
+    "event_trigger": [],
+    "category": ["event_trigger"],
+    "temporal_status": ["event_trigger"],
+    "measurability": ["event_trigger"],
+    "relation_temp": ["event_trigger"],
+    "relation_quant": ["event_trigger"],
+    "chain_of_features": ["event_trigger"],
+    "event_trigger_chain_of_features": [],
+    "category_input_man_features": ["event_trigger", "chain_of_features"],
+    "category_input_all_features": ["event_trigger", "chain_of_features"],
+}
+
+
+def predicted_label(outputs, model, task_name, subtask_name=None):
+    '''
+    Label predicted for a row by an upstream task, '' if the task has no label
+    outputs: result arrays of the row's completed tasks (one row each)
+    '''
+    if subtask_name is None:
+        label = outputs[task_name][f'{model}_{task_name}_label'][0]
+    else:
+        label = outputs[task_name][f'{model}_cof_{subtask_name}_label'][0]
+    if isinstance(label, list):
+        return ', '.join(str(value) for value in label)
+    return '' if label is None else str(label)
+
+
+def build_input(task_name, row, outputs, model):
+    '''
+    Input text of a task for one row. Dependencies that were annotated for the row replace the
+    corresponding ground truth values; tasks without annotated dependencies use their input column.
+    row: dict with the input columns of the row
+    outputs: result arrays of the row's completed tasks
+    '''
+    dependencies = [dependency for dependency in TASK_DEPENDENCIES[task_name] if dependency in outputs]
+    if not dependencies:
+        return row[input_column(task_name)]
+
+    keyword = span_text(row['keyword'])
+    if 'event_trigger' in outputs:
+        event_trigger = predicted_label(outputs, model, 'event_trigger')
+    else:
+        event_trigger = span_text(row['event_trigger'])
+
+    if task_name not in ['category_input_man_features', 'category_input_all_features']:
+        return f'{row["text"].strip()} (keyword: "{keyword}", event trigger: "{event_trigger}")'
+
+    if 'chain_of_features' in outputs:
+        features = {subtask_name: predicted_label(outputs, model, 'chain_of_features', subtask_name)
+                    for subtask_name in ['temporal_status', 'time_specifications', 'quantified_values', 'measurability']}
+    else:
+        features = {
+            'temporal_status': row['temporal_status'],
+            'time_specifications': span_text(row['relation_time_specification']),
+            'quantified_values': span_text(row['relation_unit']),
+            'measurability': str(row['measurability']).split('.')[0],
+        }
+    text = (f"{row['text'].strip()} (keyword: '{keyword}', event trigger: '{event_trigger}', temporal status: '{features['temporal_status']}', "
+            f"time specifications: '{features['time_specifications']}', quantified values: '{features['quantified_values']}', "
+            f"measurability: '{features['measurability']}'")
+    if task_name == 'category_input_all_features':
+        text += (f", event_factuality: '{row['event_factuality']}', kw_is_nsubj: \"{row['kw_is_nsubj']}\", "
+                 f"kw_is_dobj: \"{row['kw_is_dobj']}\", kw_is_pobj: \"{row['kw_is_pobj']}\"")
+    return text + ")"
+
+
+def topological_order(task_names):
+    '''
+    Order the tasks so that every task comes after the selected tasks it depends on
+    '''
+    task_names = list(task_names)
+    order = []
+    visiting = set()
+
+    def visit(task_name):
+        if task_name in order:
+            return
+        if task_name in visiting:
+            raise ValueError(f"Cyclic task dependency at '{task_name}'.")
+        visiting.add(task_name)
+        for dependency in TASK_DEPENDENCIES[task_name]:
+            if dependency in task_names:
+                visit(dependency)
+        visiting.discard(task_name)
+        order.append(task_name)
+
+    for task_name in task_names:
+        visit(task_name)
+    return order
+
+
+async def stream_annotated_rows(task_names, df, client, model, max_concurrency=8, max_rows_in_flight=None, rpm=None, tpm=None,
+                                cache=None, journal=None, use_predictions=True, controller=None, telemetry=None):
+    '''
+    Annotate the dataframe row by row and yield every row as soon as all its tasks are done.
+    Within a row, each task starts when the tasks it depends on have finished, so independent tasks run
+    concurrently and dependent tasks use the predictions of their dependencies as input. Several rows are
+    in flight at once to keep the number of in-flight requests at max_concurrency.
+    Yields (position, results) with the result arrays (one row each) of every task.
+    max_rows_in_flight: number of rows annotated at once, defaults to 4 * max_concurrency
+    journal: optional ResultJournal, responses are appended to it and responses already in it are reused
+    use_predictions: build task inputs from the predictions of their dependencies instead of the ground truth columns
+    controller: optional RequestController, defaults to one whose in-flight limit adapts between 1 and max_concurrency
+    telemetry: optional Telemetry recording every request
+    '''
+    order = topological_order(task_names)
+    controller = controller or RequestController(initial_limit=max_concurrency, max_limit=max_concurrency)
+    row_slots = asyncio.Semaphore(max_rows_in_flight or 4 * max_concurrency)
+    limiter = RateLimiter(rpm, tpm)
+    previous = journal.responses(model) if journal is not None else {}
+
+    row_ids = get_row_ids(df)
+    columns = {column: df[column].tolist() for column in df.columns}
+
+    async def annotate_task(task_name, row, row_id, outputs, dependencies):
+        await asyncio.gather(*dependencies)
+        available = {dependency: outputs[dependency] for dependency in TASK_DEPENDENCIES[task_name]
+                     if use_predictions and dependency in outputs}
+        input_text = build_input(task_name, row, available, model)
+        response = previous.get((row_id, task_name))
+        if response is None:
+            response = await classify_event_async(client, model, task_name, input_text, controller, limiter, cache, telemetry)
+            if journal is not None:
+                journal.record(row_id, task_name, model, response)
+        store_response(outputs[task_name], response, 0, model, task_name)
+
+    async def annotate_row(position):
+        try:
+            row = {column: values[position] for column, values in columns.items()}
+            outputs = {task_name: initialize_results(task_name, model, 1) for task_name in order}
+            futures = {}
+            # tasks are created in topological order, so the futures of their dependencies exist
+            for task_name in order:
+                dependencies = [futures[dependency] for dependency in TASK_DEPENDENCIES[task_name] if dependency in futures]
+                futures[task_name] = asyncio.ensure_future(annotate_task(task_name, row, row_ids[position], outputs, dependencies))
+            await asyncio.gather(*futures.values())
+            return position, outputs
+        finally:
+            row_slots.release()
+
+    pending = set()
+    for position in range(len(df)):
+        await row_slots.acquire()
+        pending.add(asyncio.ensure_future(annotate_row(position)))
+        # emit the rows that finished while the next rows were admitted
+        done = {future for future in pending if future.done()}
+        pending -= done
+        for future in done:
+            yield future.result()
+
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+async def classify_df_pipelined(task_names, df, client, model, on_row=None, **kwargs):
+    '''
+    Classify the events in the dataframe row by row with stream_annotated_rows.
+    Produces the same columns as classify_df.
+    on_row: optional function called with (position, results) for every finished row, e.g. to write rows progressively
+    kwargs: options of stream_annotated_rows
+    '''
+    task_names = list(task_names)
+    df = initialize_response_columns(df, task_names, model)
+    results = {task_name: initialize_results(task_name, model, len(df)) for task_name in task_names}
+
+    async for position, outputs in stream_annotated_rows(task_names, df, client, model, **kwargs):
+        for task_name, task_outputs in outputs.items():
+            for column, values in task_outputs.items():
+                result_array(results[task_name], column)[position] = values[0]
+        if on_row is not None:
+            on_row(position, outputs)
+
+    for task_name in task_names:
+        df = attach_results(df, results[task_name])
+    return df
@@ -0,0 +1,179 @@
+import bisect
+import json
+import time
+
+# Upper bounds in seconds of the latency histogram buckets (the last bucket is +Inf)
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+# Counters of the run summary and the Prometheus file, summed from the request records
+COUNTERS = ["requests", "cache_hits", "api_requests", "retries", "parse_failures", "reasked_keys",
+            "prompt_tokens", "completion_tokens"]
+
+
+def new_request_stats():
+    '''
+    Statistics of one classify_event call, filled in by request_completion and the RequestController
+    '''
+    return {"latency": 0.0, "queue_wait": 0.0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0,
+            "api_requests": 0, "cache_hit": False, "parse_failed": False, "reasked_keys": 0}
+
+
+def add_usage(stats, response):
+    '''
+    Add the token usage of a chat completion response to the request statistics
+    '''
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        stats["prompt_tokens"] += usage.prompt_tokens or 0
+        stats["completion_tokens"] += usage.completion_tokens or 0
+
+
+class TaskMetrics:
+    '''
+    Running aggregates of the requests of one task and model, in constant memory
+    '''
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.queue_wait_sum = 0.0
+        self.first_request = None
+        self.last_request = None
+
+    def add(self, stats, timestamp):
+        self.counters["requests"] += 1
+        self.counters["cache_hits"] += stats["cache_hit"]
+        self.counters["parse_failures"] += stats["parse_failed"]
+        for counter in ["api_requests", "retries", "reasked_keys", "prompt_tokens", "completion_tokens"]:
+            self.counters[counter] += stats[counter]
+        if not stats["cache_hit"]:
+            self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, stats["latency"])] += 1
+            self.latency_sum += stats["latency"]
+            self.latency_max = max(self.latency_max, stats["latency"])
+            self.queue_wait_sum += stats["queue_wait"]
+        if self.first_request is None:
+            self.first_request = timestamp - stats["latency"] - stats["queue_wait"]
+        self.last_request = timestamp
+
+    def latency_quantile(self, quantile):
+        '''
+        Upper bound of the histogram bucket containing the quantile, None if there were no API requests
+        '''
+        count = sum(self.latency_buckets)
+        if not count:
+            return None
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS + [self.latency_max], self.latency_buckets):
+            cumulative += bucket_count
+            if cumulative >= quantile * count:
+                return bound
+        return self.latency_max
+
+    def summary(self):
+        measured = sum(self.latency_buckets)
+        duration = (self.last_request - self.first_request) if self.first_request is not None else 0.0
+        return {
+            **self.counters,
+            "latency_mean_s": self.latency_sum / measured if measured else None,
+            "latency_p50_s": self.latency_quantile(0.5),
+            "latency_p99_s": self.latency_quantile(0.99),
+            "latency_max_s": self.latency_max,
+            "queue_wait_mean_s": self.queue_wait_sum / measured if measured else None,
+            "requests_per_sec": self.counters["requests"] / duration if duration > 0 else None,
+            "latency_histogram": {str(bound): count for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], self.latency_buckets)},
+        }
+
+
+class Telemetry:
+    '''
+    Structured per-request records and a per-run summary of the annotation pipeline.
+    Each classify_event call is written as one JSON line to path (buffered, flushed every flush_every records)
+    and aggregated per task and model in constant memory. close() flushes and closes the JSONL file,
+    write_summary() writes the summary as JSON and in the Prometheus text format.
+    path: JSONL file of the request records, None to only aggregate
+    '''
+
+    def __init__(self, path=None, flush_every=1000):
+        self.path = path
+        self.flush_every = flush_every
+        self.file = open(path, 'a', encoding='utf-8') if path is not None else None
+        self.buffer = []
+        self.metrics = {}
+        self.started_at = time.time()
+
+    def record(self, task_name, model, stats):
+        '''
+        Record one classify_event call
+        stats: request statistics as returned by new_request_stats
+        '''
+        timestamp = time.time()
+        metrics = self.metrics.get((task_name, model))
+        if metrics is None:
+            metrics = self.metrics[(task_name, model)] = TaskMetrics()
+        metrics.add(stats, timestamp)
+        if self.file is not None:
+            self.buffer.append(json.dumps({"time": timestamp, "task": task_name, "model": model, **stats}))
+            if len(self.buffer) >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        if self.file is not None and self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.file.flush()
+            self.buffer = []
+
+    def summary(self):
+        '''
+        Per-run summary with counters, latency histograms and throughput per task and model
+        '''
+        finished_at = time.time()
+        return {
+            "started_at": self.started_at,
+            "finished_at": finished_at,
+            "duration_s": finished_at - self.started_at,
+            "tasks": [{"task": task_name, "model": model, **metrics.summary()}
+                      for (task_name, model), metrics in self.metrics.items()],
+        }
+
+    def prometheus_text(self):
+        '''
+        Summary in the Prometheus text exposition format
+        '''
+        lines = []
+        for counter in COUNTERS:
+            name = f'llm_annotation_{counter}_total'
+            lines += [f'# HELP {name} {counter.replace("_", " ").capitalize()} per task and model.', f'# TYPE {name} counter']
+            for (task_name, model), metrics in self.metrics.items():
+                lines.append(f'{name}{{task="{task_name}",model="{model}"}} {metrics.counters[counter]}')
+
+        name = 'llm_annotation_request_latency_seconds'
+        lines += [f'# HELP {name} Latency of the API requests per task and model.', f'# TYPE {name} histogram']
+        for (task_name, model), metrics in self.metrics.items():
+            labels = f'task="{task_name}",model="{model}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], metrics.latency_buckets):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {metrics.latency_sum}')
+            lines.append(f'{name}_count{{{labels}}} {cumulative}')
+
+        name = 'llm_annotation_queue_wait_seconds_total'
+        lines += [f'# HELP {name} Time the requests waited for the concurrency and rate limits.', f'# TYPE {name} counter']
+        for (task_name, model), metrics in self.metrics.items():
+            lines.append(f'{name}{{task="{task_name}",model="{model}"}} {metrics.queue_wait_sum}')
+        return '\n'.join(lines) + '\n'
+
+    def write_summary(self, summary_path, prometheus_path=None):
+        with open(summary_path, 'w') as f:
+            json.dump(self.summary(), f, indent=4)
+        if prometheus_path is not None:
+            with open(prometheus_path, 'w') as f:
+                f.write(self.prometheus_text())
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
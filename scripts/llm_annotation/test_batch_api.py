@@ -0,0 +1,52 @@
+import json
+
+from batch_api import (export_batch_requests, ingest_batch_results, make_custom_id, parse_custom_id, read_batch_results,
+                       write_fixture_results)
+from benchmark_local_overhead import synthetic_df
+from mock_server import canned_response
+
+
+def test_custom_id_round_trip():
+    assert parse_custom_id(make_custom_id('gpt-4o', 'chain_of_features', 17)) == ('gpt-4o', 'chain_of_features', '17')
+
+
+def test_export_fixture_ingest(tmp_path):
+    '''
+    Requests exported for a small frame, answered with canned results and ingested fill the columns of classify_df
+    '''
+    df = synthetic_df(5)
+    df['row_id'] = [10, 11, 12, 13, 14]
+    task_names = ['category', 'chain_of_features']
+
+    request_paths = export_batch_requests(task_names, df, 'gpt-4o', str(tmp_path / 'requests'), max_requests_per_shard=4)
+    assert len(request_paths) == 3
+    requests = list(read_batch_results(request_paths))
+    assert [parse_custom_id(request['custom_id']) for request in requests] \
+        == [('gpt-4o', task_name, str(row_id)) for task_name in task_names for row_id in df['row_id']]
+
+    results_path = str(tmp_path / 'results' / 'fixture.jsonl')
+    write_fixture_results(request_paths, results_path)
+    assert [result['custom_id'] for result in read_batch_results([results_path])] == [request['custom_id'] for request in requests]
+
+    df_llm = ingest_batch_results([results_path], df, task_names, 'gpt-4o')
+    category = json.loads(canned_response('category'))
+    assert (df_llm['gpt-4o_category_label'] == category['label']).all()
+    assert (df_llm['gpt-4o_category_reasoning'] == category['reasoning']).all()
+    chain = json.loads(canned_response('chain_of_features'))
+    for subtask, response in chain.items():
+        assert (df_llm[f'gpt-4o_cof_{subtask}_label'] == response['label']).all()
+        assert (df_llm[f'gpt-4o_cof_{subtask}_reasoning'] == response['reasoning']).all()
+    assert df_llm['row_id'].tolist() == df['row_id'].tolist()
+
+
+def test_ingest_skips_failed_and_other_models(tmp_path):
+    df = synthetic_df(2)
+    results_path = tmp_path / 'results.jsonl'
+    failed = {"custom_id": make_custom_id('gpt-4o', 'category', 0), "response": None,
+              "error": {"code": "server_error", "message": "failed"}}
+    other_model = {"custom_id": make_custom_id('gpt-4o-mini', 'category', 1), "error": None,
+                   "response": {"status_code": 200, "body": {"choices": [{"message": {"content": canned_response('category')}}]}}}
+    results_path.write_text('\n'.join(json.dumps(result) for result in [failed, other_model]) + '\n')
+
+    df_llm = ingest_batch_results([str(results_path)], df, ['category'], 'gpt-4o')
+    assert df_llm['gpt-4o_category_label'].isna().all()
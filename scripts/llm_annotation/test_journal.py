@@ -0,0 +1,25 @@
+import json
+
+import pandas as pd
+
+from journal import ResultJournal
+from llm_annotation import rebuild_from_journal
+from mock_server import canned_response
+
+
+def test_resume_after_partial_line(tmp_path):
+    '''
+    A record appended on resume is not lost to the partial last line left by a crash
+    '''
+    path = str(tmp_path / 'journal.jsonl')
+    response = canned_response('category')
+    with ResultJournal(path) as journal:
+        journal.record(0, 'category', 'gpt-4o', response)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"row_id": 1, "task": "categ')
+
+    with ResultJournal(path) as journal:
+        journal.record(1, 'category', 'gpt-4o', response)
+
+    df = rebuild_from_journal(pd.DataFrame({'row_id': [0, 1]}), path, ['category'], 'gpt-4o')
+    assert df['gpt-4o_category_label'].tolist() == [json.loads(response)['label']] * 2
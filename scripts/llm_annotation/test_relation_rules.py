@@ -0,0 +1,19 @@
+import pytest
+
+from relation_rules import normalize_quantified_value
+
+
+@pytest.mark.parametrize('expression, normalized', [
+    ('70,128 m3/year', '70128 m3/year'),
+    ('12 tCO2e', '12 t CO2e'),
+    ('100 m2', '100 m2'),
+    ('$500 million', '500000000 USD'),
+    ('€2.5 billion', '2500000000 EUR'),
+    ('500 million USD', '500000000 USD'),
+    ('12–19 kilotons', '12-19 kt'),
+    ('40%', '40 %'),
+    ('more than 38,000', '>38000'),
+    ('around 3 million tonnes of CO2e', '~3000000 t CO2e'),
+])
+def test_normalize_quantified_value(expression, normalized):
+    assert normalize_quantified_value(expression) == normalized
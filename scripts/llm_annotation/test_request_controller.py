@@ -0,0 +1,51 @@
+import asyncio
+
+import openai
+import pytest
+
+from request_controller import CircuitOpenError, RequestController
+
+
+def test_rate_limiter_wait_is_not_latency():
+    '''
+    Time queued in before_request (the rate limiter) does not lower the in-flight limit
+    '''
+    controller = RequestController(initial_limit=4, max_limit=4, latency_target=0.05)
+
+    async def send_request():
+        await asyncio.sleep(0.001)
+        return 'response'
+
+    async def run():
+        stats = {"queue_wait": 0.0, "retries": 0}
+        result = await controller.call(send_request, stats, before_request=lambda: asyncio.sleep(0.1))
+        return result, stats
+
+    result, stats = asyncio.run(run())
+    assert result == 'response'
+    assert stats["queue_wait"] >= 0.1
+    assert controller.state()['limit'] == 4
+
+
+def test_open_circuit_pauses_requests():
+    '''
+    Requests wait for the cooldown of the open circuit instead of failing, and fail after max_trips openings in a row
+    '''
+    controller = RequestController(max_retries=10, base_delay=0, failure_threshold=2, cooldown=0.05, max_trips=2)
+    outcomes = iter([openai.APITimeoutError(request=None), openai.APITimeoutError(request=None), 'response'])
+
+    async def send_request():
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert asyncio.run(controller.call(send_request)) == 'response'
+    assert controller.state()['circuit_trips'] == 1
+
+    async def fail():
+        raise openai.APITimeoutError(request=None)
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(controller.call(fail))
+    assert controller.state()['circuit_trips'] == 3
@@ -0,0 +1,47 @@
+import pytest
+
+from llm_annotation import build_messages
+from response_parser import followup_messages, invalid_keys, merge_followup
+
+TEXT = 'In 2020 we reduced our CO2 emissions by 8%. (keyword: "CO2 emissions", event trigger: "reduced")'
+
+
+def test_followup_sends_prefix_input_and_missing_keys():
+    '''
+    The re-ask shares the cacheable prefix of the first request and asks for the missing keys only,
+    without the first answer or the instructions after the input
+    '''
+    messages = build_messages('chain_of_features', TEXT)
+    followup = followup_messages('chain_of_features', TEXT, ['measurability'])
+
+    assert followup[:-1] == messages[:-1]
+    assert [message['role'] for message in followup].count('assistant') == 1
+    first_prompt, followup_prompt = messages[-1]['content'], followup[-1]['content']
+    end_of_input = first_prompt.index(TEXT) + len(TEXT)
+    assert followup_prompt[:end_of_input] == first_prompt[:end_of_input]
+    request = followup_prompt[end_of_input:]
+    assert 'measurability' in request and 'temporal_status' not in request
+
+
+@pytest.mark.parametrize('task_name, response, invalid', [
+    ('category', {'label': 'action', 'reasoning': 'r'}, []),
+    ('category', {'label': 'Action ', 'reasoning': 'r'}, []),
+    ('category', {'label': 'acton', 'reasoning': 'r'}, ['label']),
+    ('measurability', {'label': 3, 'reasoning': 'r'}, []),
+    ('measurability', {'label': '6', 'reasoning': 'r'}, ['label']),
+    ('relation_temp', {'label': 'since 2011', 'reasoning': 'r'}, []),
+    ('chain_of_features', {'temporal_status': {'label': 'pasts', 'reasoning': 'r'},
+                           'time_specifications': {'label': '2020', 'reasoning': 'r'},
+                           'quantified_values': {'label': '8%', 'reasoning': 'r'},
+                           'measurability': {'label': '3', 'reasoning': 'r'},
+                           'category': {'label': 'action', 'reasoning': 'r'}}, ['temporal_status']),
+])
+def test_invalid_keys_checks_labels(task_name, response, invalid):
+    assert invalid_keys(task_name, response) == invalid
+
+
+def test_merge_followup_keeps_unparseable_response():
+    assert merge_followup('I cannot classify this.', 'Sorry.', ['label', 'reasoning']) == 'I cannot classify this.'
+    assert merge_followup('{"label": "acton"}', 'Sorry.', ['label', 'reasoning']) == '{"label": "acton"}'
+    assert merge_followup('{"label": "acton"}', '{"label": "action", "reasoning": "r"}', ['label', 'reasoning']) \
+        == '{"label": "action", "reasoning": "r"}'
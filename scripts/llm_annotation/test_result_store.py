@@ -0,0 +1,34 @@
+import pandas as pd
+
+from result_store import ResultStore
+
+
+def category_results(labels):
+    return pd.DataFrame({'row_id': range(len(labels)), 'gpt-4o_category_label': labels,
+                         'gpt-4o_category_reasoning': ['reasoning'] * len(labels)})
+
+
+def test_last_written_result_wins(tmp_path):
+    '''
+    The result written last wins, whatever the run names and even within the same second
+    '''
+    store = ResultStore(str(tmp_path))
+    store.append(category_results(['action', 'belief']), ['category'], 'gpt-4o', '991231-235959')
+    store.append(category_results(['intention', 'situation']), ['category'], 'gpt-4o', 'baseline')
+    store.append(category_results(['action']), ['category'], 'gpt-4o', 'baseline')
+
+    wide = store.to_wide()
+    assert wide['gpt-4o_category_label'].tolist() == ['action', 'situation']
+
+
+def test_run_selects_all_appends(tmp_path):
+    '''
+    Appends with the same run name (e.g. the chunks of a streamed run) are read together
+    '''
+    store = ResultStore(str(tmp_path))
+    store.append(category_results(['action']), ['category'], 'gpt-4o', 'streamed')
+    store.append(category_results(['belief', 'belief']).iloc[1:], ['category'], 'gpt-4o', 'streamed')
+    store.append(category_results(['situation']), ['category'], 'gpt-4o', 'other')
+
+    wide = store.to_wide(runs=['streamed'])
+    assert wide['gpt-4o_category_label'].tolist() == ['action', 'belief']
@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import pandas as pd
+import pytest
+
+from async_engine import classify_df_async
+from benchmark_local_overhead import synthetic_df
+from mock_server import canned_response
+from request_controller import RequestController
+from streaming import classify_stream, estimate_chunk_memory, read_input_chunks
+
+
+class MockAsyncCompletions:
+
+    def __init__(self, content):
+        self.content = content
+
+    async def create(self, model, messages, **kwargs):
+        await asyncio.sleep(0.001)
+        message = type('Message', (), {'content': self.content})
+        choice = type('Choice', (), {'message': message})
+        return type('Response', (), {'choices': [choice]})
+
+
+class MockAsyncClient:
+    '''
+    Stand-in for the AsyncOpenAI client that returns the same response for every request
+    '''
+
+    def __init__(self, content):
+        self.chat = type('Chat', (), {})()
+        self.chat.completions = MockAsyncCompletions(content)
+
+
+def test_stream_input_async_chunks_share_controller(tmp_path):
+    '''
+    --stream-input --async runs every chunk in its own event loop with one shared request controller
+    '''
+    input_path = tmp_path / 'input.csv'
+    synthetic_df(5).to_csv(input_path, index=False)
+    client = MockAsyncClient(canned_response('category'))
+    controller = RequestController(initial_limit=1, max_limit=1)
+
+    def classify_chunk(chunk):
+        return asyncio.run(classify_df_async(['category'], chunk, client, 'mock-model', controller=controller))
+
+    n_parts = classify_stream([str(input_path)], str(tmp_path / 'parts'), classify_chunk, 2, chunk_size=3)
+
+    assert n_parts == 2
+    parts = pd.concat([pd.read_csv(tmp_path / 'parts' / f'part-{part:05d}.csv') for part in range(n_parts)])
+    assert parts['row_id'].tolist() == list(range(5))
+    assert (parts['mock-model_category_label'] == json.loads(canned_response('category'))['label']).all()
+    assert controller.state()['successes'] == 5
+    assert controller.state()['in_flight'] == 0
+
+
+@pytest.mark.parametrize('input_format', ['csv', 'parquet'])
+def test_memory_ceiling_limits_rows_read(tmp_path, input_format):
+    '''
+    With a memory ceiling, chunks are read with fewer rows than chunk_size instead of being split after reading
+    '''
+    df = synthetic_df(5000)
+    input_path = str(tmp_path / f'input.{input_format}')
+    df.to_parquet(input_path) if input_format == 'parquet' else df.to_csv(input_path, index=False)
+
+    chunks = list(read_input_chunks([input_path], 5000, n_result_columns=2, max_memory_mb=0.1))
+
+    assert len(chunks) > 1
+    assert all(estimate_chunk_memory(chunk, 2) < 1.1 * 0.1 * 1024 * 1024 for chunk in chunks)
+    assert pd.concat(chunks)['row_id'].tolist() == list(range(len(df)))
+    assert pd.concat(chunks)['document'].tolist() == df['document'].tolist()
@@ -0,0 +1,246 @@
+'''
+SHAP values of the CatBoost category model of catboost_shap.ipynb, computed once and stored on disk.
+
+The SHAP values of a row only depend on the model and the feature values of the row, so they are stored per
+distinct row: for each model, .npy part files (memory-mapped on load) hold the (rows x features x classes) SHAP
+values computed with CatBoost's own TreeSHAP implementation (the same values as shap.TreeExplainer), next to
+the hashes of the explained rows. Explaining data again, a subset, a superset or a reordered copy of it only
+computes the rows whose hash is not stored yet, and duplicate rows are computed once. The per-class mean |SHAP|
+table, the per-feature-value groups of the box plots and the waterfall inputs are derived from the stored values
+with vectorized reductions.
+
+Usage: $python shap_store.py --data ../data/ground_truth_features_grouped_train.csv
+'''
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from catboost_predictor import FEATURES, MODEL_PATH, SCRIPTS_DIR, CategoryPredictor, make_pool, prepare_features
+
+SHAP_CACHE_DIR = os.path.join(SCRIPTS_DIR, 'cache', 'shap')
+
+# Order of the feature values in the box plots of the notebook, other features are sorted
+FEATURE_VALUE_ORDER = {'Event Factuality': ['_', 'negative', 'low', 'medium', 'high', 'max']}
+
+
+def model_hash(model):
+    '''
+    Hash of the serialized CatBoost model
+    '''
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'model.cbm')
+        model.save_model(path)
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+
+def row_hashes(X):
+    '''
+    64-bit hash of the feature values of each row
+    '''
+    return pd.util.hash_pandas_object(X, index=False).to_numpy()
+
+
+class ShapArtifacts:
+    '''
+    Stored SHAP values of a model on a dataset
+    unique_values: (distinct rows x features x classes) array
+    inverse: index of each row of X in unique_values
+    base_values: expected value of each class
+    X: explained features
+    classes: class names
+    '''
+
+    def __init__(self, unique_values, inverse, base_values, X, classes):
+        self.unique_values = unique_values
+        self.inverse = inverse
+        self.base_values = base_values
+        self.X = X
+        self.classes = list(classes)
+        self.features = list(X.columns)
+
+    @property
+    def values(self):
+        '''
+        (rows x features x classes) SHAP values of all rows of X
+        '''
+        return self.unique_values[self.inverse]
+
+    def mean_abs(self):
+        '''
+        Mean |SHAP| of each feature (rows) and class (columns), the bar plot table of the notebook
+        '''
+        # each distinct row weighted by its number of occurrences
+        counts = np.bincount(self.inverse, minlength=len(self.unique_values))
+        mean_abs = np.tensordot(counts, np.abs(self.unique_values), axes=1) / len(self.inverse)
+        return pd.DataFrame(mean_abs, index=self.features, columns=self.classes)
+
+    def feature_values(self, feature):
+        values = self.X[feature].unique().tolist()
+        if feature in FEATURE_VALUE_ORDER:
+            ordered = [value for value in FEATURE_VALUE_ORDER[feature] if value in values]
+            return ordered + sorted(value for value in values if value not in ordered)
+        return sorted(values)
+
+    def feature_value_groups(self, feature):
+        '''
+        SHAP values of the rows grouped by their value of the feature, for all classes at once
+        Returns a dict feature value -> (rows of the value x classes) array, in the box plot order.
+        The rows are grouped with one stable sort of the value codes instead of a boolean mask per value and class.
+        '''
+        index = self.features.index(feature)
+        order = self.feature_values(feature)
+        codes = pd.Categorical(self.X[feature], categories=order).codes
+        sorted_rows = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[sorted_rows], np.arange(len(order) + 1))
+        feature_values = self.unique_values[self.inverse[sorted_rows], index, :]
+        return {value: feature_values[bounds[i]:bounds[i + 1]] for i, value in enumerate(order)}
+
+    def feature_value_means(self):
+        '''
+        Mean SHAP value and number of rows of every feature value and class, computed with one bincount
+        per feature. Returns a long dataframe with the columns feature, value, rows and one column per class.
+        '''
+        tables = []
+        for index, feature in enumerate(self.features):
+            order = self.feature_values(feature)
+            codes = pd.Categorical(self.X[feature], categories=order).codes
+            counts = np.bincount(codes, minlength=len(order))
+            sums = np.stack([np.bincount(codes, weights=self.unique_values[self.inverse, index, class_index], minlength=len(order))
+                             for class_index in range(len(self.classes))], axis=1)
+            table = pd.DataFrame(sums / counts[:, None], columns=self.classes)
+            table.insert(0, 'rows', counts)
+            table.insert(0, 'value', order)
+            table.insert(0, 'feature', feature)
+            tables.append(table)
+        return pd.concat(tables, ignore_index=True)
+
+    def waterfall(self, row, category):
+        '''
+        Inputs of a waterfall plot of one row and class: SHAP values, base value, feature values and names
+        '''
+        class_index = self.classes.index(category)
+        return {
+            'values': np.asarray(self.unique_values[self.inverse[row], :, class_index]),
+            'base_values': float(self.base_values[class_index]),
+            'data': self.X.iloc[row].to_numpy(),
+            'feature_names': self.features,
+        }
+
+    def explanation(self, category=None):
+        '''
+        shap.Explanation of all rows (and of one class if given) for the plots of the shap package
+        '''
+        import shap
+
+        if category is None:
+            return shap.Explanation(np.asarray(self.values), base_values=np.tile(self.base_values, (len(self.X), 1)),
+                                    data=self.X.to_numpy(), feature_names=self.features)
+        class_index = self.classes.index(category)
+        return shap.Explanation(np.asarray(self.values[:, :, class_index]),
+                                base_values=np.full(len(self.X), self.base_values[class_index]),
+                                data=self.X.to_numpy(), feature_names=self.features)
+
+
+class ShapStore:
+    '''
+    SHAP values on disk per model and distinct row
+    store_dir: folder with one subfolder per model
+    '''
+
+    def __init__(self, store_dir=SHAP_CACHE_DIR):
+        self.store_dir = store_dir
+
+    def model_dir(self, model):
+        return os.path.join(self.store_dir, model_hash(model)[:32])
+
+    def load(self, model_dir):
+        '''
+        Hashes and memory-mapped SHAP values of all rows stored for a model, in part order
+        '''
+        parts = sorted(name[:-len('.hashes.npy')] for name in os.listdir(model_dir) if name.endswith('.hashes.npy'))
+        hashes = [np.load(os.path.join(model_dir, f'{part}.hashes.npy')) for part in parts]
+        values = [np.load(os.path.join(model_dir, f'{part}.values.npy'), mmap_mode='r') for part in parts]
+        return hashes, values
+
+    def write_part(self, model_dir, hashes, values):
+        '''
+        Write the SHAP values of new rows as a part of the model's store. The values are written first and the hashes
+        last, each under a temporary name that is renamed when complete, so only finished parts are ever read.
+        '''
+        part = os.path.join(model_dir, f'part-{time.time_ns()}-{os.getpid()}')
+        for suffix, array in [('values', values), ('hashes', hashes)]:
+            with open(f'{part}.{suffix}.npy.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(f'{part}.{suffix}.npy.tmp', f'{part}.{suffix}.npy')
+
+    def explain(self, predictor, X, chunk_size=100000):
+        '''
+        SHAP artifacts of the predictor on X. Only the distinct rows of X that are not stored yet are computed,
+        in chunks of rows, and added to the store.
+        predictor: CategoryPredictor
+        '''
+        X = prepare_features(X).reset_index(drop=True)
+        unique_hashes, first_rows, inverse = np.unique(row_hashes(X), return_index=True, return_inverse=True)
+        model_dir = self.model_dir(predictor.model)
+        os.makedirs(model_dir, exist_ok=True)
+        metadata_path = os.path.join(model_dir, 'metadata.json')
+
+        stored_hashes, stored_values = self.load(model_dir)
+        known = np.concatenate(stored_hashes) if stored_hashes else np.array([], dtype=np.uint64)
+        missing = first_rows[~np.isin(unique_hashes, known)]
+        for start in range(0, len(missing), chunk_size):
+            rows = missing[start:start + chunk_size]
+            # CatBoost returns (rows x classes x features + expected value)
+            shap_values = predictor.model.get_feature_importance(make_pool(X.iloc[rows]), type='ShapValues')
+            self.write_part(model_dir, row_hashes(X.iloc[rows]),
+                            np.ascontiguousarray(shap_values[:, :, :-1].transpose(0, 2, 1), dtype=np.float32))
+            if not os.path.exists(metadata_path):
+                with open(metadata_path, 'w') as f:
+                    json.dump({'features': FEATURES, 'classes': list(predictor.classes),
+                               'base_values': list(map(float, shap_values[0, :, -1]))}, f, indent=4)
+        if len(missing):
+            stored_hashes, stored_values = self.load(model_dir)
+
+        # position of each distinct row of X in the parts, gathered part by part from the memory-mapped files
+        hashes = np.concatenate(stored_hashes)
+        parts = np.repeat(np.arange(len(stored_hashes)), [len(part_hashes) for part_hashes in stored_hashes])
+        offsets = np.concatenate([np.arange(len(part_hashes)) for part_hashes in stored_hashes])
+        order = np.argsort(hashes, kind='stable')
+        positions = order[np.searchsorted(hashes[order], unique_hashes)]
+        unique_values = np.empty((len(unique_hashes), len(FEATURES), len(predictor.classes)), dtype=np.float32)
+        for part, values in enumerate(stored_values):
+            selected = parts[positions] == part
+            unique_values[selected] = values[offsets[positions[selected]]]
+
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        return ShapArtifacts(unique_values, inverse.ravel(), np.array(metadata['base_values']), X, metadata['classes'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute (or load) the stored SHAP values of the CatBoost category model.')
+    parser.add_argument('--data', default=os.path.join(SCRIPTS_DIR, '..', 'data', 'ground_truth_features_grouped_train.csv'))
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--store', default=SHAP_CACHE_DIR)
+    args = parser.parse_args()
+
+    predictor = CategoryPredictor.load_or_train(args.model)
+    X = pd.read_csv(args.data).dropna()[FEATURES]
+    store = ShapStore(args.store)
+    for attempt, data in [('first call', X), ('second call', X), ('reordered superset', pd.concat([X, X]).sample(frac=1, random_state=0))]:
+        start = time.perf_counter()
+        artifacts = store.explain(predictor, data)
+        print(f'{attempt}: SHAP values of {len(data)} rows ({len(artifacts.unique_values)} distinct) in {time.perf_counter() - start:.2f} s')
+    print(artifacts.mean_abs().to_string())
+    print(artifacts.feature_value_means().to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+'''
+Offset-based index of the annotated spans and the model inputs derived from it.
+
+Spans are stored as strings like '58-70 [fossil fuels]' (character offsets into the text and the span text).
+The offsets are parsed once into integer arrays, all marked input variants are built from the offsets:
+the BERT inputs with [KEYWORD]/[TRIGGER] tags around the annotated occurrence, the LLM inputs with the
+(keyword: ..., event trigger: ...) suffixes and the feature-augmented LLM inputs.
+
+Usage: $python spans.py --rows 1000000
+'''
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+SPAN_PATTERN = r'^\s*(?P<start>\d+)-(?P<end>\d+)\s*\[(?P<text>.*)\]\s*$'
+
+# Opening and closing tag of each span in the BERT inputs
+BERT_MARKERS = {
+    'keyword': ('[KEYWORD] ', ' [/KEYWORD]'),
+    'event_trigger': ('[TRIGGER] ', ' [/TRIGGER]'),
+}
+
+
+def to_arrow(column):
+    '''
+    Column as a pyarrow string array, missing values as 'nan' like in an f-string
+    '''
+    return pa.array(column.astype(object).fillna('nan').astype(str).to_numpy(dtype=object), type=pa.string())
+
+
+def parse_spans(spans):
+    '''
+    Start and end offsets and text of a column of annotated spans, parsed in one regex pass by pyarrow
+    spans: series of span strings like '58-70 [fossil fuels]'
+    Returns int32 arrays of the start and end offsets (-1 for missing or malformed spans) and a pyarrow
+    string array of the span texts ('' for missing spans).
+    '''
+    parts = pc.extract_regex(pa.array(spans.to_numpy(dtype=object), type=pa.string(), from_pandas=True), SPAN_PATTERN)
+    starts = pc.cast(pc.struct_field(parts, 'start'), pa.int32()).fill_null(-1).to_numpy(zero_copy_only=False)
+    ends = pc.cast(pc.struct_field(parts, 'end'), pa.int32()).fill_null(-1).to_numpy(zero_copy_only=False)
+    return starts, ends, pc.struct_field(parts, 'text').fill_null('')
+
+
+def span_text(span):
+    '''
+    Text of an annotated span like '58-70 [fossil fuels]', '' if the span is missing
+    '''
+    if not isinstance(span, str):
+        return ""
+    start = span.find('[')
+    end = span.rfind(']')
+    return span[start + 1:end] if 0 <= start < end else ""
+
+
+def join(*parts):
+    '''
+    Element-wise concatenation of pyarrow string arrays and string constants
+    '''
+    return pc.binary_join_element_wise(*parts, '')
+
+
+class SpanIndex:
+    '''
+    Texts and the character offsets of their annotated spans
+    texts: array of the texts
+    offsets: dict span name -> (starts, ends) int32 arrays, -1 for missing spans
+    span_texts: optional dict span name -> pyarrow string array of the span texts
+    '''
+
+    def __init__(self, texts, offsets, span_texts=None):
+        self.texts = np.asarray(texts, dtype=object)
+        self.offsets = offsets
+        self.texts_of_spans = span_texts or {}
+
+    @classmethod
+    def from_df(cls, df, columns=('keyword', 'event_trigger'), text_column='text'):
+        offsets, span_texts = {}, {}
+        for column in columns:
+            starts, ends, texts = parse_spans(df[column])
+            offsets[column] = (starts, ends)
+            span_texts[column] = texts
+        return cls(df[text_column].to_numpy(dtype=object), offsets, span_texts)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def span_texts(self, name):
+        '''
+        Text of the span of each row as a pyarrow string array ('' for missing spans)
+        '''
+        if name not in self.texts_of_spans:
+            starts, ends = self.offsets[name]
+            self.texts_of_spans[name] = pa.array([text[start:end] if start >= 0 else ''
+                                                  for text, start, end in zip(self.texts, starts.tolist(), ends.tolist())],
+                                                 type=pa.string())
+        return self.texts_of_spans[name]
+
+    def marked_texts(self, markers=BERT_MARKERS, block_size=50000):
+        '''
+        Texts with the opening and closing tag of each span inserted at its offsets. Only the annotated
+        occurrence is tagged, missing spans get no tags. The tag order is computed for all rows at once:
+        adjacent spans close before the next one opens, nested spans open outer first and close inner first,
+        and spans with the same offsets open in the order of markers and close in the reverse order.
+        markers: dict span name -> (opening tag, closing tag)
+        block_size: number of rows whose tags are inserted at once
+        '''
+        positions, kinds, secondary, tertiary, tag_ids = [], [], [], [], []
+        tag_table = ['']
+        for marker, (name, (opening, closing)) in enumerate(markers.items()):
+            starts, ends = self.offsets[name]
+            present = starts >= 0
+            positions += [np.where(present, starts, 0), np.where(present, ends, 0)]
+            kinds += [np.ones(len(self), dtype=np.int8), np.zeros(len(self), dtype=np.int8)]
+            secondary += [-ends, -starts]
+            tertiary += [np.full(len(self), marker), np.full(len(self), -marker)]
+            tag_ids += [np.where(present, len(tag_table), 0), np.where(present, len(tag_table) + 1, 0)]
+            tag_table += [opening, closing]
+        positions = np.stack(positions, axis=1)
+        order = np.lexsort((np.stack(tertiary, axis=1), np.stack(secondary, axis=1), np.stack(kinds, axis=1), positions), axis=1)
+        positions = np.take_along_axis(positions, order, axis=1)
+        tag_ids = np.take_along_axis(np.stack(tag_ids, axis=1), order, axis=1)
+        # blocks of rows keep the byte arrays of insert_tags small
+        return np.concatenate([insert_tags(self.texts[start:start + block_size], positions[start:start + block_size],
+                                           tag_ids[start:start + block_size], tag_table)
+                               for start in range(0, len(self), block_size)] or [np.array([], dtype=object)])
+
+
+def insert_tags(texts, positions, tag_ids, tag_table):
+    '''
+    Texts with the tags inserted at the character positions, for all rows at once: the tag bytes are inserted
+    into the UTF-8 data buffer of a pyarrow string array with one np.insert, and the row offsets are shifted
+    by the number of inserted bytes
+    texts: array of n texts
+    positions: (n x k) character offsets, sorted within each row
+    tag_ids: (n x k) index of the tag in tag_table of each position, tags are inserted in the given order at
+             equal positions
+    tag_table: list of tags, '' for no tag
+    '''
+    array = pa.array(texts, type=pa.large_string())
+    offsets = np.frombuffer(array.buffers()[1], dtype=np.int64)[:len(texts) + 1]
+    data = np.frombuffer(array.buffers()[2], dtype=np.uint8)[:offsets[-1]] if offsets[-1] else np.array([], dtype=np.uint8)
+    char_lengths = pc.utf8_length(array).to_numpy(zero_copy_only=False).astype(np.int64)
+    byte_lengths = np.diff(offsets)
+
+    rows = np.repeat(np.arange(len(texts)), positions.shape[1])
+    # offsets past the end of a text are inserted at its end, as slicing would
+    positions = np.minimum(positions.ravel(), char_lengths[rows])
+    if (char_lengths == byte_lengths).all():
+        targets = offsets[rows] + positions
+    else:
+        # byte offset of every character: the bytes that do not continue a multi-byte character
+        char_bytes = np.append(np.flatnonzero((data & 0xC0) != 0x80), len(data))
+        row_chars = np.concatenate([[0], np.cumsum(char_lengths)])
+        targets = np.where(positions < char_lengths[rows], char_bytes[row_chars[rows] + positions], offsets[rows + 1])
+
+    # bytes of every inserted tag, in row and position order
+    tag_bytes = [np.frombuffer(tag.encode('utf-8'), dtype=np.uint8) for tag in tag_table]
+    tag_lengths = np.array([len(tag) for tag in tag_bytes], dtype=np.int64)
+    tag_starts = np.concatenate([[0], np.cumsum(tag_lengths)[:-1]])
+    tag_ids = tag_ids.ravel()
+    lengths = tag_lengths[tag_ids]
+    inserted = np.repeat(np.arange(tag_ids.size), lengths)
+    within_tag = np.arange(inserted.size) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    marked = np.insert(data, targets[inserted], np.concatenate(tag_bytes)[tag_starts[tag_ids[inserted]] + within_tag])
+
+    inserted_per_row = lengths.reshape(len(texts), -1).sum(axis=1)
+    marked_offsets = offsets + np.concatenate([[0], np.cumsum(inserted_per_row)])
+    array = pa.LargeStringArray.from_buffers(len(texts), pa.py_buffer(marked_offsets), pa.py_buffer(marked))
+    return array.to_numpy(zero_copy_only=False).astype(object)
+
+
+def bert_inputs(df, index=None):
+    '''
+    BERT input of each row: the text with [KEYWORD] and [TRIGGER] tags around the annotated spans
+    '''
+    index = index if index is not None else SpanIndex.from_df(df)
+    return pd.Series(index.marked_texts(), index=df.index, dtype=object)
+
+
+def llm_inputs(df, index=None):
+    '''
+    Input columns of the LLM tasks (see input_column in llm_annotation/llm_annotation.py) built from the offsets:
+    text_kw, text_kw_et and, if the feature columns are present, text_kw_et_man and text_kw_et_all
+    Returns a dataframe with the same index as df.
+    '''
+    index = index if index is not None else SpanIndex.from_df(df)
+    # the suffixes follow the stripped text, as in the text_kw/text_kw_et columns of the ground truth
+    text = pc.utf8_trim_whitespace(pa.array(index.texts, type=pa.string()))
+    keyword = index.span_texts('keyword')
+    event_trigger = index.span_texts('event_trigger')
+
+    inputs = {
+        'text_kw': join(text, ' (keyword: "', keyword, '")'),
+        'text_kw_et': join(text, ' (keyword: "', keyword, '", event trigger: "', event_trigger, '")'),
+    }
+    if {'temporal_status', 'relation_time_specification', 'relation_unit', 'measurability'}.issubset(df.columns):
+        text_kw_et_man = join(text, " (keyword: '", keyword, "', event trigger: '", event_trigger,
+                              "', temporal status: '", to_arrow(df['temporal_status']),
+                              "', time specifications: '", parse_spans(df['relation_time_specification'])[2],
+                              "', quantified values: '", parse_spans(df['relation_unit'])[2],
+                              "', measurability: '", to_arrow(df['measurability'].astype(object).map(str).str.split('.').str[0]), "'")
+        inputs['text_kw_et_man'] = join(text_kw_et_man, ")")
+        if {'event_factuality', 'kw_is_nsubj', 'kw_is_dobj', 'kw_is_pobj'}.issubset(df.columns):
+            inputs['text_kw_et_all'] = join(text_kw_et_man, ", event_factuality: '", to_arrow(df['event_factuality']),
+                                            "', kw_is_nsubj: \"", to_arrow(df['kw_is_nsubj']),
+                                            "\", kw_is_dobj: \"", to_arrow(df['kw_is_dobj']),
+                                            "\", kw_is_pobj: \"", to_arrow(df['kw_is_pobj']), "\")")
+    return pd.DataFrame({column: pd.Series(values.to_pandas().to_numpy(), index=df.index, dtype=object)
+                         for column, values in inputs.items()}, index=df.index)
+
+
+def add_input_columns(df, overwrite=False):
+    '''
+    Add the missing LLM input columns to the dataframe, computed from the keyword and event trigger offsets
+    overwrite: recompute columns that are already present
+    '''
+    if not {'text', 'keyword', 'event_trigger'}.issubset(df.columns):
+        return df
+    inputs = llm_inputs(df)
+    for column in inputs.columns:
+        if overwrite or column not in df.columns:
+            df[column] = inputs[column]
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the offset-based input generation on the replicated ground truth.')
+    parser.add_argument('--data', default='../data/ground_truth_test.csv', help='ground truth CSV file')
+    parser.add_argument('--rows', type=int, default=1000000, help='number of rows after replicating the ground truth')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data)
+    df = pd.concat([df] * -(-args.rows // len(df)), ignore_index=True).head(args.rows)
+
+    start = time.perf_counter()
+    index = SpanIndex.from_df(df)
+    parsed = time.perf_counter()
+    bert = bert_inputs(df, index)
+    marked = time.perf_counter()
+    inputs = llm_inputs(df, index)
+    finished = time.perf_counter()
+    print(f'{len(df)} rows: parse offsets {parsed - start:.2f} s, BERT inputs {marked - parsed:.2f} s, '
+          f'LLM inputs ({len(inputs.columns)} columns) {finished - marked:.2f} s')
+    print(bert.iloc[0])
+
+
+if __name__ == "__main__":
+    main()
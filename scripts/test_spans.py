@@ -0,0 +1,19 @@
+import pandas as pd
+import pytest
+
+from spans import bert_inputs
+
+
+@pytest.mark.parametrize('keyword, event_trigger, marked', [
+    ('0-3 [abc]', '0-3 [abc]', '[KEYWORD] [TRIGGER] abc [/TRIGGER] [/KEYWORD] def'),
+    ('0-7 [abc def]', '4-7 [def]', '[KEYWORD] abc [TRIGGER] def [/TRIGGER] [/KEYWORD]'),
+    ('4-7 [def]', '0-7 [abc def]', '[TRIGGER] abc [KEYWORD] def [/KEYWORD] [/TRIGGER]'),
+    ('0-3 [abc]', '3-7 [ def]', '[KEYWORD] abc [/KEYWORD][TRIGGER]  def [/TRIGGER]'),
+    ('4-7 [def]', None, 'abc [KEYWORD] def [/KEYWORD]'),
+])
+def test_bert_inputs_nest_tags(keyword, event_trigger, marked):
+    '''
+    Tags of nested and coincident spans nest, adjacent spans close before the next one opens
+    '''
+    df = pd.DataFrame({'text': ['abc def'], 'keyword': [keyword], 'event_trigger': [event_trigger]})
+    assert bert_inputs(df).tolist() == [marked]